@@ -1,4 +1,3 @@
-import asyncio
 import json
 import logging
 import os
@@ -12,6 +11,8 @@ logging.basicConfig(level=logging.INFO,
 logger = logging.getLogger(__name__)
 
 NUMBER_0F_ITEMS = 1
+# Split the stock of each item in this many parts, the stock service must run with SPLIT_ITEMS=True
+ITEM_PARTS = int(os.environ.get('ITEM_PARTS', 1))
 ITEM_STARTING_STOCK = 100
 ITEM_PRICE = 1
 NUMBER_OF_USERS = 1000
@@ -36,34 +37,24 @@ async def post_and_get_field(session, url, field):
 
 
 async def create_items(session, number_of_items: int, stock: int, price: int) -> List[str]:
-    tasks = []
-    # Create items
-    for _ in range(number_of_items):
-        create_item_url = f"{STOCK_URL}/stock/item/create/{price}"
-        tasks.append(asyncio.ensure_future(post_and_get_field(session, create_item_url, 'item_id')))
-    item_ids : List[str] = await asyncio.gather(*tasks)
-    tasks = []
-    # Add stock
-    for item_id in item_ids:
-        create_item_url = f"{STOCK_URL}/stock/add/{item_id}/{stock}"
-        tasks.append(asyncio.ensure_future(post_and_get_status(session, create_item_url)))
-    await asyncio.gather(*tasks)
+    # Create items with their stock in a single request
+    create_items_url = f"{STOCK_URL}/stock/item/batch_create/{number_of_items}/{price}/{stock}"
+    item_ids: List[str] = await post_and_get_field(session, create_items_url, 'item_ids')
     return item_ids
 
 
+async def split_items(session, item_ids: List[str], parts: int):
+    # Split the stock of the hot items, so the checkouts do not contend for one counter
+    for item_id in item_ids:
+        status = await post_and_get_status(session, f"{STOCK_URL}/stock/item/split/{item_id}/{parts}")
+        if status != 200:
+            logger.error(f"Failed to split item {item_id}")
+
+
 async def create_users(session, number_of_users: int, credit: int) -> List[str]:
-    tasks = []
-    # Create users
-    for _ in range(number_of_users):
-        create_user_url = f"{PAYMENT_URL}/payment/create_user"
-        tasks.append(asyncio.ensure_future(post_and_get_field(session, create_user_url, 'user_id')))
-    user_ids: List[str] = await asyncio.gather(*tasks)
-    tasks = []
-    # Add funds
-    for user_id in user_ids:
-        add_funds_url = f"{PAYMENT_URL}/payment/add_funds/{user_id}/{credit}"
-        tasks.append(asyncio.ensure_future(post_and_get_status(session, add_funds_url)))
-    await asyncio.gather(*tasks)
+    # Create users with their credit in a single request
+    create_users_url = f"{PAYMENT_URL}/payment/batch_create_users/{number_of_users}/{credit}"
+    user_ids: List[str] = await post_and_get_field(session, create_users_url, 'user_ids')
     return user_ids
 
 
@@ -73,6 +64,8 @@ async def populate_databases():
         # create item with 100 stock
         item_ids: List[str] = await create_items(session, NUMBER_0F_ITEMS,
                                                  ITEM_STARTING_STOCK, ITEM_PRICE)
+        if ITEM_PARTS > 1:
+            await split_items(session, item_ids, ITEM_PARTS)
         logger.info("Items created")
 
         logger.info("Creating users ...")
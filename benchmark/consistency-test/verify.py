@@ -24,30 +24,36 @@ with open(os.path.join('..', 'urls.json')) as f:
     STOCK_URL = urls['STOCK_URL']
 
 
-async def get_and_get_field(session, url, field, key):
-    async with session.get(url) as resp:
+# Number of ids read per find_batch request
+FIND_BATCH_SIZE = 1000
+
+
+async def post_and_get_fields(session, url, ids, field):
+    async with session.post(url, json=ids) as resp:
         jsn = await resp.json()
-        return key, jsn[field]
+        return [(key, value[field]) for key, value in jsn.items()]
 
 
 async def get_user_credit_dict(session, user_id_list: List[str]) -> Dict[str, int]:
     tasks = []
     # Get credit
-    for user_id in user_id_list:
-        create_item_url = f"{PAYMENT_URL}/payment/find_user/{user_id}"
-        tasks.append(asyncio.ensure_future(get_and_get_field(session, create_item_url, 'credit', user_id)))
-    user_id_credit: List[Tuple[str, int]] = await asyncio.gather(*tasks)
-    return dict(user_id_credit)
+    for i in range(0, len(user_id_list), FIND_BATCH_SIZE):
+        find_users_url = f"{PAYMENT_URL}/payment/find_batch"
+        tasks.append(asyncio.ensure_future(post_and_get_fields(session, find_users_url,
+                                                               user_id_list[i:i + FIND_BATCH_SIZE], 'credit')))
+    user_id_credit: List[List[Tuple[str, int]]] = await asyncio.gather(*tasks)
+    return dict(pair for batch in user_id_credit for pair in batch)
 
 
 async def get_item_stock_dict(session, item_id_list: Union[List[str], str]) -> Dict[str, int]:
     tasks = []
     # Get stock
-    for item_id in item_id_list:
-        create_item_url = f"{STOCK_URL}/stock/find/{item_id}"
-        tasks.append(asyncio.ensure_future(get_and_get_field(session, create_item_url, 'stock', item_id)))
-    item_id_stock: List[Tuple[str, int]] = await asyncio.gather(*tasks)
-    return dict(item_id_stock)
+    for i in range(0, len(item_id_list), FIND_BATCH_SIZE):
+        find_items_url = f"{STOCK_URL}/stock/find_batch"
+        tasks.append(asyncio.ensure_future(post_and_get_fields(session, find_items_url,
+                                                               item_id_list[i:i + FIND_BATCH_SIZE], 'stock')))
+    item_id_stock: List[List[Tuple[str, int]]] = await asyncio.gather(*tasks)
+    return dict(pair for batch in item_id_stock for pair in batch)
 
 
 def get_prior_user_state(user_ids):
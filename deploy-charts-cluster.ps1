@@ -26,6 +26,9 @@ helm install -f helm-config/redis-helm-values.yaml stock-db-0 bitnami/redis
 helm install -f helm-config/redis-helm-values.yaml stock-db-1 bitnami/redis
 helm install -f helm-config/redis-helm-values.yaml stock-db-2 bitnami/redis
 
+echo "Installing Redis Helm Chart for the message bus..."
+helm install -f helm-config/redis-helm-values.yaml bus-db bitnami/redis
+
 echo "Installing Nginx Helm Chart to enable the ingress..."
 helm install -f helm-config/nginx-helm-values.yaml nginx ingress-nginx/ingress-nginx
 
@@ -32,5 +32,8 @@ helm install -f helm-config/redis-helm-values.yaml stock-db-0 bitnami/redis --se
 helm install -f helm-config/redis-helm-values.yaml stock-db-1 bitnami/redis --set master.service.nodePorts.redis=30210 --set replica.service.nodePorts.redis=30211
 helm install -f helm-config/redis-helm-values.yaml stock-db-2 bitnami/redis --set master.service.nodePorts.redis=30220 --set replica.service.nodePorts.redis=30221
 
+echo "Installing Redis Helm Chart for the message bus..."
+helm install -f helm-config/redis-helm-values.yaml bus-db bitnami/redis --set master.service.nodePorts.redis=30300 --set replica.service.nodePorts.redis=30301
+
 echo "Applying k8s yml files..."
 kubectl apply -f k8s
@@ -1,88 +1,115 @@
 import json
 import os
-import atexit
-import random
+import threading
+import time
 from talepy import run_transaction
-from checkout_classes import DebitCustomerBalance, RetrieveStock, UpdateOrder
+from checkout_classes import DebitCustomerBalance, RetrieveStock, UpdateOrder, precheck_order
+from service_client import payment_service, stock_service
+from item_cache import item_prices, sold_out_items
+from checkout_coalescing import CHECKOUT_COALESCING, coalesce_checkout, in_flight_checkouts
+from compensations import (COMPENSATION_WORKERS, enqueue_compensation, outbox_depth,
+                           start_compensation_workers)
+from checkout_worker import (CHECKOUT_STREAM, CHECKOUT_WORKERS, CHECKOUT_QUEUED, checkout_status_key,
+                             start_workers)
+from saga_log import PENDING_SAGAS, SagaLog, abort_saga, is_pending, recover_saga, saga_key
+from saga_planner import PAYMENT_STEP, STOCK_STEP, plan_steps, saga_stats
+from scripts import (ADD_ITEM, REMOVE_ITEM, ENQUEUE_CHECKOUT, ITEM_FIELD_PREFIX, PRICE_FIELD_PREFIX, SCRIPT_OK,
+                     SCRIPT_ORDER_NOT_FOUND, SCRIPT_ORDER_LOCKED, SCRIPT_ORDER_PAID, SCRIPT_NOT_ENOUGH_STOCK,
+                     SCRIPT_PRICE_UNKNOWN)
 
 from flask import Flask, Response
-import requests
-import redis
 
-from pottery import Redlock
+from bus import STOCK_RESTOCKED, subscribe
+from lease_lock import LOCK_WAIT_TIMEOUT, LeaseLock, backoff, held_locks, lock_key, locked
+from sharding import db_shards, get_db, get_read_db, allocate_ids
 
-STOCK_SERVICE_URL = os.environ['STOCK_SERVICE_URL']
-PAYMENT_SERVICE_URL = os.environ['USER_SERVICE_URL']
-
-RANDOM_SEED = 42
-ID_BYTES_SIZE = 32
-LOCK_AUTORELEASE_TIME = 120
-
-# Set random seed to generate unique ids for the items
-random.seed(RANDOM_SEED)
+# Serve the reads with a single HGETALL without locking the order
+LOCK_FREE_READS = os.environ.get('LOCK_FREE_READS', 'False') == 'True'
+# Queue the checkouts and run them with the checkout workers, the client polls their status
+ASYNC_CHECKOUT = os.environ.get('ASYNC_CHECKOUT', 'False') == 'True'
+# Seconds between the runs of the recovery of the unfinished checkout sagas, 0 disables it
+SAGA_RECOVERY_INTERVAL = int(os.environ.get('SAGA_RECOVERY_INTERVAL', 30))
+# Seconds since the last update of a saga before the recovery considers it abandoned
+SAGA_RECOVERY_GRACE = int(os.environ.get('SAGA_RECOVERY_GRACE', 10))
 
 app = Flask("order-service")
 
-# Connect to DB
-db_0: redis.Redis = redis.Redis(host=os.environ['REDIS_HOST_0'],
-                                port=int(os.environ['REDIS_PORT']),
-                                password=os.environ['REDIS_PASSWORD'],
-                                db=int(os.environ['REDIS_DB']))
-
-db_1: redis.Redis = redis.Redis(host=os.environ['REDIS_HOST_1'],
-                                port=int(os.environ['REDIS_PORT']),
-                                password=os.environ['REDIS_PASSWORD'],
-                                db=int(os.environ['REDIS_DB']))
-
-db_2: redis.Redis = redis.Redis(host=os.environ['REDIS_HOST_2'],
-                                port=int(os.environ['REDIS_PORT']),
-                                password=os.environ['REDIS_PASSWORD'],
-                                db=int(os.environ['REDIS_DB']))
-
-db_shards = [db_0, db_1, db_2]
-MODULO_HASH = len(db_shards)
-
-
-def close_db_connection():
-    """
-    Close the DB connection
-    """
-    for db in db_shards:
-        db.close()
-
-
-# Retrieve DB from item_id
-def get_db(item_id: str):
-    """
-    Retrieve the DB where the item_id is stored.
-    :param item_id: The item id.
-    :return: The db connection.
-    """
-    item_id_bytes = int(item_id.split(":")[1])
-    db_idx = item_id_bytes % MODULO_HASH
-
-    return db_shards[db_idx]
-
-
-# Run close_db_connection function when service ends
-atexit.register(close_db_connection)
+# Register the scripts, they are executed with EVALSHA on the shard passed as client
+add_item_script = db_shards[0].register_script(ADD_ITEM)
+remove_item_script = db_shards[0].register_script(REMOVE_ITEM)
+enqueue_checkout_script = db_shards[0].register_script(ENQUEUE_CHECKOUT)
 
 
 def convert_order(order):
     """
     Convert the order from bytes to proper types.
+    Each line item is stored in its own field, orders stored with the legacy JSON blob of items are also supported.
 
     :return: The order as a dictionary.
     """
+    items = json.loads(order[b"items"].decode("utf-8")) if b"items" in order else {}
+    for field, amount in order.items():
+        field = field.decode("utf-8")
+        if field.startswith(ITEM_FIELD_PREFIX):
+            items[field[len(ITEM_FIELD_PREFIX):]] = int(amount)
+
     return {
         "order_id": order[b"order_id"].decode("utf-8"),
         "user_id": order[b"user_id"].decode("utf-8"),
-        "items": json.loads(order[b"items"].decode("utf-8")),
+        "items": items,
         "paid": json.loads(order[b"paid"].decode("utf-8")),
         "total_cost": int(order[b"total_cost"])
     }
 
 
+def script_error_response(result, order_id: str, item_id: str):
+    """
+    Convert the failed result of an order script to the corresponding error response.
+
+    :param result: The result of the script.
+    :param order_id: The id of the order.
+    :param item_id: The id of the item.
+    :return: The error response.
+    """
+    if result[0] == SCRIPT_ORDER_NOT_FOUND:
+        return Response(f"The order {order_id} does not exist in the DB!", status=404)
+    if result[0] == SCRIPT_ORDER_LOCKED:
+        return Response(f"The order {order_id} is locked, try later", status=400)
+    if result[0] == SCRIPT_ORDER_PAID:
+        return Response(f"The order {order_id} is already paid!", status=400)
+    if result[0] == SCRIPT_NOT_ENOUGH_STOCK:
+        return Response(f"There is no more available stock for this item {item_id}", status=400)
+    return Response(f"The item {item_id} does not exist in order {order_id}", status=404)
+
+
+def run_cart_script(script, order_id: str, args, db):
+    """
+    Run a script that updates the items of an order, waiting with backoff while a checkout holds the lock of the
+    order, up to LOCK_WAIT_TIMEOUT.
+
+    :param script: The registered script.
+    :param order_id: The id of the order.
+    :param args: The arguments of the script.
+    :param db: The db connection of the order.
+    :return: The result of the script.
+    """
+    deadline = time.monotonic() + LOCK_WAIT_TIMEOUT if LOCK_WAIT_TIMEOUT >= 0 else None
+    attempt = 0
+    while True:
+        result = script(keys=[order_id, lock_key(order_id)], args=args, client=db)
+        if result[0] != SCRIPT_ORDER_LOCKED:
+            return result
+
+        if deadline is not None and time.monotonic() >= deadline:
+            return result
+
+        delay = backoff(attempt)
+        if deadline is not None:
+            delay = min(delay, deadline - time.monotonic())
+        time.sleep(max(delay, 0))
+        attempt += 1
+
+
 class Order:
     """
     Order class that defines the saved information in order.
@@ -102,14 +129,17 @@ class Order:
         :return: The class dictionary.
         """
         # Redis expects a dictionary of key-value pairs where the values can only be bytes, strings, integers, or floats
-        # Dictionaries and booleans are not supported.
-        return {
+        # Dictionaries and booleans are not supported, so each item is stored in its own counter field.
+        order = {
             "order_id": self.order_id,
             "user_id": self.user_id,
-            "items": json.dumps(self.items),
             "paid": json.dumps(self.paid),
             "total_cost": self.total_cost
         }
+        for item_id, amount in self.items.items():
+            order[f"{ITEM_FIELD_PREFIX}{item_id}"] = amount
+
+        return order
 
 
 @app.post('/create/<user_id>')
@@ -122,20 +152,17 @@ def create_order(user_id: str):
     """
     
     # Check user_id exists in payment
-    check_user_id = f"{PAYMENT_SERVICE_URL}/find_user/{user_id}"
+    check_user_id = f"/find_user/{user_id}"
     try:
-        response = requests.get(check_user_id)
+        response = payment_service.get(check_user_id)
         if response.status_code != 200:
             return Response(response.content, status=response.status_code)
     except Exception as err:
         return Response(str(err), status=400)
 
     # Create unique order id
-    new_order_id = f"order:{random.getrandbits(ID_BYTES_SIZE)}"
+    new_order_id = allocate_ids("order")[0]
     db = get_db(new_order_id)
-    while db.hget(new_order_id, "order_id"):
-        new_order_id = f"order:{random.getrandbits(ID_BYTES_SIZE)}"
-        db = get_db(new_order_id)
 
     # Create a new order
     new_order = Order(order_id=new_order_id, user_id=user_id)
@@ -161,56 +188,67 @@ def remove_order(order_id):
     :param order_id: The id of the order to be deleted.
     :return: Empty successful response if successful, otherwise error.
     """
-    # Lock the order
+    # Lock the order, it is released when the block exits
     db = get_db(order_id)
-    order_lock = Redlock(key=order_id, masters={db}, auto_release_time=LOCK_AUTORELEASE_TIME)
+    with locked(LeaseLock(order_id, db)) as acquired:
+        if not acquired:
+            return Response(f"The order {order_id} is locked, try later", status=400)
 
-    if order_lock.acquire():
         try:
             result = db.delete(order_id)  # deletes the whole order and
             # will return 0 if the entry does not exist
         except Exception as err:
-            order_lock.release()
             return Response(str(err), status=400)
 
         # Check the result
         if not result:
-            order_lock.release()
             return Response(f"The order {order_id} does not exist in the DB!", status=404)
 
-        # Release the lock
-        order_lock.release()
-
         return Response(json.dumps(f"The order with id {order_id} is removed successfully."),
                         mimetype="application/json", status=200)
-    else:
-        return Response(f"The order {order_id} is locked, try later", status=400)
+
+
+def order_response(order_id: str, order):
+    """
+    Build the response of a retrieved order.
+
+    :param order_id: The id of the order.
+    :param order: The order as returned by the DB.
+    :return: The order with the proper types, or an error if it does not exist.
+    """
+    if not order:
+        return Response(f"There isn't any order with {order_id} in the DB!", status=404)
+
+    # Convert bytes to proper types
+    return_order = convert_order(order)
+
+    return Response(json.dumps(return_order), mimetype="application/json", status=200)
 
 
 @app.get('/find/<order_id>')
 def find_order(order_id):
-    db = get_db(order_id)
-    # Lock the order
-    order_lock = Redlock(key=order_id, masters={db}, auto_release_time=LOCK_AUTORELEASE_TIME)
+    db = get_read_db(order_id)
 
-    if order_lock.acquire():
+    if LOCK_FREE_READS:
+        # HGETALL is atomic and every write of the order is atomic, so it always returns a consistent order
         try:
             order = db.hgetall(order_id)  # returns dictionary
         except Exception as err:
-            order_lock.release()
             return Response(str(err), status=400)
 
-        order_lock.release()
+        return order_response(order_id, order)
 
-        if not order:
-            return Response(f"There isn't any order with {order_id} in the DB!", status=404)
+    # Lock the order, it is released when the block exits
+    with locked(LeaseLock(order_id, db)) as acquired:
+        if not acquired:
+            return Response(f"The order {order_id} is locked, try later", status=400)
 
-        # Convert bytes to proper types
-        return_order = convert_order(order)
+        try:
+            order = db.hgetall(order_id)  # returns dictionary
+        except Exception as err:
+            return Response(str(err), status=400)
 
-        return Response(json.dumps(return_order), mimetype="application/json", status=200)
-    else:
-        return Response(f"The order {order_id} is locked, try later", status=400)
+        return order_response(order_id, order)
 
 
 @app.post('/addItem/<order_id>/<item_id>')
@@ -223,66 +261,38 @@ def add_item(order_id, item_id):
     :return: A successful response if the operation is successful, an error otherwise.
     """
     db = get_db(order_id)
-    # Lock the order
-    order_lock = Redlock(key=order_id, masters={db}, auto_release_time=LOCK_AUTORELEASE_TIME)
-    if order_lock.acquire():
-        # Retrieve order
-        try:
-            order = db.hgetall(order_id)  # returns dictionary
-        except Exception as err:
-            order_lock.release()
-            return Response(str(err), status=400)
 
-        # Check if the order exists
-        if not order:
-            order_lock.release()
-            return Response(f"The order {order_id} does not exist in the DB!", status=404)
-
-        # Convert bytes to proper types
-        order = convert_order(order)
+    # Fail fast if the item ran out of stock recently
+    if sold_out_items.unavailable({item_id: 1}) is not None:
+        return Response(f"There is no more available stock for this item {item_id}", status=400)
 
-        # Check if the order is paid and abort if so
-        if order.get("paid"):
-            order_lock.release()
-            return Response(f"The order {order_id} is already paid!", status=400)
-
-        # Check if item exist in the stock and the stock is more than 0
-        find_item_in_stock = f"{STOCK_SERVICE_URL}/find/{item_id}"
-        try:
-            response = requests.get(find_item_in_stock)
-            if response.status_code != 200:
-                order_lock.release()
-                return Response(response.content, status=response.status_code)
-        except Exception as err:
-            order_lock.release()
-            return Response(str(err), status=400)
-
-        item_to_be_added = json.loads(response.content)
-        added_items = order.get("items")
+    # Check if item exist in the stock and the stock is more than 0
+    find_item_in_stock = f"/find/{item_id}"
+    try:
+        response = stock_service.get(find_item_in_stock)
+        if response.status_code != 200:
+            return Response(response.content, status=response.status_code)
+    except Exception as err:
+        return Response(str(err), status=400)
 
-        if added_items.get(item_id, 0) + 1 > item_to_be_added["stock"]:  # item_to_be_added["stock"] <= 0 |
-            order_lock.release()
-            return Response(f"There is no more available stock for this item {item_id}", status=400)
+    item_to_be_added = json.loads(response.content)
+    item_prices.put(item_id, item_to_be_added["price"])
+    if item_to_be_added["stock"] <= 0:
+        sold_out_items.mark(item_id, item_to_be_added["stock"])
 
-        # Increase the field of item_id with 1 or add a new field
-        added_items[item_id] = added_items.get(item_id, 0) + 1
+    # Increase the quantity of the item and the total cost of the order in one atomic script
+    try:
+        result = run_cart_script(add_item_script, order_id,
+                                 [f"{ITEM_FIELD_PREFIX}{item_id}", item_to_be_added["price"],
+                                  item_to_be_added["stock"], f"{PRICE_FIELD_PREFIX}{item_id}"],
+                                 db)
+    except Exception as err:
+        return Response(str(err), status=400)
 
-        # Add the item and update the total cost of the order in DB
-        try:
-            serialized_transaction = db.pipeline()
-            serialized_transaction.hset(order_id, "items", json.dumps(added_items))  # overwrites the previous entry
-            serialized_transaction.hincrby(order_id, "total_cost", 1 * item_to_be_added["price"])  # increase the total cost
-            results = serialized_transaction.execute()
-        except Exception as err:
-            order_lock.release()
-            return Response(str(err), status=400)
+    if result[0] != SCRIPT_OK:
+        return script_error_response(result, order_id, item_id)
 
-        # new_cost = order["total_cost"] + item_to_be_added["price"] # can be removed later, now for debug purpose
-        order_lock.release()
-        
-        return Response(f"A new item {item_id} is added to order {order_id}, total cost becomes {results[1]}", status=200)
-    else:
-        return Response(f"The order {order_id} is locked, try later", status=400)
+    return Response(f"A new item {item_id} is added to order {order_id}, total cost becomes {result[1]}", status=200)
 
 
 @app.delete('/removeItem/<order_id>/<item_id>')
@@ -295,91 +305,152 @@ def remove_item(order_id, item_id):
     :return: A success response if the operation is successful, an error otherwise.
     """
     db = get_db(order_id)
-    # Lock the order
-    order_lock = Redlock(key=order_id, masters={db}, auto_release_time=LOCK_AUTORELEASE_TIME)
-
-    if order_lock.acquire():
-        # Get the order
-        order = db.hgetall(order_id)
-
-        # Check if the order exists
-        if not order:
-            order_lock.release()
-            return Response(f"The order {order_id} does not exist in the DB!", status=404)
+    fields = [f"{ITEM_FIELD_PREFIX}{item_id}", f"{PRICE_FIELD_PREFIX}{item_id}"]
 
-        # Convert bytes to proper types
-        order = convert_order(order)
-
-        # Check if the order is paid
-        if order["paid"]:
-            order_lock.release()
-            return Response(f"The order {order_id} is already paid!", status=400)
-
-        # Check if the item exists in the order
-        items = order["items"]
-        if not items.get(item_id):
-            order_lock.release()
-            return Response(f"The item {item_id} does not exist in order {order_id}", status=404)
-
-        # Decrease the number of items by 1 or delete the item
-        if items[item_id] > 1:
-            items[item_id] -= 1
-        else:
-            del items[item_id]
-
-        # Get the item from the stock to check the price
-        find_item = f"{STOCK_SERVICE_URL}/find/{item_id}"
-        try:
-            response = requests.get(find_item)
-            if response.status_code != 200:
-                order_lock.release()
-                return Response(response.content, status=response.status_code)
-        except Exception as err:
-            order_lock.release()
-            return Response(str(err), status=404)
+    # Decrease the quantity of the item, or delete it, and the total cost of the order by the unit price stored with
+    # the item in one atomic script
+    try:
+        result = run_cart_script(remove_item_script, order_id, [*fields, ""], db)
+    except Exception as err:
+        return Response(str(err), status=400)
 
-        item = response.json()
+    if result[0] == SCRIPT_PRICE_UNKNOWN:
+        # The item was added without its unit price, get it from the cache, or from the stock if it is not cached yet
+        price = item_prices.get(item_id)
+        if price is None:
+            find_item = f"/find/{item_id}"
+            try:
+                response = stock_service.get(find_item)
+                if response.status_code != 200:
+                    return Response(response.content, status=response.status_code)
+            except Exception as err:
+                return Response(str(err), status=404)
+
+            price = response.json()["price"]
+            item_prices.put(item_id, price)
 
-        # Update the order and the total cost of the order
         try:
-            serialized_transaction = db.pipeline()
-            serialized_transaction.hset(order_id, "items", json.dumps(items))
-            serialized_transaction.hincrby(order_id, "total_cost", -1 * item["price"])
-            result = serialized_transaction.execute()
+            result = run_cart_script(remove_item_script, order_id, [*fields, price], db)
         except Exception as err:
-            order_lock.release()
             return Response(str(err), status=400)
 
-        # Release the lock
-        order_lock.release()
+    if result[0] != SCRIPT_OK:
+        return script_error_response(result, order_id, item_id)
 
-        # Return success response
-        return Response(
-            f"The item {item_id} is removed from order {order_id} successfully! Total cost becomes {result[1]}.",
-            status=200)
-    else:
-        return Response(f"The order {order_id} is locked, try later", status=400)
+    # Return success response
+    return Response(
+        f"The item {item_id} is removed from order {order_id} successfully! Total cost becomes {result[1]}.",
+        status=200)
 
 
 @app.post('/checkout/<order_id>')
 def checkout(order_id):
     """
     Checks out the given order.
+    With ASYNC_CHECKOUT the order is only validated and queued, the result is retrieved with /checkout_status.
+    With CHECKOUT_COALESCING a request for an order whose checkout is running returns the outcome of that checkout.
 
     :param order_id: The id of the order to be checked out.
-    :return: The status of the order - success/failure or an error, otherwise.
+    :return: The status of the order - success/failure or an error, otherwise. The ticket of the queued checkout
+    with status 202 in the asynchronous mode.
     """
-    db = get_db(order_id)
-    # Lock the order
-    order_lock = Redlock(key=order_id, masters={db}, auto_release_time=LOCK_AUTORELEASE_TIME)
+    if not ASYNC_CHECKOUT:
+        if CHECKOUT_COALESCING:
+            return coalesce_checkout(order_id, checkout_order)
+        return checkout_order(order_id)
 
-    if order_lock.acquire():
-        # Get the order
+    status_key = checkout_status_key(order_id)
+    db = get_db(order_id, status_key)
+
+    # Validate the order without locking it, the checkout worker checks it again holding the lock
+    try:
         order = db.hgetall(order_id)
+    except Exception as err:
+        return Response(str(err), status=400)
+
+    if not order:
+        return Response(f"The order {order_id} does not exist in the DB!", status=404)
+
+    order = convert_order(order)
+    if order["paid"]:
+        return Response(f"The order {order_id} is already paid!", status=400)
+    if not order["items"]:
+        return Response(f"The order {order_id} is empty!", status=400)
+    sold_out = sold_out_items.unavailable(order["items"])
+    if sold_out is not None:
+        return Response(f"Checkout was unsuccessful! The item {sold_out} is sold out", status=400)
+
+    # Queue the checkout, unless the order has a checkout queued or running already
+    try:
+        result = enqueue_checkout_script(keys=[order_id, status_key, CHECKOUT_STREAM], client=db)
+    except Exception as err:
+        return Response(str(err), status=400)
+
+    return_checkout = {
+        "order_id": order_id,
+        "ticket": result[1].decode("utf-8"),
+        "status": CHECKOUT_QUEUED
+    }
+    return Response(json.dumps(return_checkout), mimetype="application/json", status=202)
+
+
+@app.get('/checkout_status/<order_id>')
+def checkout_status(order_id):
+    """
+    Retrieve the status of the last asynchronous checkout of the given order.
+
+    :param order_id: The id of the order.
+    :return: The ticket, the status (queued, processing, succeeded or failed) and the message of the checkout,
+    an error if the order has not been queued for checkout.
+    """
+    status_key = checkout_status_key(order_id)
+    try:
+        checkout_record = get_read_db(status_key).hgetall(status_key)
+    except Exception as err:
+        return Response(str(err), status=400)
+
+    if not checkout_record:
+        return Response(f"There isn't any checkout of order {order_id} in the DB!", status=404)
+
+    return_checkout = {
+        "order_id": order_id,
+        "ticket": checkout_record[b"ticket"].decode("utf-8"),
+        "status": checkout_record[b"status"].decode("utf-8"),
+        "message": checkout_record[b"message"].decode("utf-8")
+    }
+    return Response(json.dumps(return_checkout), mimetype="application/json", status=200)
+
+
+def checkout_order(order_id):
+    """
+    Check out the given order holding its lock, running the checkout saga.
+
+    :param order_id: The id of the order to be checked out.
+    :return: The status of the order - success/failure or an error, otherwise.
+    """
+    db = get_db(order_id, saga_key(order_id))
+    # Lock the order, fencing its saga record, it is released when the block exits
+    order_lock = LeaseLock(order_id, db, saga_key(order_id))
+
+    with locked(order_lock) as acquired:
+        if not acquired:
+            return Response(f"The order {order_id} is locked, try later", status=400)
+
+        # Get the order and the state of its last saga
+        serialized_transaction = db.pipeline(transaction=False)
+        serialized_transaction.hgetall(order_id)
+        serialized_transaction.hget(saga_key(order_id), "state")
+        order, saga_state = serialized_transaction.execute()
+
+        # Finish the saga of a previous checkout that did not complete first, it may pay the order
+        if is_pending(saga_state):
+            if not recover_saga(order_id, db, order_lock.fencing_token):
+                return Response(f"The previous checkout of order {order_id} is not finished yet, try later",
+                                status=400)
+            order = db.hgetall(order_id)
 
         # Check if the order exists
         if not order:
-            order_lock.release()
             return Response(f"The order {order_id} does not exist in the DB!", status=404)
 
         # Convert bytes to proper types
@@ -387,32 +458,184 @@ def checkout(order_id):
 
         # Check if the order is paid
         if order["paid"]:
-            order_lock.release()
             return Response(f"The order {order_id} is already paid!", status=400)
 
         # Check if the order is empty
         if not order["items"]:
-            order_lock.release()
             return Response(f"The order {order_id} is empty!", status=400)
 
+        # Fail fast if one of the items ran out of stock recently, without running the saga
+        sold_out = sold_out_items.unavailable(order["items"])
+        if sold_out is not None:
+            return Response(f"Checkout was unsuccessful! The item {sold_out} is sold out", status=400)
+
+        # Fail fast if a step likely to fail would fail, with read-only requests
+        failure = precheck_order(order)
+        if failure is not None:
+            return Response("Checkout was unsuccessful! " + failure, status=400)
+
+        # Persist the progress of the checkout, so it is recovered if this worker dies
+        saga = SagaLog(order_id, db, order_lock.fencing_token)
+        # Run first the independent step that is the cheapest to fail
+        debit = DebitCustomerBalance(order["user_id"], order_id, order["total_cost"], saga)
+        steps = plan_steps({STOCK_STEP: RetrieveStock(order["items"], saga), PAYMENT_STEP: debit})
         try:
+            saga.start(order, payment_first=steps[0] is debit)
             run_transaction(
-                steps=[
-                    RetrieveStock(order["items"]),
-                    DebitCustomerBalance(order["user_id"], order_id, order["total_cost"]),
-                    UpdateOrder(order_id, db)
-                ],
+                steps=steps + [UpdateOrder(order_id, db, saga)],
                 starting_state={}
             )
         except Exception as err:
-            # Release the lock
-            order_lock.release()
+            # The failed step may have been applied anyway, e.g. after a timeout, so the whole attempt is aborted,
+            # once here and then by the compensation workers if it fails. Until then the saga stays pending, so it is
+            # never lost.
+            if saga.txn_id is not None and not saga.fenced:
+                try:
+                    if not abort_saga(saga, order["user_id"], order["items"]) and compensation_workers:
+                        enqueue_compensation(order_id, db)
+                except Exception as compensation_err:
+                    # The saga is still pending, it is aborted by the saga recovery
+                    print(f"Failed to compensate the checkout of order {order_id}: {compensation_err}")
             return Response("Checkout was unsuccessful! " + str(err), status=400)
 
-        # Release the lock
-        order_lock.release()
-
         # Return success response
         return Response(f"The order {order_id} is paid successfully.", status=200)
-    else:
-        return Response(f"The order {order_id} is locked, try later", status=400)
+
+
+def recover_sagas():
+    """
+    Recover the unfinished checkout sagas of all the shards, abandoned for longer than SAGA_RECOVERY_GRACE.
+    Each saga is recovered holding the lock of its order, so it never runs concurrently with its checkout.
+    """
+    abandoned = time.time() - SAGA_RECOVERY_GRACE
+    for shard in db_shards:
+        for order_id in shard.zrangebyscore(PENDING_SAGAS, "-inf", abandoned):
+            order_id = order_id.decode("utf-8")
+            db = get_db(order_id, saga_key(order_id))
+            order_lock = LeaseLock(order_id, db, saga_key(order_id))
+            with locked(order_lock, blocking=False) as acquired:
+                if not acquired:
+                    continue
+
+                try:
+                    if recover_saga(order_id, db, order_lock.fencing_token) and db is not shard:
+                        # The saga has been moved to its new shard by a migration
+                        shard.zrem(PENDING_SAGAS, order_id)
+                except Exception as err:
+                    print(f"Failed to recover the saga of order {order_id}: {err}")
+
+
+def compensate_checkout(order_id: str) -> bool:
+    """
+    Abort the saga of a failed checkout holding the lock of its order, for the compensation workers.
+
+    :param order_id: The id of the order.
+    :return: True if the saga is finished, False if it has to be retried later.
+    """
+    db = get_db(order_id, saga_key(order_id))
+    order_lock = LeaseLock(order_id, db, saga_key(order_id))
+    with locked(order_lock) as acquired:
+        if not acquired:
+            return False
+
+        return recover_saga(order_id, db, order_lock.fencing_token)
+
+
+def run_saga_recovery():
+    """
+    Recover the unfinished checkout sagas on startup and then every SAGA_RECOVERY_INTERVAL seconds.
+    """
+    while True:
+        try:
+            recover_sagas()
+        except Exception as err:
+            print(f"Failed to recover the sagas: {err}")
+        time.sleep(SAGA_RECOVERY_INTERVAL)
+
+
+@app.get('/metrics/http_client')
+def http_client_metrics():
+    """
+    Retrieve the metrics of the pooled HTTP clients used to call the other services.
+
+    :return: The in-flight requests, the pool saturation and the errors of each client.
+    """
+    return_metrics = {
+        "stock": stock_service.stats(),
+        "payment": payment_service.stats(),
+    }
+
+    return Response(json.dumps(return_metrics), mimetype="application/json", status=200)
+
+
+@app.get('/metrics/price_cache')
+def price_cache_metrics():
+    """
+    Retrieve the metrics of the item price cache.
+
+    :return: The size, the hits, the misses and the evictions of the cache.
+    """
+    return Response(json.dumps(item_prices.stats()), mimetype="application/json", status=200)
+
+
+@app.get('/metrics/sold_out_cache')
+def sold_out_cache_metrics():
+    """
+    Retrieve the metrics of the cache of the sold out items.
+
+    :return: The size, the hits, the misses, the rejected requests and the invalidations of the cache.
+    """
+    return Response(json.dumps(sold_out_items.stats()), mimetype="application/json", status=200)
+
+
+@app.get('/metrics/saga')
+def saga_metrics():
+    """
+    Retrieve the statistics of the steps of the checkout saga.
+
+    :return: The failure rate, latency, executions, prechecks and compensations of each step, and their order.
+    """
+    return Response(json.dumps(saga_stats()), mimetype="application/json", status=200)
+
+
+@app.get('/metrics/checkout_coalescing')
+def checkout_coalescing_metrics():
+    """
+    Retrieve the metrics of the coalescing of the duplicate checkouts.
+
+    :return: The checkouts running in this process and the duplicates attached to a running or succeeded checkout.
+    """
+    return Response(json.dumps(in_flight_checkouts.stats()), mimetype="application/json", status=200)
+
+
+@app.get('/metrics/compensations')
+def compensation_metrics():
+    """
+    Retrieve the depth of the compensation outboxes.
+
+    :return: The compensations waiting in the outbox of every shard, their total and the ones due now.
+    """
+    return Response(json.dumps(outbox_depth()), mimetype="application/json", status=200)
+
+
+@app.get('/locks')
+def list_locks():
+    """
+    List the locks currently held in the DB of the service, by any process.
+
+    :return: The held locks with their holder, route, age in seconds and callsite, the oldest first.
+    """
+    return Response(json.dumps(held_locks()), mimetype="application/json", status=200)
+
+
+# Compensate the failed checkouts in this process
+compensation_workers = start_compensation_workers(compensate_checkout) if COMPENSATION_WORKERS > 0 else []
+
+# Run the queued checkouts in this process
+checkout_workers = start_workers(checkout_order) if ASYNC_CHECKOUT and CHECKOUT_WORKERS > 0 else []
+
+# Forget the sold out items as soon as they are restocked
+subscribe(STOCK_RESTOCKED, lambda message: sold_out_items.invalidate(*json.loads(message)))
+
+if SAGA_RECOVERY_INTERVAL > 0:
+    threading.Thread(target=run_saga_recovery, daemon=True).start()
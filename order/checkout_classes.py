@@ -1,65 +1,86 @@
-import os
-import requests
 import json
 from talepy.steps import Step
 
-PAYMENT_SERVICE_URL = os.environ['USER_SERVICE_URL']
-STOCK_SERVICE_URL = os.environ['STOCK_SERVICE_URL']
+from compensations import return_back_added_items, return_back_money
+from item_cache import sold_out_items
+from service_client import payment_service, stock_service
+from saga_log import SAGA_COMPLETED, SAGA_PAID, SAGA_STOCK_RETRIEVED
+from saga_planner import PAYMENT_STEP, STOCK_STEP, needs_precheck, observed, step_stats
 
 
 class DebitCustomerBalance(Step):
 
-    def __init__(self, user_id, order_id, total_cost):
+    def __init__(self, user_id, order_id, total_cost, saga):
         self.user_id = user_id
         self.order_id = order_id
         self.total_cost = total_cost
+        self.saga = saga
 
+    @observed(PAYMENT_STEP)
     def execute(self, state):
-        pay_order = f"{PAYMENT_SERVICE_URL}/pay/{self.user_id}/{self.order_id}/{self.total_cost}"
-        response = requests.post(pay_order)
+        # The payment is done once for the transaction of the checkout attempt, and never after its cancellation
+        pay_order = f"/pay/{self.user_id}/{self.order_id}/{self.total_cost}/{self.saga.txn_id}"
+        response = payment_service.post(pay_order)
         if response.status_code != 200:
             raise Exception(f"Failed payment for {self.order_id}! " + str(response.text))
+        self.saga.record(SAGA_PAID)
         print("Debit customer execution performed")
         return state
 
     def compensate(self, state):
+        # Best effort, the failures are only logged and the attempt is aborted again after the saga
+        # The saga has been taken over, its new owner compensates it
+        if self.saga.fenced:
+            return
         print("Debit customer compensation performed")
-        return_back_money(self.user_id, self.order_id)
+        step_stats[PAYMENT_STEP].compensated()
+        return_back_money(self.user_id, self.order_id, self.saga.txn_id)
 
 
 class RetrieveStock(Step):
 
-    def __init__(self, requested_items):
+    def __init__(self, requested_items, saga):
         self.added_items = {}
         self.requested_items = requested_items
+        self.saga = saga
 
+    @observed(STOCK_STEP)
     def execute(self, state):
-        for item_id, amount in self.requested_items.items():
-            remove_stock = f"{STOCK_SERVICE_URL}/subtract/{item_id}/{amount}"
-            response = requests.post(remove_stock)
+        # Reserve all the items of the order at once, the stock service applies all of them or none,
+        # and only once for the transaction of the checkout attempt
+        response = stock_service.post(f"/subtract_batch/{self.saga.txn_id}", json=self.requested_items)
 
-            if response.status_code != 200:
-                self.compensate(state)
-                raise Exception(f"Failed to add an item {item_id}! " + str(response.text))
+        if response.status_code != 200:
+            if response.status_code == 400:
+                remember_sold_out(self.requested_items)
+            raise Exception(f"Failed to retrieve the items {list(self.requested_items)}! " + str(response.text))
 
-            self.added_items[item_id] = amount
+        self.added_items = dict(self.requested_items)
+        self.saga.record(SAGA_STOCK_RETRIEVED)
         print("Retrieve stock execution performed")
         return state
 
     def compensate(self, state):
+        # Best effort, the failures are only logged and the attempt is aborted again after the saga
+        # The saga has been taken over, its new owner compensates it
+        if self.saga.fenced:
+            return
         print("Retrieve stock compensation performed")
-        return_back_added_items(self.added_items)
+        step_stats[STOCK_STEP].compensated()
+        return_back_added_items(self.added_items, self.saga.txn_id)
 
 
 class UpdateOrder(Step):
 
-    def __init__(self, order_id, db):
+    def __init__(self, order_id, db, saga):
         self.order_id = order_id
         self.db = db
+        self.saga = saga
 
     def execute(self, state):
         print("Update order execution performed")
-        self.db.hset(self.order_id, "paid", json.dumps(True))
+        # The order is paid together with the end of the saga
+        self.saga.finish(SAGA_COMPLETED, paid=True)
         return state
 
     def compensate(self, state):
@@ -67,25 +88,67 @@ class UpdateOrder(Step):
         self.db.hset(self.order_id, "paid", json.dumps(False))
 
 
-def return_back_added_items(add_items) -> str:
-    for item_id, amount in add_items.items():
-        add_back_stock = f"{STOCK_SERVICE_URL}/add/{item_id}/{amount}"
-        try:
-            response = requests.post(add_back_stock)
-            if response.status_code != 200:
-                return f"Error when returning one of the items {item_id}! " + str(response.text)
-        except Exception as err:
-            return "Error when returning items" + str(err)
+def remember_sold_out(requested_items):
+    """
+    Read the stock of the items of a failed retrieval and remember the ones without enough stock, so the next
+    checkouts of these items fail without running the saga.
+
+    :param requested_items: The dictionary of item_id -> requested amount.
+    :return: The first item without enough stock, None if all the items have enough or the stock could not be read.
+    """
+    try:
+        response = stock_service.post("/find_batch", json=list(requested_items))
+        if response.status_code != 200:
+            return None
+    except Exception:
+        return None
+
+    sold_out = None
+    for item_id, item in response.json().items():
+        if item["stock"] < requested_items[item_id]:
+            sold_out_items.mark(item_id, item["stock"])
+            sold_out = sold_out or item_id
+
+    return sold_out
 
-    return "Items were successfully returned!"
 
+def has_enough_credit(user_id, total_cost) -> bool:
+    """
+    Read the credit of a user, without locking it, and compare it with the cost of an order.
 
-def return_back_money(user_id, order_id) -> str:
-    cancel_order = f"{PAYMENT_SERVICE_URL}/cancel/{user_id}/{order_id}"
+    :param user_id: The id of the user.
+    :param total_cost: The total cost of the order.
+    :return: False if the user has not enough credit, True if it has or the credit could not be read.
+    """
     try:
-        response = requests.post(cancel_order)
+        response = payment_service.post("/find_batch", json=[user_id])
         if response.status_code != 200:
-            return "Cancellation of payment was not successful because " + str(response.text)
-    except Exception as err:
-        return "Cancellation of payment was not successful " + str(err)
-    return "Money were successfully returned!"
+            return True
+    except Exception:
+        return True
+
+    user = response.json().get(user_id)
+    return user is None or user["credit"] >= total_cost
+
+
+def precheck_order(order):
+    """
+    Check with read-only requests the steps of the checkout of an order that are likely to fail.
+    The checks are only hints, a checkout that passes them can still fail in its steps. Only the failed checks are
+    accounted for in the statistics of the steps, the passed ones are followed by the execution of the step.
+
+    :param order: The converted order.
+    :return: The reason why the checkout would fail, None if it may succeed.
+    """
+    if needs_precheck(STOCK_STEP):
+        sold_out = remember_sold_out(order["items"])
+        if sold_out is not None:
+            step_stats[STOCK_STEP].observe(True)
+            return f"The item {sold_out} is sold out"
+
+    if needs_precheck(PAYMENT_STEP):
+        if not has_enough_credit(order["user_id"], order["total_cost"]):
+            step_stats[PAYMENT_STEP].observe(True)
+            return f"The user {order['user_id']} does not have enough credit"
+
+    return None
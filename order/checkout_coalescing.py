@@ -0,0 +1,243 @@
+"""
+Coalescing of the duplicate synchronous checkouts of an order.
+A client, or the gateway retrying on a timeout, can send the checkout of an order again while the first request is
+still running, and the duplicate would fail with "locked, try later". With CHECKOUT_COALESCING the duplicates wait
+for the running checkout and return its outcome instead:
+- in a process, the requests of an order attach to the one running its checkout;
+- across the replicas, the running checkout is claimed in the record order:<number>:checkout_result, in the same shard
+  as the order, where its result is stored for CHECKOUT_RESULT_TTL and polled by the duplicates. The claim is renewed
+  while the checkout runs, so it expires only if its process dies.
+
+A checkout that succeeded is returned to the later requests too, while the record lasts, and a failed one runs again,
+since the order may have changed meanwhile.
+"""
+import os
+import threading
+import time
+import uuid
+
+from flask import Response
+
+from scripts import CLAIM_CHECKOUT, FINISH_CHECKOUT, RENEW_CHECKOUT
+from sharding import db_shards, get_db
+
+# Attach the duplicate checkouts of an order to the one running already
+CHECKOUT_COALESCING = os.environ.get('CHECKOUT_COALESCING', 'False') == 'True'
+# Seconds the claim of a running checkout is kept after its last renewal, and its result is kept, a duplicate waits
+# for the result up to this long before checking the claim again
+CHECKOUT_RESULT_TTL = float(os.environ.get('CHECKOUT_RESULT_TTL', 30))
+# Seconds between two reads of the result of a checkout running in another process
+CHECKOUT_POLL_INTERVAL = 0.02
+# Seconds between two renewals of the claims of the running checkouts
+CHECKOUT_RENEW_INTERVAL = CHECKOUT_RESULT_TTL / 3
+
+CHECKOUT_RUNNING = "running"
+
+# Register the scripts, they are executed with EVALSHA on the shard passed as client
+claim_checkout_script = db_shards[0].register_script(CLAIM_CHECKOUT)
+finish_checkout_script = db_shards[0].register_script(FINISH_CHECKOUT)
+renew_checkout_script = db_shards[0].register_script(RENEW_CHECKOUT)
+
+
+def checkout_result_key(order_id: str) -> str:
+    """
+    Retrieve the key of the result of the last synchronous checkout of an order, stored in the same shard as the order.
+
+    :param order_id: The id of the order.
+    :return: The checkout result key.
+    """
+    return f"{order_id}:checkout_result"
+
+
+class InFlightCheckouts:
+    """
+    The checkouts running in the process, with the duplicate requests waiting for them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = {}
+        self.local_duplicates = 0
+        self.remote_duplicates = 0
+        self.reused_results = 0
+
+    def join(self, order_id: str):
+        """
+        Attach a request to the running checkout of an order, or register it as the one running it.
+
+        :param order_id: The id of the order.
+        :return: The slot of the checkout, its "event" is set when the "result" is available, and True if the request
+        has to run the checkout.
+        """
+        with self.lock:
+            slot = self.running.get(order_id)
+            if slot is not None:
+                self.local_duplicates += 1
+                return slot, False
+
+            slot = {"event": threading.Event(), "result": None}
+            self.running[order_id] = slot
+            return slot, True
+
+    def finish(self, order_id: str, slot: dict, result):
+        """
+        Hand the result of a checkout to its duplicates.
+
+        :param order_id: The id of the order.
+        :param slot: The slot of the checkout.
+        :param result: The status and the message of the checkout.
+        """
+        with self.lock:
+            self.running.pop(order_id, None)
+        slot["result"] = result
+        slot["event"].set()
+
+    def count(self, counter: str):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "running": len(self.running),
+                "local_duplicates": self.local_duplicates,
+                "remote_duplicates": self.remote_duplicates,
+                "reused_results": self.reused_results,
+            }
+
+
+in_flight_checkouts = InFlightCheckouts()
+
+
+class ClaimWatchdog:
+    """
+    Renews the claims of the checkouts running in the process, the thread starts with the first claim.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.claims = {}
+        self.thread = None
+
+    def watch(self, key: str, db, attempt: str):
+        with self.lock:
+            self.claims[key] = (db, attempt)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def unwatch(self, key: str):
+        with self.lock:
+            self.claims.pop(key, None)
+
+    def run(self):
+        ttl = int(CHECKOUT_RESULT_TTL * 1000)
+        while True:
+            time.sleep(CHECKOUT_RENEW_INTERVAL)
+            with self.lock:
+                claims = list(self.claims.items())
+            for key, (db, attempt) in claims:
+                try:
+                    if not renew_checkout_script(keys=[key], args=[attempt, ttl], client=db):
+                        print(f"The claim of the checkout {key} has expired")
+                        self.unwatch(key)
+                except Exception as err:
+                    print(f"Failed to renew the claim of the checkout {key}: {err}")
+
+
+claim_watchdog = ClaimWatchdog()
+
+
+def wait_for_result(db, key: str, attempt: bytes):
+    """
+    Wait for the result of a checkout running in another process.
+
+    :param db: The db connection of the order.
+    :param key: The checkout result key of the order.
+    :param attempt: The id of the running attempt.
+    :return: The status and the message of the checkout, None if it is gone, e.g. its process died.
+    """
+    deadline = time.monotonic() + CHECKOUT_RESULT_TTL
+    while time.monotonic() < deadline:
+        time.sleep(CHECKOUT_POLL_INTERVAL)
+        current_attempt, status, message = db.hmget(key, "attempt", "status", "message")
+        if current_attempt != attempt:
+            return None
+        if status != CHECKOUT_RUNNING.encode("utf-8"):
+            return int(status), message.decode("utf-8")
+
+    return None
+
+
+def run_claimed(order_id: str, run_checkout):
+    """
+    Run the checkout of an order, unless it is running or has succeeded in another process.
+
+    :param order_id: The id of the order.
+    :param run_checkout: The function that checks out an order and returns the response.
+    :return: The status and the message of the checkout.
+    """
+    key = checkout_result_key(order_id)
+    db = get_db(order_id, key)
+    ttl = int(CHECKOUT_RESULT_TTL * 1000)
+
+    while True:
+        attempt = uuid.uuid4().hex
+        current = claim_checkout_script(keys=[key], args=[attempt, ttl], client=db)
+        if not current:
+            break
+
+        current_attempt, status, message = current
+        if status != CHECKOUT_RUNNING.encode("utf-8"):
+            in_flight_checkouts.count("reused_results")
+            return int(status), message.decode("utf-8")
+
+        in_flight_checkouts.count("remote_duplicates")
+        result = wait_for_result(db, key, current_attempt)
+        if result is not None:
+            return result
+        # The running checkout is gone, claim it again
+
+    # Keep the claim while the checkout runs, however long it takes
+    claim_watchdog.watch(key, db, attempt)
+    try:
+        response = run_checkout(order_id)
+        result = response.status_code, response.get_data(as_text=True)
+    except Exception as err:
+        result = 400, "Checkout was unsuccessful! " + str(err)
+    finally:
+        claim_watchdog.unwatch(key)
+
+    try:
+        finish_checkout_script(keys=[key], args=[attempt, result[0], result[1], ttl], client=db)
+    except Exception as err:
+        # The claim expires, the duplicates run the checkout again
+        print(f"Failed to store the result of the checkout of order {order_id}: {err}")
+    return result
+
+
+def coalesce_checkout(order_id: str, run_checkout) -> Response:
+    """
+    Check out an order, attaching the request to the running checkout of the order if any.
+
+    :param order_id: The id of the order.
+    :param run_checkout: The function that checks out an order and returns the response.
+    :return: The response of the checkout.
+    """
+    slot, leader = in_flight_checkouts.join(order_id)
+    if not leader:
+        if not slot["event"].wait(CHECKOUT_RESULT_TTL):
+            return Response(f"The checkout of order {order_id} is still running, try later", status=400)
+        status, message = slot["result"]
+        return Response(message, status=status)
+
+    result = 400, f"The checkout of order {order_id} failed, try later"
+    try:
+        result = run_claimed(order_id, run_checkout)
+    except Exception as err:
+        result = 400, "Checkout was unsuccessful! " + str(err)
+    finally:
+        in_flight_checkouts.finish(order_id, slot, result)
+
+    status, message = result
+    return Response(message, status=status)
@@ -0,0 +1,145 @@
+"""
+Workers of the asynchronous checkouts.
+With ASYNC_CHECKOUT the checkout endpoint only validates the order and appends it to the checkout stream of its shard,
+the workers read the stream with a consumer group, run the saga of each checkout and store its result in the
+checkout status record order:<number>:checkout, in the same shard as the order.
+
+The workers run as threads of the order service, CHECKOUT_WORKERS per shard, or as a separate process with
+    python checkout_worker.py
+to size them independently of the web workers, setting CHECKOUT_WORKERS=0 for the web workers.
+"""
+import os
+import socket
+import threading
+import time
+
+import redis
+
+from sharding import db_shards, get_db
+
+# Number of worker threads per shard started by the order service, 0 to run the workers only as separate processes
+CHECKOUT_WORKERS = int(os.environ.get('CHECKOUT_WORKERS', 1))
+# Milliseconds a worker waits for new checkouts before looking for abandoned ones
+CHECKOUT_BLOCK_TIME = int(os.environ.get('CHECKOUT_BLOCK_TIME', 1000))
+# Milliseconds after which a checkout read by a worker that did not acknowledge it is claimed by another worker
+CHECKOUT_CLAIM_IDLE = int(os.environ.get('CHECKOUT_CLAIM_IDLE', 60000))
+
+CHECKOUT_STREAM = "checkouts"
+CHECKOUT_GROUP = "checkout-workers"
+
+CHECKOUT_QUEUED = "queued"
+CHECKOUT_PROCESSING = "processing"
+CHECKOUT_SUCCEEDED = "succeeded"
+CHECKOUT_FAILED = "failed"
+
+
+def checkout_status_key(order_id: str) -> str:
+    """
+    Retrieve the key of the checkout status record of an order, stored in the same shard as the order.
+
+    :param order_id: The id of the order.
+    :return: The checkout status key.
+    """
+    return f"{order_id}:checkout"
+
+
+def create_group(db):
+    """
+    Create the consumer group of the checkout stream of a shard, if it does not exist yet.
+
+    :param db: The db connection of the shard.
+    """
+    try:
+        db.xgroup_create(CHECKOUT_STREAM, CHECKOUT_GROUP, id="0", mkstream=True)
+    except redis.exceptions.ResponseError as err:
+        if "BUSYGROUP" not in str(err):
+            raise
+
+
+def process_checkout(db, ticket, fields, run_checkout):
+    """
+    Run a checkout read from the stream, store its result and acknowledge it.
+
+    :param db: The db connection of the shard of the stream.
+    :param ticket: The id of the stream entry.
+    :param fields: The fields of the stream entry.
+    :param run_checkout: The function that checks out an order and returns the response.
+    """
+    order_id = fields[b"order_id"].decode("utf-8")
+    status_key = checkout_status_key(order_id)
+    order_db = get_db(order_id, status_key)
+    order_db.hset(status_key, "status", CHECKOUT_PROCESSING)
+
+    try:
+        response = run_checkout(order_id)
+        status = CHECKOUT_SUCCEEDED if response.status_code == 200 else CHECKOUT_FAILED
+        message = response.get_data(as_text=True)
+    except Exception as err:
+        status = CHECKOUT_FAILED
+        message = "Checkout was unsuccessful! " + str(err)
+
+    order_db.hset(status_key, mapping={"status": status, "message": message})
+
+    serialized_transaction = db.pipeline()
+    serialized_transaction.xack(CHECKOUT_STREAM, CHECKOUT_GROUP, ticket)
+    serialized_transaction.xdel(CHECKOUT_STREAM, ticket)
+    serialized_transaction.execute()
+
+
+def run_worker(db, consumer: str, run_checkout):
+    """
+    Process the checkouts of the stream of a shard forever.
+    The checkouts of a worker that died before acknowledging them are claimed after CHECKOUT_CLAIM_IDLE, they are
+    safe to run again because the saga of an unfinished checkout is recovered before the order is checked out.
+
+    :param db: The db connection of the shard.
+    :param consumer: The name of the worker in the consumer group.
+    :param run_checkout: The function that checks out an order and returns the response.
+    """
+    create_group(db)
+    while True:
+        try:
+            # Claim the abandoned checkouts first, then wait for new ones
+            _, entries, *_ = db.xautoclaim(CHECKOUT_STREAM, CHECKOUT_GROUP, consumer,
+                                           min_idle_time=CHECKOUT_CLAIM_IDLE, count=10)
+            if not entries:
+                streams = db.xreadgroup(CHECKOUT_GROUP, consumer, {CHECKOUT_STREAM: ">"},
+                                        count=10, block=CHECKOUT_BLOCK_TIME)
+                entries = streams[0][1] if streams else []
+
+            for ticket, fields in entries:
+                if fields:
+                    process_checkout(db, ticket, fields, run_checkout)
+                else:
+                    # The entry has been deleted after it was read, only its acknowledgement is missing
+                    db.xack(CHECKOUT_STREAM, CHECKOUT_GROUP, ticket)
+        except Exception as err:
+            print(f"Checkout worker {consumer} failed: {err}")
+            time.sleep(1)
+
+
+def start_workers(run_checkout, workers: int = CHECKOUT_WORKERS) -> list:
+    """
+    Start the checkout worker threads, the given number for each shard.
+
+    :param run_checkout: The function that checks out an order and returns the response.
+    :param workers: The number of workers per shard.
+    :return: The started threads.
+    """
+    threads = []
+    for shard_idx, db in enumerate(db_shards):
+        for worker_idx in range(workers):
+            consumer = f"{socket.gethostname()}-{os.getpid()}-{shard_idx}-{worker_idx}"
+            thread = threading.Thread(target=run_worker, args=(db, consumer, run_checkout), daemon=True)
+            thread.start()
+            threads.append(thread)
+
+    return threads
+
+
+if __name__ == '__main__':
+    # Importing the app starts its CHECKOUT_WORKERS workers per shard, at least one per shard runs in this process
+    import app
+
+    for worker_thread in app.checkout_workers or start_workers(app.checkout_order, 1):
+        worker_thread.join()
@@ -0,0 +1,199 @@
+"""
+Compensations of the failed checkouts.
+The steps of a failed checkout are compensated once right away by the saga, as a best effort whose failures are only
+logged, then its attempt is aborted once before the checkout returns, so the client finds the compensations done and
+their locks released when it sends its next request. If the abort fails, the order is written to the outbox of its
+shard, the sorted set compensations:outbox scored by the time of its next attempt. The compensation workers abort the
+saga of every due order in the background: they repeat the compensations, which are idempotent, and reschedule the
+order with exponential backoff until its saga is finished, so a failed compensation is never lost and never retried on
+the request path. If the order cannot be written to the outbox, its saga stays in sagas:pending and is aborted by the
+saga recovery.
+
+The workers run as threads of the order service, COMPENSATION_WORKERS per process, with COMPENSATION_WORKERS=0 the
+sagas whose abort failed are left pending and finished by the saga recovery.
+"""
+import os
+import random
+import threading
+import time
+
+from item_cache import stock_returned
+from service_client import payment_service, stock_service
+from sharding import db_shards
+
+# Number of compensation worker threads per process, 0 to leave the failed aborts to the saga recovery
+COMPENSATION_WORKERS = int(os.environ.get('COMPENSATION_WORKERS', 1))
+# Seconds between two scans of the outboxes, a compensation added by the process wakes its workers right away
+COMPENSATION_POLL_INTERVAL = float(os.environ.get('COMPENSATION_POLL_INTERVAL', 1))
+# Seconds before the first retry of a failed compensation, doubled at every attempt
+COMPENSATION_BACKOFF_BASE = float(os.environ.get('COMPENSATION_BACKOFF_BASE', 0.1))
+# Maximum seconds between two retries of a compensation
+COMPENSATION_BACKOFF_MAX = float(os.environ.get('COMPENSATION_BACKOFF_MAX', 30))
+# Maximum due compensations taken from an outbox at every scan
+COMPENSATION_BATCH = 100
+
+COMPENSATION_OUTBOX = "compensations:outbox"
+# Hash of the failed attempts of each order in the outbox, one per shard
+COMPENSATION_ATTEMPTS = "compensations:attempts"
+
+# Set when a compensation is added by this process
+wakeup = threading.Event()
+
+
+def return_back_added_items(add_items, txn_id) -> bool:
+    """
+    Release the stock reserved by a checkout attempt.
+
+    :param add_items: The dictionary of item_id -> reserved amount.
+    :param txn_id: The transaction id of the attempt.
+    :return: True if the stock has been released.
+    """
+    if not add_items:
+        return True
+
+    try:
+        response = stock_service.post(f"/add_batch/{txn_id}", json=add_items)
+    except Exception as err:
+        print(f"Error when returning the items {list(add_items)}: {err}")
+        return False
+    if response.status_code != 200:
+        print(f"Error when returning the items {list(add_items)}: {response.text}")
+        return False
+
+    stock_returned(add_items)
+    return True
+
+
+def return_back_money(user_id, order_id, txn_id) -> bool:
+    """
+    Cancel the payment of a checkout attempt, a payment that is cancelled already or does not exist needs nothing.
+    The transaction is cancelled in any case, so a late payment of the attempt is ignored.
+
+    :param user_id: The id of the user of the order.
+    :param order_id: The id of the order.
+    :param txn_id: The transaction id of the attempt.
+    :return: True if the order is not paid by the attempt anymore.
+    """
+    try:
+        response = payment_service.post(f"/cancel/{user_id}/{order_id}/{txn_id}")
+    except Exception as err:
+        print(f"Cancellation of the payment of {order_id} was not successful: {err}")
+        return False
+    # The payment service answers 409 if the payment is cancelled already
+    if response.status_code in (200, 404, 409):
+        return True
+
+    print(f"Cancellation of the payment of {order_id} was not successful: {response.text}")
+    return False
+
+
+def enqueue_compensation(order_id: str, db):
+    """
+    Write the order of a failed checkout to the outbox of its shard, to be compensated right away.
+
+    :param order_id: The id of the order.
+    :param db: The db connection of the saga of the order.
+    """
+    serialized_transaction = db.pipeline()
+    serialized_transaction.zadd(COMPENSATION_OUTBOX, {order_id: time.time()})
+    serialized_transaction.hdel(COMPENSATION_ATTEMPTS, order_id)
+    serialized_transaction.execute()
+    wakeup.set()
+
+
+def reschedule_compensation(order_id: str, db):
+    """
+    Retry the compensation of an order later, with jittered exponential backoff.
+
+    :param order_id: The id of the order.
+    :param db: The db connection of the outbox of the order.
+    """
+    attempts = db.hincrby(COMPENSATION_ATTEMPTS, order_id, 1)
+    delay = min(COMPENSATION_BACKOFF_MAX, COMPENSATION_BACKOFF_BASE * 2 ** min(attempts - 1, 16))
+    db.zadd(COMPENSATION_OUTBOX, {order_id: time.time() + random.uniform(delay / 2, delay)}, xx=True)
+
+
+def complete_compensation(order_id: str, db):
+    """
+    Remove the order from the outbox.
+
+    :param order_id: The id of the order.
+    :param db: The db connection of the outbox of the order.
+    """
+    serialized_transaction = db.pipeline()
+    serialized_transaction.zrem(COMPENSATION_OUTBOX, order_id)
+    serialized_transaction.hdel(COMPENSATION_ATTEMPTS, order_id)
+    serialized_transaction.execute()
+
+
+def outbox_depth() -> dict:
+    """
+    Retrieve the number of compensations in the outboxes.
+
+    :return: The number of compensations of every shard, their total and the ones due now.
+    """
+    now = time.time()
+    shards = []
+    due = 0
+    for shard in db_shards:
+        serialized_transaction = shard.pipeline(transaction=False)
+        serialized_transaction.zcard(COMPENSATION_OUTBOX)
+        serialized_transaction.zcount(COMPENSATION_OUTBOX, "-inf", now)
+        shard_depth, shard_due = serialized_transaction.execute()
+        shards.append(shard_depth)
+        due += shard_due
+
+    return {
+        "depth": sum(shards),
+        "due": due,
+        "shards": shards,
+    }
+
+
+def run_compensations(compensate):
+    """
+    Compensate the due orders of all the outboxes forever.
+
+    :param compensate: The function that aborts the saga of an order and returns True if it is finished.
+    """
+    while True:
+        wakeup.wait(COMPENSATION_POLL_INTERVAL)
+        wakeup.clear()
+        for shard in db_shards:
+            try:
+                due = shard.zrangebyscore(COMPENSATION_OUTBOX, "-inf", time.time(), start=0, num=COMPENSATION_BATCH)
+            except Exception as err:
+                print(f"Failed to read the compensation outbox: {err}")
+                continue
+
+            for order_id in due:
+                order_id = order_id.decode("utf-8")
+                try:
+                    if compensate(order_id):
+                        complete_compensation(order_id, shard)
+                    else:
+                        reschedule_compensation(order_id, shard)
+                except Exception as err:
+                    print(f"Failed to compensate the checkout of order {order_id}: {err}")
+                    try:
+                        reschedule_compensation(order_id, shard)
+                    except Exception:
+                        # The order is still due, it is retried at the next scan
+                        pass
+
+
+def start_compensation_workers(compensate, workers: int = COMPENSATION_WORKERS) -> list:
+    """
+    Start the compensation worker threads of the process.
+
+    :param compensate: The function that aborts the saga of an order and returns True if it is finished.
+    :param workers: The number of worker threads.
+    :return: The started threads.
+    """
+    threads = []
+    for _ in range(workers):
+        thread = threading.Thread(target=run_compensations, args=(compensate,), daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    return threads
@@ -0,0 +1,13 @@
+"""
+Gunicorn configuration of the service, loaded automatically from the working directory.
+
+With WORKER_CLASS=gevent the worker runs the Flask app on an event loop: the socket calls of the Redis and HTTP
+clients are patched to be cooperative, so one worker keeps many requests in flight while they wait on I/O,
+with the same routes. The default sync worker serves one request at a time.
+"""
+import os
+
+worker_class = os.environ.get('WORKER_CLASS', 'sync')
+
+# Maximum number of concurrent requests of an event loop worker
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 1000))
@@ -0,0 +1,160 @@
+"""
+In-process caches of the order service for the information of the items retrieved from the stock service.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from bus import STOCK_RESTOCKED, bus, publish
+
+PRICE_CACHE_SIZE = int(os.environ.get('PRICE_CACHE_SIZE', 10000))
+# Seconds the stock of a sold out item is remembered, 0 disables the cache, which is also disabled without a bus
+SOLD_OUT_TTL = float(os.environ.get('SOLD_OUT_TTL', 0))
+
+
+class LRUCache:
+    """
+    Bounded cache that evicts the least recently used entry when it is full.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Retrieve an entry from the cache.
+
+        :param key: The key of the entry.
+        :return: The cached value, None if the key is not in the cache.
+        """
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        """
+        Add or refresh an entry of the cache, evicting the least recently used one if the cache is full.
+
+        :param key: The key of the entry.
+        :param value: The value to cache.
+        """
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        """
+        Retrieve the metrics of the cache.
+
+        :return: The metrics as a dictionary.
+        """
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class SoldOutCache(LRUCache):
+    """
+    Short-lived cache of the stock of the items that ran out of stock, so the checkouts that cannot succeed fail
+    without calling the other services. An entry is dropped after its TTL or when the item is restocked.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        super().__init__(max_size)
+        self.ttl = ttl
+        self.rejections = 0
+        self.invalidations = 0
+
+    def mark(self, item_id: str, stock: int):
+        """
+        Remember the stock of an item that is not enough for a request.
+
+        :param item_id: The id of the item.
+        :param stock: The stock of the item.
+        """
+        if self.ttl > 0:
+            self.put(item_id, (stock, time.monotonic() + self.ttl))
+
+    def unavailable(self, items: dict):
+        """
+        Find an item whose remembered stock is lower than the requested amount.
+
+        :param items: The dictionary of item_id -> requested amount.
+        :return: The id of the first unavailable item, None if all of them may be available.
+        """
+        if self.ttl <= 0:
+            return None
+
+        for item_id, amount in items.items():
+            entry = self.get(item_id)
+            if entry is None:
+                continue
+
+            stock, expiry = entry
+            if expiry < time.monotonic():
+                self.invalidate(item_id)
+            elif stock < amount:
+                with self.lock:
+                    self.rejections += 1
+                return item_id
+
+        return None
+
+    def invalidate(self, *item_ids: str):
+        """
+        Forget the stock of the given items, e.g. when they are restocked.
+
+        :param item_ids: The ids of the items.
+        """
+        with self.lock:
+            for item_id in item_ids:
+                if self.entries.pop(item_id, None) is not None:
+                    self.invalidations += 1
+
+    def stats(self) -> dict:
+        """
+        Retrieve the metrics of the cache.
+
+        :return: The metrics as a dictionary.
+        """
+        stats = super().stats()
+        with self.lock:
+            stats.update(ttl=self.ttl, rejections=self.rejections, invalidations=self.invalidations)
+        return stats
+
+
+# The price of an item never changes after its creation, so it can be cached without invalidation
+item_prices = LRUCache(PRICE_CACHE_SIZE)
+# The stock service publishes the restocked items on the bus, their entries are invalidated before the TTL, so without
+# a bus a restocked item would be rejected until its entry expires
+sold_out_items = SoldOutCache(PRICE_CACHE_SIZE, SOLD_OUT_TTL if bus is not None else 0)
+
+
+def stock_returned(item_ids):
+    """
+    Forget the given items in the sold out caches of all the order processes, after their stock has been returned.
+
+    :param item_ids: The ids of the items.
+    """
+    sold_out_items.invalidate(*item_ids)
+    publish(STOCK_RESTOCKED, json.dumps(list(item_ids)))
@@ -0,0 +1,368 @@
+"""
+Lease lock on a single Redis shard.
+A lock is the key lock:<key> in the shard of the locked entity, holding the random token of its holder followed by
+the identity of the holder as JSON, with a short lease. Acquiring and releasing take one round trip each, a watchdog thread renews the leases of the held locks, so a
+long operation keeps its lock while a crashed holder loses it after LOCK_LEASE_TIME.
+
+A lock that guards fenced writes is created with the hash of the fenced resource, e.g. the saga record of an order:
+every acquisition gets a fencing token from the counter lock_fence of that hash, so the resource can reject the updates
+of a holder whose lease expired meanwhile, because its token is lower than the one of the new holder. The fenced writes
+store their token in the field fence of the same hash and the counter never issues a token below it, so the tokens keep
+increasing when the hash is moved to another shard. The other locks do not issue fencing tokens.
+
+The endpoints hold their locks with the locked context manager, which releases them on every return and exception,
+and the locks held by all the processes are listed from the shards with their holder, route, age and callsite by
+held_locks.
+
+By default a request fails at once with "locked, try later" when one of its locks is held, as in the first versions.
+With a positive LOCK_WAIT_TIMEOUT a contended lock is waited for with jittered exponential backoff, up to the timeout
+for all the locks of a request, so a request only fails once its deadline has passed. The wait blocks the worker
+serving the request, so it needs enough workers, or the gevent worker class, to keep serving the other requests.
+With LOCK_FAIR_QUEUE, which needs a positive timeout, the waiters of a key queue in the sorted set lock_queue:<key>
+by arrival time and only the head of the queue acquires the lock, so a waiter cannot starve behind later arrivals.
+"""
+import contextlib
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+import uuid
+
+from flask import has_request_context, request
+
+from sharding import db_shards
+
+# Milliseconds a lock is held without being renewed
+LOCK_LEASE_TIME = int(os.environ.get('LOCK_LEASE_TIME', 1000))
+# Seconds between the renewals of the held locks
+LOCK_RENEW_INTERVAL = LOCK_LEASE_TIME / 3000
+# Maximum seconds a request waits for its locks, 0 to fail at once if they are held, -1 to wait forever
+LOCK_WAIT_TIMEOUT = float(os.environ.get('LOCK_WAIT_TIMEOUT', 0))
+# Seconds of the first backoff between two attempts of a blocking acquisition, doubled at every attempt
+LOCK_BACKOFF_BASE = float(os.environ.get('LOCK_BACKOFF_BASE', 0.005))
+# Maximum seconds of the backoff
+LOCK_BACKOFF_MAX = float(os.environ.get('LOCK_BACKOFF_MAX', 0.1))
+# Grant each lock to its waiters in arrival order
+LOCK_FAIR_QUEUE = os.environ.get('LOCK_FAIR_QUEUE', 'False') == 'True'
+# Milliseconds after which a queued waiter is considered gone, e.g. crashed, and removed from the queue
+LOCK_QUEUE_TIMEOUT = int(max(LOCK_WAIT_TIMEOUT, 60) * 1000) + LOCK_LEASE_TIME
+
+LOCK_KEY_PREFIX = "lock"
+LOCK_QUEUE_PREFIX = "lock_queue"
+
+# Issues the fencing token of an acquisition from the hash of the fenced resource, if any, otherwise returns 1.
+# The token is never below the fence of the last fenced write, also if the counter has been lost or reset.
+NEXT_FENCE = """
+local function next_fence(fence_key)
+    if not fence_key then
+        return 1
+    end
+    local fence = tonumber(redis.call('HGET', fence_key, 'fence') or '0')
+    local token = redis.call('HINCRBY', fence_key, 'lock_fence', 1)
+    if token <= fence then
+        token = fence + 1
+        redis.call('HSET', fence_key, 'lock_fence', token)
+    end
+    return token
+end
+"""
+
+# The value of a lock starts with the token of its holder
+HOLDS = """
+local function holds(lock_key, token)
+    local value = redis.call('GET', lock_key)
+    return value and string.sub(value, 1, string.len(token)) == token
+end
+"""
+
+# KEYS: [lock key, fenced hash (optional)], ARGV: [token, lease in ms, value]
+# Returns the fencing token, 1 without fenced hash, if the lock is acquired, 0 otherwise.
+ACQUIRE = NEXT_FENCE + """
+if redis.call('SET', KEYS[1], ARGV[3], 'NX', 'PX', ARGV[2]) then
+    return next_fence(KEYS[2])
+end
+return 0
+"""
+
+# KEYS: [lock key, queue key, fenced hash (optional)],
+# ARGV: [token, lease in ms, queue timeout in ms, enqueue, value]
+# The waiter joins the queue, scored by its arrival time, if enqueue is 1, otherwise it only acquires the lock if
+# nobody is queued. Returns the fencing token, 1 without fenced hash, if the lock is acquired, 0 otherwise.
+FAIR_ACQUIRE = NEXT_FENCE + """
+local time = redis.call('TIME')
+local now = time[1] * 1000 + math.floor(time[2] / 1000)
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now - tonumber(ARGV[3]))
+if ARGV[4] == '1' and not redis.call('ZSCORE', KEYS[2], ARGV[1]) then
+    redis.call('ZADD', KEYS[2], now, ARGV[1])
+end
+
+local head = redis.call('ZRANGE', KEYS[2], 0, 0)[1]
+if (head == nil or head == ARGV[1]) and redis.call('SET', KEYS[1], ARGV[5], 'NX', 'PX', ARGV[2]) then
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    return next_fence(KEYS[3])
+end
+if head ~= nil then
+    redis.call('PEXPIRE', KEYS[2], ARGV[3])
+end
+return 0
+"""
+
+# KEYS: [lock key], ARGV: [token]
+RELEASE = HOLDS + """
+if holds(KEYS[1], ARGV[1]) then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# KEYS: [lock key], ARGV: [token, lease in ms]
+RENEW = HOLDS + """
+if holds(KEYS[1], ARGV[1]) then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Register the scripts, they are executed with EVALSHA on the shard passed as client
+acquire_script = db_shards[0].register_script(ACQUIRE)
+fair_acquire_script = db_shards[0].register_script(FAIR_ACQUIRE)
+release_script = db_shards[0].register_script(RELEASE)
+renew_script = db_shards[0].register_script(RENEW)
+
+
+def lock_key(key: str) -> str:
+    """
+    Retrieve the key of the lock of a key, stored in the same shard of the key.
+
+    :param key: The locked key, e.g. order:<number>.
+    :return: The lock key.
+    """
+    return f"{LOCK_KEY_PREFIX}:{key}"
+
+
+def lock_queue_key(key: str) -> str:
+    """
+    Retrieve the key of the queue of the waiters of a lock, stored in the same shard of the key.
+
+    :param key: The locked key, e.g. order:<number>.
+    :return: The queue key.
+    """
+    return f"{LOCK_QUEUE_PREFIX}:{key}"
+
+
+def backoff(attempt: int) -> float:
+    """
+    Compute the jittered exponential backoff before an attempt to acquire a lock.
+
+    :param attempt: The number of failed attempts.
+    :return: The seconds to wait, uniformly distributed up to the exponential bound.
+    """
+    return random.uniform(0, min(LOCK_BACKOFF_MAX, LOCK_BACKOFF_BASE * 2 ** min(attempt, 16)))
+
+
+def callsite() -> str:
+    """
+    Retrieve the code that is acquiring a lock, skipping the frames of this module and of contextlib.
+
+    :return: The file, line and function of the caller.
+    """
+    frame = sys._getframe(1)
+    while frame.f_back is not None and frame.f_code.co_filename in (__file__, contextlib.__file__):
+        frame = frame.f_back
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno} {frame.f_code.co_name}"
+
+
+class LeaseLock:
+    """
+    Lock of one key, held with a lease renewed by the watchdog.
+    """
+
+    def __init__(self, key: str, db, fence_key: str = None):
+        self.key = key
+        self.db = db
+        # The hash of the resource fenced by the lock, in the same shard of the key, None if nothing is fenced
+        self.fence_key = fence_key
+        self.token = uuid.uuid4().hex
+        self.fencing_token = None
+        # Identity of the holder of the current acquisition, stored in the lock after the token
+        self.holder = None
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        """
+        Acquire the lock.
+
+        :param blocking: Wait until the lock is free, otherwise try only once.
+        :param timeout: The maximum seconds to wait, -1 to wait forever.
+        :return: True if the lock has been acquired.
+        """
+        deadline = time.monotonic() + timeout if timeout >= 0 else None
+        self.holder = {
+            "holder": f"{socket.gethostname()}-{os.getpid()}-{threading.current_thread().name}",
+            "route": f"{request.method} {request.path}" if has_request_context() else None,
+            "callsite": callsite(),
+        }
+        attempt = 0
+        while True:
+            fencing_token = self.try_acquire(blocking)
+            if fencing_token:
+                self.fencing_token = fencing_token if self.fence_key else None
+                watchdog.watch(self)
+                return True
+
+            if not blocking:
+                return False
+            if deadline is not None and time.monotonic() >= deadline:
+                if LOCK_FAIR_QUEUE:
+                    # Leave the queue, so the next waiter does not wait for the timeout of this one
+                    self.db.zrem(lock_queue_key(self.key), self.token)
+                return False
+
+            delay = backoff(attempt)
+            if deadline is not None:
+                delay = min(delay, deadline - time.monotonic())
+            time.sleep(max(delay, 0))
+            attempt += 1
+
+    def try_acquire(self, enqueue: bool) -> int:
+        """
+        Try to acquire the lock once.
+
+        :param enqueue: Join the queue of the waiters of the lock, if LOCK_FAIR_QUEUE is set.
+        :return: The fencing token, 1 if nothing is fenced, if the lock has been acquired, 0 otherwise.
+        """
+        fence_keys = [self.fence_key] if self.fence_key else []
+        value = f"{self.token} {json.dumps({**self.holder, 'acquired_at': time.time()})}"
+        if LOCK_FAIR_QUEUE:
+            return fair_acquire_script(keys=[lock_key(self.key), lock_queue_key(self.key), *fence_keys],
+                                       args=[self.token, LOCK_LEASE_TIME, LOCK_QUEUE_TIMEOUT, "1" if enqueue else "0",
+                                             value],
+                                       client=self.db)
+        return acquire_script(keys=[lock_key(self.key), *fence_keys], args=[self.token, LOCK_LEASE_TIME, value],
+                              client=self.db)
+
+    def release(self) -> bool:
+        """
+        Release the lock.
+
+        :return: True if the lock was still held, False if its lease had expired.
+        """
+        watchdog.unwatch(self)
+        return bool(release_script(keys=[lock_key(self.key)], args=[self.token], client=self.db))
+
+    def renew(self) -> bool:
+        """
+        Extend the lease of the lock.
+
+        :return: True if the lock is still held.
+        """
+        return bool(renew_script(keys=[lock_key(self.key)], args=[self.token, LOCK_LEASE_TIME], client=self.db))
+
+
+@contextlib.contextmanager
+def locked(*lease_locks: LeaseLock, blocking: bool = True, timeout: float = LOCK_WAIT_TIMEOUT):
+    """
+    Hold some locks for the duration of a with block.
+    The locks are acquired in the given order and the acquired ones are always released when the block exits, with a
+    return or an exception, also if one of them could not be acquired.
+
+    :param lease_locks: The locks to acquire.
+    :param blocking: Wait until each lock is free, otherwise try only once.
+    :param timeout: The maximum seconds to wait for all the locks together, -1 to wait forever.
+    :return: True if all the locks have been acquired, the block must check it.
+    """
+    deadline = time.monotonic() + timeout if timeout >= 0 else None
+    acquired = []
+    try:
+        for lease_lock in lease_locks:
+            remaining = max(deadline - time.monotonic(), 0) if deadline is not None else -1
+            if not lease_lock.acquire(blocking, remaining):
+                break
+            acquired.append(lease_lock)
+
+        yield len(acquired) == len(lease_locks)
+    finally:
+        for lease_lock in reversed(acquired):
+            try:
+                lease_lock.release()
+            except Exception as err:
+                # The lease expires anyway, the block must not fail because of the release
+                print(f"Failed to release the lock of {lease_lock.key}: {err}")
+
+
+class Watchdog:
+    """
+    Renews the leases of the locks held by the process, the thread starts with the first lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.held = set()
+        self.thread = None
+
+    def watch(self, lease_lock: LeaseLock):
+        with self.lock:
+            self.held.add(lease_lock)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def unwatch(self, lease_lock: LeaseLock):
+        with self.lock:
+            self.held.discard(lease_lock)
+
+    def run(self):
+        while True:
+            time.sleep(LOCK_RENEW_INTERVAL)
+            with self.lock:
+                held = list(self.held)
+            for lease_lock in held:
+                try:
+                    if not lease_lock.renew():
+                        print(f"The lease of the lock of {lease_lock.key} has expired")
+                        self.unwatch(lease_lock)
+                except Exception as err:
+                    print(f"Failed to renew the lock of {lease_lock.key}: {err}")
+
+
+watchdog = Watchdog()
+
+
+def parse_lock(key: bytes, value: bytes, now: float) -> dict:
+    """
+    Read the holder of a lock from the value of its key.
+
+    :param key: The lock key.
+    :param value: The value of the lock key, the token of the holder followed by its identity.
+    :param now: The current time, to compute the age of the lock.
+    :return: The lock as a dictionary, without identity if the lock has been acquired by a previous version.
+    """
+    _, _, holder = value.decode("utf-8").partition(" ")
+    holder = json.loads(holder) if holder else {}
+    acquired_at = holder.pop("acquired_at", None)
+    return {
+        "key": key.decode("utf-8")[len(LOCK_KEY_PREFIX) + 1:],
+        **holder,
+        "age": round(now - acquired_at, 3) if acquired_at is not None else None,
+    }
+
+
+def held_locks() -> list:
+    """
+    Retrieve the locks currently held in the shards by any process, the oldest first.
+    The lock keys are scanned, so it is meant for diagnostics only.
+
+    :return: The held locks as dictionaries, with their holder, route, callsite and age in seconds.
+    """
+    now = time.time()
+    locks = []
+    for db in {id(db): db for db in db_shards}.values():
+        keys = list(db.scan_iter(match=f"{LOCK_KEY_PREFIX}:*", count=1000))
+        serialized_transaction = db.pipeline(transaction=False)
+        for key in keys:
+            serialized_transaction.get(key)
+        locks += [parse_lock(key, value, now) for key, value in zip(keys, serialized_transaction.execute()) if value]
+
+    return sorted(locks, key=lambda lock: -(lock["age"] or 0))
@@ -0,0 +1,234 @@
+"""
+Persistent log of the checkout sagas.
+The progress of the saga of an order is stored in the record order:<number>:saga, in the same shard as the order,
+and the orders with an unfinished saga are kept in the sorted set sagas:pending of the shard, scored by the time of
+their last update. If the worker running a checkout dies, the recovery resumes or compensates its saga.
+
+The saga record is only updated with the fencing token of the lock of the order, issued from the counter kept in the
+saga record itself, so a checkout that lost its lock cannot overwrite the progress of the recovery that took it over,
+also after the record has been moved to another shard.
+
+The stock is retrieved before the payment, unless the record has payment_first, set when the adaptive order of the
+steps runs the payment first: the state of the saga is the last step done in the order of the attempt.
+"""
+import json
+import time
+
+from compensations import return_back_money
+from item_cache import stock_returned
+from scripts import UPDATE_SAGA
+from service_client import payment_service, stock_service
+from sharding import db_shards
+
+SAGA_STARTED = "started"
+SAGA_STOCK_RETRIEVED = "stock_retrieved"
+SAGA_PAID = "paid"
+SAGA_COMPLETED = "completed"
+SAGA_ABORTED = "aborted"
+
+PENDING_SAGAS = "sagas:pending"
+
+# Register the script, it is executed with EVALSHA on the shard passed as client
+update_saga_script = db_shards[0].register_script(UPDATE_SAGA)
+
+
+class StaleSagaError(Exception):
+    """
+    The saga has been taken over by a newer holder of the lock of the order.
+    """
+
+
+def saga_key(order_id: str) -> str:
+    """
+    Retrieve the key of the saga record of an order, stored in the same shard as the order.
+
+    :param order_id: The id of the order.
+    :return: The saga key.
+    """
+    return f"{order_id}:saga"
+
+
+class SagaLog:
+    """
+    The saga record of the checkout of an order.
+    Every checkout attempt has its own transaction id, used by the other services to apply its steps exactly once.
+    """
+
+    def __init__(self, order_id: str, db, fencing_token: int):
+        self.order_id = order_id
+        self.db = db
+        self.fencing_token = fencing_token
+        self.key = saga_key(order_id)
+        self.txn_id = None
+        self.state = None
+        self.payment_first = False
+        # Set when the saga has been taken over, nothing must be compensated anymore
+        self.fenced = False
+
+    def start(self, order, payment_first: bool = False):
+        """
+        Start a new checkout attempt of the order.
+
+        :param order: The converted order.
+        :param payment_first: True if the attempt debits the user before retrieving the stock.
+        """
+        attempt = self.db.hincrby(self.key, "attempt", 1)
+        self.txn_id = f"{self.order_id}:{attempt}"
+        self.payment_first = payment_first
+        self.record(SAGA_STARTED, user_id=order["user_id"], items=json.dumps(order["items"]),
+                    total_cost=order["total_cost"], payment_first="1" if payment_first else "0")
+
+    def update(self, state: str, finished: bool, paid: bool = None, **fields):
+        """
+        Persist the progress of the saga, if it has not been taken over.
+
+        :param state: The new state of the saga.
+        :param finished: True to remove the saga from the pending sagas.
+        :param paid: The paid status to set in the order together with the saga, None to leave it.
+        :param fields: Other fields of the saga record to update.
+        """
+        args = [self.fencing_token, time.time(), state, "1" if finished else "0",
+                "" if paid is None else json.dumps(paid)]
+        for field, value in fields.items():
+            args += [field, value]
+
+        if not update_saga_script(keys=[self.key, PENDING_SAGAS, self.order_id], args=args, client=self.db):
+            self.fenced = True
+            raise StaleSagaError(f"The checkout of order {self.order_id} has been taken over")
+        self.state = state
+
+    def record(self, state: str, **fields):
+        """
+        Persist the progress of the saga and mark it as pending.
+
+        :param state: The new state of the saga.
+        :param fields: Other fields of the saga record to update.
+        """
+        self.update(state, False, **fields)
+
+    def finish(self, state: str, paid: bool = None):
+        """
+        Mark the saga as finished.
+
+        :param state: The final state of the saga.
+        :param paid: The paid status to set in the order together with the end of the saga, None to leave it.
+        """
+        self.update(state, True, paid)
+
+    def payment_requested(self) -> bool:
+        """
+        Check if the payment of the attempt may have been requested.
+
+        :return: True if the payment may have been done.
+        """
+        return self.payment_first or self.state != SAGA_STARTED
+
+    def stock_retrieved(self) -> bool:
+        """
+        Check if the stock of the attempt has been retrieved for sure.
+
+        :return: True if the retrieval of the stock is recorded.
+        """
+        return self.state == SAGA_STOCK_RETRIEVED or (self.state == SAGA_PAID and not self.payment_first)
+
+
+def is_pending(state) -> bool:
+    """
+    Check if a saga state, as stored in the DB, belongs to an unfinished saga.
+
+    :param state: The state of the saga, or None if the order has no saga.
+    :return: True if the saga is unfinished.
+    """
+    return state is not None and state.decode("utf-8") not in (SAGA_COMPLETED, SAGA_ABORTED)
+
+
+def payment_done(user_id: str, order_id: str):
+    """
+    Check in the payment service if the order is paid.
+
+    :param user_id: The id of the user of the order.
+    :param order_id: The id of the order.
+    :return: True if it is paid, False if it is not, None if the payment service could not tell.
+    """
+    try:
+        response = payment_service.post(f"/status/{user_id}/{order_id}")
+    except Exception:
+        return None
+
+    if response.status_code == 404:
+        return False
+    if response.status_code != 200:
+        return None
+    return response.json()["paid"]
+
+
+def abort_saga(saga: SagaLog, user_id: str, items) -> bool:
+    """
+    Compensate the saga of an order: cancel the payment of its attempt, if it has been requested, and release the
+    stock reserved by the attempt. Both compensations are idempotent, so they can be repeated safely, and they also
+    discard a late payment or retrieval of the stock of the attempt.
+
+    :param saga: The saga.
+    :param user_id: The id of the user of the order.
+    :param items: The items of the order.
+    :return: True if the saga is aborted, False if it has to be retried later.
+    """
+    if saga.fenced:
+        return False
+
+    # The payment of the attempt is cancelled also if it is not done, so a late payment of the attempt is ignored
+    if saga.payment_requested() and not return_back_money(user_id, saga.order_id, saga.txn_id):
+        return False
+
+    try:
+        response = stock_service.post(f"/add_batch/{saga.txn_id}", json=items)
+    except Exception:
+        return False
+    if response.status_code != 200:
+        return False
+    if saga.stock_retrieved():
+        stock_returned(items)
+
+    try:
+        saga.finish(SAGA_ABORTED)
+    except StaleSagaError:
+        return False
+    return True
+
+
+def recover_saga(order_id: str, db, fencing_token: int) -> bool:
+    """
+    Resume or compensate the unfinished saga of an order, the lock of the order must be held.
+    The saga is completed if the payment has been done, otherwise it is aborted.
+
+    :param order_id: The id of the order.
+    :param db: The db connection of the order.
+    :param fencing_token: The fencing token of the lock of the order.
+    :return: True if the saga is finished, False if it has to be retried later.
+    """
+    saga = SagaLog(order_id, db, fencing_token)
+    record = db.hgetall(saga.key)
+    if not is_pending(record.get(b"state")):
+        db.zrem(PENDING_SAGAS, order_id)
+        return True
+
+    saga.state = record[b"state"].decode("utf-8")
+    saga.txn_id = f"{order_id}:{int(record[b'attempt'])}"
+    saga.payment_first = record.get(b"payment_first") == b"1"
+    user_id = record[b"user_id"].decode("utf-8")
+
+    # Both steps are done if the stock has been retrieved and the payment has been done
+    if saga.stock_retrieved() and payment_done(user_id, order_id):
+        # Roll forward, the order is paid together with the end of the saga
+        try:
+            saga.finish(SAGA_COMPLETED, paid=True)
+        except StaleSagaError:
+            return False
+        print(f"Saga of order {order_id} recovered: completed")
+        return True
+
+    if not abort_saga(saga, user_id, json.loads(record[b"items"])):
+        return False
+
+    print(f"Saga of order {order_id} recovered: aborted")
+    return True
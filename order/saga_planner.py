@@ -0,0 +1,154 @@
+"""
+Adaptive order of the steps of the checkout saga.
+Retrieving the stock and debiting the user do not depend on each other, so they can run in either order before the
+order is updated. Every process tracks for both steps the exponentially weighted moving average of their failure
+probability and of their latency. With ADAPTIVE_SAGA_ORDER the step with the lowest latency / failure probability,
+the cheapest one likely to fail, runs first: a checkout that fails then mostly fails before the other step is applied,
+so there is nothing to compensate.
+
+With SAGA_PRECHECK the steps whose failure probability reaches SAGA_PRECHECK_THRESHOLD are checked before the saga
+with a read-only request, so a checkout bound to fail does not apply any step.
+"""
+import functools
+import os
+import threading
+import time
+
+# Order the independent steps of the checkout by their observed failure probability and latency
+ADAPTIVE_SAGA_ORDER = os.environ.get('ADAPTIVE_SAGA_ORDER', 'False') == 'True'
+# Weight of the last execution in the moving averages of the steps
+SAGA_STATS_ALPHA = float(os.environ.get('SAGA_STATS_ALPHA', 0.1))
+# Check the stock and the credit with read-only requests before running the steps likely to fail
+SAGA_PRECHECK = os.environ.get('SAGA_PRECHECK', 'False') == 'True'
+# Failure probability of a step from which it is checked before the saga
+SAGA_PRECHECK_THRESHOLD = float(os.environ.get('SAGA_PRECHECK_THRESHOLD', 0.2))
+# Lower bound of the failure probability in the rank of a step, so a step that never fails still has a finite rank
+MIN_FAILURE_RATE = 0.001
+
+STOCK_STEP = "stock"
+PAYMENT_STEP = "payment"
+
+
+class StepStats:
+    """
+    Moving averages of the outcome and of the latency of the executions of a step.
+    """
+
+    def __init__(self, alpha: float):
+        self.alpha = alpha
+        self.lock = threading.Lock()
+        self.failure_rate = 0.0
+        self.latency = None
+        self.executions = 0
+        self.failures = 0
+        self.prechecks = 0
+        self.compensations = 0
+
+    def observe(self, failed: bool, seconds: float = None):
+        """
+        Account for an execution of the step, or for a precheck of it.
+
+        :param failed: True if the step failed, or would have failed according to its precheck.
+        :param seconds: The duration of the execution, None for a precheck.
+        """
+        with self.lock:
+            self.failure_rate += self.alpha * (float(failed) - self.failure_rate)
+            if seconds is None:
+                self.prechecks += 1
+                return
+
+            self.executions += 1
+            self.failures += int(failed)
+            self.latency = seconds if self.latency is None else self.latency + self.alpha * (seconds - self.latency)
+
+    def compensated(self):
+        with self.lock:
+            self.compensations += 1
+
+    def rank(self) -> float:
+        """
+        Retrieve the rank of the step, the steps with the lowest rank run first.
+
+        :return: The expected seconds spent in the step for each failure it detects.
+        """
+        with self.lock:
+            return (self.latency or 0) / max(self.failure_rate, MIN_FAILURE_RATE)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "failure_rate": round(self.failure_rate, 4),
+                "latency": round(self.latency, 4) if self.latency is not None else None,
+                "executions": self.executions,
+                "failures": self.failures,
+                "prechecks": self.prechecks,
+                "compensations": self.compensations,
+            }
+
+
+step_stats = {
+    STOCK_STEP: StepStats(SAGA_STATS_ALPHA),
+    PAYMENT_STEP: StepStats(SAGA_STATS_ALPHA),
+}
+
+
+def observed(name: str):
+    """
+    Decorate the execute method of a step, to account for its outcome and latency.
+
+    :param name: The name of the step in step_stats.
+    :return: The decorator.
+    """
+
+    def decorator(execute):
+        @functools.wraps(execute)
+        def wrapper(step, state):
+            start = time.monotonic()
+            try:
+                state = execute(step, state)
+            except Exception:
+                step_stats[name].observe(True, time.monotonic() - start)
+                raise
+            step_stats[name].observe(False, time.monotonic() - start)
+            return state
+
+        return wrapper
+
+    return decorator
+
+
+def plan_steps(steps: dict) -> list:
+    """
+    Order the independent steps of a checkout.
+
+    :param steps: The dictionary of step name -> step, in the default order.
+    :return: The steps in the order they must run, the default one without ADAPTIVE_SAGA_ORDER.
+    """
+    if not ADAPTIVE_SAGA_ORDER:
+        return list(steps.values())
+
+    # The sort is stable, so the default order is kept while there are no statistics
+    return [steps[name] for name in sorted(steps, key=lambda name: step_stats[name].rank())]
+
+
+def needs_precheck(name: str) -> bool:
+    """
+    Check if a step is likely enough to fail to be checked before the saga.
+
+    :param name: The name of the step.
+    :return: True if the step has to be checked.
+    """
+    return SAGA_PRECHECK and step_stats[name].failure_rate >= SAGA_PRECHECK_THRESHOLD
+
+
+def saga_stats() -> dict:
+    """
+    Retrieve the statistics of the steps of the checkout saga.
+
+    :return: The statistics of each step and the order in which the steps currently run.
+    """
+    return {
+        "adaptive": ADAPTIVE_SAGA_ORDER,
+        "order": plan_steps({name: name for name in step_stats}),
+        "steps": {name: stats.stats() for name, stats in step_stats.items()},
+    }
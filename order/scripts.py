@@ -0,0 +1,162 @@
+"""
+Server-side Lua scripts for the mutations of the order line items.
+Each line item is a counter field of the order hash, so adding or removing an item is an O(1) atomic
+increment executed in a single round trip, without reading and rewriting the whole order.
+
+KEYS of the scripts: [order_id, lock key of the order]. While a checkout holds the lock of the order,
+the line items cannot be changed.
+
+The scripts return a list whose first element is the status of the execution:
+- SCRIPT_OK: the order has been updated, list[1] is the new total cost.
+- SCRIPT_ORDER_NOT_FOUND: the order does not exist.
+- SCRIPT_ORDER_LOCKED: the order is locked by a checkout.
+- SCRIPT_ORDER_PAID: the order has been paid already.
+- SCRIPT_NOT_ENOUGH_STOCK: adding the item would exceed its available stock.
+- SCRIPT_ITEM_NOT_FOUND: the item to remove is not in the order.
+- SCRIPT_CHECKOUT_PENDING: a checkout of the order is queued or running already, list[1] is its ticket.
+- SCRIPT_PRICE_UNKNOWN: the item to remove was added without its unit price, e.g. by the first versions, and no
+  price has been passed.
+"""
+
+SCRIPT_OK = 0
+SCRIPT_ORDER_NOT_FOUND = 1
+SCRIPT_ORDER_LOCKED = 2
+SCRIPT_ORDER_PAID = 3
+SCRIPT_NOT_ENOUGH_STOCK = 4
+SCRIPT_ITEM_NOT_FOUND = 5
+SCRIPT_CHECKOUT_PENDING = 6
+SCRIPT_PRICE_UNKNOWN = 7
+
+# Prefix of the hash fields that store the quantity of each item in the order
+ITEM_FIELD_PREFIX = "items:"
+# Prefix of the hash fields that store the unit price of each item in the order, as charged when it was added
+PRICE_FIELD_PREFIX = "prices:"
+
+# Checks shared by the scripts, it also expands the legacy JSON blob of the items into one field per item
+CHECK_ORDER = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return {1}
+end
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return {2}
+end
+if redis.call('HGET', KEYS[1], 'paid') == 'true' then
+    return {3}
+end
+
+local legacy_items = redis.call('HGET', KEYS[1], 'items')
+if legacy_items then
+    for item_id, amount in pairs(cjson.decode(legacy_items)) do
+        redis.call('HSET', KEYS[1], 'items:' .. item_id, amount)
+    end
+    redis.call('HDEL', KEYS[1], 'items')
+end
+"""
+
+# ARGV: [item field, item price, available stock of the item, price field]
+# The unit price of the item is stored with its line, the units added later are charged the same price.
+ADD_ITEM = CHECK_ORDER + """
+local amount = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0')
+if amount + 1 > tonumber(ARGV[3]) then
+    return {4}
+end
+
+local price = redis.call('HGET', KEYS[1], ARGV[4])
+if amount == 0 or not price then
+    price = ARGV[2]
+    redis.call('HSET', KEYS[1], ARGV[4], price)
+end
+redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+return {0, redis.call('HINCRBY', KEYS[1], 'total_cost', price)}
+"""
+
+# ARGV: [item field, price field, item price or '' to use the stored unit price]
+REMOVE_ITEM = CHECK_ORDER + """
+local amount = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0')
+if amount <= 0 then
+    return {5}
+end
+
+local price = redis.call('HGET', KEYS[1], ARGV[2]) or ARGV[3]
+if price == '' then
+    return {7}
+end
+
+if amount == 1 then
+    redis.call('HDEL', KEYS[1], ARGV[1], ARGV[2])
+else
+    redis.call('HINCRBY', KEYS[1], ARGV[1], -1)
+end
+return {0, redis.call('HINCRBY', KEYS[1], 'total_cost', -tonumber(price))}
+"""
+
+# KEYS: [order_id, checkout status key of the order, checkout stream of the shard]
+# Queues the checkout of the order unless one is queued or running already, list[1] is the ticket of the checkout.
+ENQUEUE_CHECKOUT = """
+local checkout = redis.call('HMGET', KEYS[2], 'status', 'ticket')
+if checkout[1] == 'queued' or checkout[1] == 'processing' then
+    return {6, checkout[2]}
+end
+
+local ticket = redis.call('XADD', KEYS[3], '*', 'order_id', KEYS[1])
+redis.call('HSET', KEYS[2], 'status', 'queued', 'ticket', ticket, 'message', '')
+return {0, ticket}
+"""
+
+# KEYS: [saga key of the order, pending sagas set, order_id]
+# ARGV: [fencing token of the order lock, time, state, '1' if the saga is finished, value of the paid field of the order
+# or '' to leave it, field, value, ...]
+# Updates the saga record unless a holder of the order lock with a higher fencing token has updated it already,
+# returns 1 if the saga is updated and 0 otherwise.
+UPDATE_SAGA = """
+local fence = tonumber(redis.call('HGET', KEYS[1], 'fence') or '0')
+if tonumber(ARGV[1]) < fence then
+    return 0
+end
+
+redis.call('HSET', KEYS[1], 'fence', ARGV[1], 'updated', ARGV[2], 'state', ARGV[3], unpack(ARGV, 6))
+if ARGV[4] == '1' then
+    redis.call('ZREM', KEYS[2], KEYS[3])
+else
+    redis.call('ZADD', KEYS[2], ARGV[2], KEYS[3])
+end
+if ARGV[5] ~= '' then
+    redis.call('HSET', KEYS[3], 'paid', ARGV[5])
+end
+return 1
+"""
+
+# KEYS: [checkout result key of the order], ARGV: [attempt id, ttl in ms]
+# Claims the synchronous checkout of the order unless one is running or has succeeded already, in which case it
+# returns [attempt id, status, message] of that checkout, otherwise it returns an empty list.
+CLAIM_CHECKOUT = """
+local checkout = redis.call('HMGET', KEYS[1], 'attempt', 'status', 'message')
+if checkout[2] == 'running' or checkout[2] == '200' then
+    return checkout
+end
+
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], 'attempt', ARGV[1], 'status', 'running')
+redis.call('PEXPIRE', KEYS[1], ARGV[2])
+return {}
+"""
+
+# KEYS: [checkout result key of the order], ARGV: [attempt id, ttl in ms]
+# Extends the claim of the attempt while its checkout is running. Returns 1 if the claim is still held, 0 otherwise.
+RENEW_CHECKOUT = """
+local checkout = redis.call('HMGET', KEYS[1], 'attempt', 'status')
+if checkout[1] == ARGV[1] and checkout[2] == 'running' then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# KEYS: [checkout result key of the order], ARGV: [attempt id, status, message, ttl in ms]
+# Stores the result of the checkout, if the claim of the attempt has not expired meanwhile.
+FINISH_CHECKOUT = """
+if redis.call('HGET', KEYS[1], 'attempt') == ARGV[1] then
+    redis.call('HSET', KEYS[1], 'status', ARGV[2], 'message', ARGV[3])
+    redis.call('PEXPIRE', KEYS[1], ARGV[4])
+end
+return 0
+"""
@@ -0,0 +1,234 @@
+"""
+Shared HTTP client for the calls from the order service to the stock and payment services.
+All the calls go through one pooled keep-alive session, so the TCP connections to the services are reused.
+With SAGA_TRANSPORT=streams the calls are sent as commands over the Redis Streams bus instead.
+
+Each service can be reached through several endpoints, e.g. the replicas behind a headless service: the host of every
+configured url is resolved periodically to all its addresses, every request goes to the less busy of two random
+endpoints, and the endpoints that keep failing are ejected for a while.
+"""
+import os
+import random
+import socket
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from bus import SAGA_TRANSPORT, StreamClient
+
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 20))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 3))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 30))
+# Seconds between the resolutions of the hosts of the services, 0 disables the resolution
+SERVICE_DISCOVERY_INTERVAL = float(os.environ.get('SERVICE_DISCOVERY_INTERVAL', 10))
+# Consecutive failures after which an endpoint is ejected, and the seconds it stays ejected
+EJECT_FAILURES = int(os.environ.get('EJECT_FAILURES', 3))
+EJECT_TIME = float(os.environ.get('EJECT_TIME', 10))
+
+# One session for all the outbound calls, with a pool of keep-alive connections per host
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+session.mount("http://", adapter)
+session.mount("https://", adapter)
+
+
+def service_urls(name: str) -> list:
+    """
+    Retrieve the configured urls of a service, from <name>_URLS as a comma separated list or from <name>_URL.
+
+    :param name: The prefix of the variables, e.g. STOCK_SERVICE.
+    :return: The list of urls.
+    """
+    if os.environ.get(f'{name}_URLS'):
+        return [url.strip() for url in os.environ[f'{name}_URLS'].split(",") if url.strip()]
+
+    return [os.environ[f'{name}_URL']]
+
+
+def resolve(url: str) -> list:
+    """
+    Expand a url into one url per address of its host.
+
+    :param url: The url.
+    :return: The urls with the addresses of the host, or the url itself if the host cannot be resolved.
+    """
+    parts = urlsplit(url)
+    try:
+        addresses = socket.getaddrinfo(parts.hostname, parts.port or 80, socket.AF_INET, socket.SOCK_STREAM)
+    except OSError:
+        return [url]
+
+    netloc = f":{parts.port}" if parts.port else ""
+    return sorted({urlunsplit(parts._replace(netloc=address[4][0] + netloc)) for address in addresses}) or [url]
+
+
+class Endpoint:
+    """
+    One endpoint of a service, with its outstanding requests and its health.
+    """
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.ejected_until = 0
+        self.ejections = 0
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ejected": self.ejected_until > time.monotonic(),
+            "ejections": self.ejections,
+        }
+
+
+class ServiceClient:
+    """
+    Client of one service, it balances the requests over the endpoints of the service, sends them through the shared
+    session and keeps the metrics of its pool.
+    """
+
+    def __init__(self, base_urls: list):
+        self.base_urls = base_urls
+        self.lock = threading.Lock()
+        self.endpoints = [Endpoint(base_url) for base_url in base_urls]
+        self.next_discovery = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.saturated = 0
+        self.errors = 0
+        self.timeouts = 0
+
+    def discover(self):
+        """
+        Resolve the endpoints of the service again, once every SERVICE_DISCOVERY_INTERVAL.
+        The known endpoints keep their state.
+        """
+        with self.lock:
+            if not SERVICE_DISCOVERY_INTERVAL or time.monotonic() < self.next_discovery:
+                return
+            self.next_discovery = time.monotonic() + SERVICE_DISCOVERY_INTERVAL
+
+        discovered = [resolved for base_url in self.base_urls for resolved in resolve(base_url)]
+
+        with self.lock:
+            known = {endpoint.base_url: endpoint for endpoint in self.endpoints}
+            self.endpoints = [known.get(base_url) or Endpoint(base_url) for base_url in discovered]
+
+    def pick(self) -> Endpoint:
+        """
+        Pick the endpoint of a request, the one with fewer outstanding requests of two random healthy endpoints.
+        If all the endpoints are ejected, all of them are considered.
+
+        :return: The endpoint, with the request counted as outstanding.
+        """
+        self.discover()
+
+        with self.lock:
+            now = time.monotonic()
+            candidates = [endpoint for endpoint in self.endpoints if endpoint.ejected_until <= now] or self.endpoints
+            if len(candidates) == 1:
+                endpoint = candidates[0]
+            else:
+                first, second = random.sample(candidates, 2)
+                endpoint = first if first.in_flight <= second.in_flight else second
+
+            # All the pooled connections to the endpoint are busy, the request has to open a new one
+            if endpoint.in_flight >= HTTP_POOL_SIZE:
+                self.saturated += 1
+            endpoint.in_flight += 1
+            endpoint.requests += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            self.requests += 1
+
+        return endpoint
+
+    def release(self, endpoint: Endpoint, failed: bool):
+        """
+        Complete a request of an endpoint, ejecting the endpoint after EJECT_FAILURES consecutive failures.
+
+        :param endpoint: The endpoint of the request.
+        :param failed: True if the endpoint could not serve the request.
+        """
+        with self.lock:
+            endpoint.in_flight -= 1
+            self.in_flight -= 1
+            if not failed:
+                endpoint.failures = 0
+                return
+
+            endpoint.failures += 1
+            if endpoint.failures >= EJECT_FAILURES:
+                endpoint.failures = 0
+                endpoint.ejected_until = time.monotonic() + EJECT_TIME
+                endpoint.ejections += 1
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        """
+        Send a request to the service.
+
+        :param method: The HTTP method.
+        :param path: The path of the endpoint, appended to the base url of the service.
+        :param kwargs: The extra arguments of the request, e.g. the json body.
+        :return: The response of the service.
+        """
+        kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+
+        endpoint = self.pick()
+        failed = True
+        try:
+            response = session.request(method, f"{endpoint.base_url}{path}", **kwargs)
+            # The errors of the service are returned with status 4xx, 5xx means the endpoint is not healthy
+            failed = response.status_code >= 500
+            return response
+        except requests.Timeout:
+            with self.lock:
+                self.timeouts += 1
+            raise
+        except requests.RequestException:
+            with self.lock:
+                self.errors += 1
+            raise
+        finally:
+            self.release(endpoint, failed)
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request("POST", path, **kwargs)
+
+    def stats(self) -> dict:
+        """
+        Retrieve the metrics of the client.
+
+        :return: The metrics as a dictionary.
+        """
+        with self.lock:
+            return {
+                "base_urls": self.base_urls,
+                "pool_size": HTTP_POOL_SIZE,
+                "in_flight": self.in_flight,
+                "peak_in_flight": self.peak_in_flight,
+                "requests": self.requests,
+                "saturated": self.saturated,
+                "errors": self.errors,
+                "timeouts": self.timeouts,
+                "endpoints": {endpoint.base_url: endpoint.stats() for endpoint in self.endpoints},
+            }
+
+
+if SAGA_TRANSPORT == "streams":
+    stock_service = StreamClient("stock")
+    payment_service = StreamClient("payment")
+else:
+    stock_service = ServiceClient(service_urls('STOCK_SERVICE'))
+    payment_service = ServiceClient(service_urls('USER_SERVICE'))
@@ -1,64 +1,109 @@
 import json
 import os
-import atexit
-import random
 
-from flask import Flask, Response
 import redis
-from pottery import Redlock
+from flask import Flask, Response, request
 
-RANDOM_SEED = 444
-ID_BYTES_SIZE = 32
-LOCK_AUTORELEASE_TIME = 120
+from bus import SAGA_TRANSPORT, bus, start_consumers
+from lease_lock import LeaseLock, held_locks, locked
+from sharding import db_shards, get_db, get_old_db, get_read_db, group_by_db, hgetall_many, allocate_ids, is_routable
+from scripts import (PAY, CANCEL, STATUS, SCRIPT_OK, SCRIPT_USER_NOT_FOUND, SCRIPT_INSUFFICIENT_CREDIT,
+                     SCRIPT_ALREADY_PAID, SCRIPT_PAYMENT_NOT_FOUND, SCRIPT_TRANSACTION_CANCELLED)
 
-# Set random seed to generate unique ids for the items
-random.seed(RANDOM_SEED)
+# How long the tombstone of a cancelled payment transaction is kept, in milliseconds
+TRANSACTION_TTL = int(os.environ.get('TRANSACTION_TTL', 7 * 24 * 3600 * 1000))
+
+# Run the payment operations as atomic server-side scripts instead of locks + multiple round trips
+USE_SCRIPTS = os.environ.get('USE_SCRIPTS', 'False') == 'True'
+# Serve the reads with a single HGETALL without locking the user
+LOCK_FREE_READS = os.environ.get('LOCK_FREE_READS', 'False') == 'True'
+# Look up the payments stored under the order id by the first versions, and move them next to their user
+LEGACY_PAYMENTS = os.environ.get('LEGACY_PAYMENTS', 'False') == 'True'
 
 app = Flask("payment-service")
 
-# Connect to DB
-db_0: redis.Redis = redis.Redis(host=os.environ['REDIS_HOST_0'],
-                                port=int(os.environ['REDIS_PORT']),
-                                password=os.environ['REDIS_PASSWORD'],
-                                db=int(os.environ['REDIS_DB']))
+# Register the scripts, they are executed with EVALSHA on the shard passed as client
+pay_script = db_shards[0].register_script(PAY)
+cancel_script = db_shards[0].register_script(CANCEL)
+status_script = db_shards[0].register_script(STATUS)
 
-db_1: redis.Redis = redis.Redis(host=os.environ['REDIS_HOST_1'],
-                                port=int(os.environ['REDIS_PORT']),
-                                password=os.environ['REDIS_PASSWORD'],
-                                db=int(os.environ['REDIS_DB']))
 
-db_2: redis.Redis = redis.Redis(host=os.environ['REDIS_HOST_2'],
-                                port=int(os.environ['REDIS_PORT']),
-                                password=os.environ['REDIS_PASSWORD'],
-                                db=int(os.environ['REDIS_DB']))
+def payment_key(user_id: str, order_id: str) -> str:
+    """
+    Retrieve the key of the payment of an order.
+    The key starts with the user id, so the payment is routed to the same shard of the user.
 
-db_shards = [db_0, db_1, db_2]
-MODULO_HASH = len(db_shards)
+    :param user_id: The id of the user.
+    :param order_id: The id of the order.
+    :return: The payment key.
+    """
+    return f"{user_id}:{order_id}"
 
 
-def close_db_connection():
+def move_legacy_payment(user_id: str, order_id: str, db):
     """
-    Close the DB connection
+    Move the payment of an order stored by the first versions under the order id, in the shard of the user, to its
+    payment key. During a migration the legacy payment may still be in the old shard of the user, and after it the
+    migration tool may have routed it by the order number. The legacy payment does not record its user, so it is moved
+    by the first request of the user for the order.
+
+    :param user_id: The id of the user.
+    :param order_id: The id of the order.
+    :param db: The db connection of the user.
     """
-    for db in db_shards:
-        db.close()
+    payment_id = payment_key(user_id, order_id)
+    if not is_routable(order_id) or db.exists(payment_id):
+        return
+
+    for legacy_db in (db, get_old_db(user_id), get_read_db(order_id)):
+        data = legacy_db.dump(order_id) if legacy_db is not None else None
+        if data is not None:
+            break
+    else:
+        return
 
+    try:
+        db.restore(payment_id, 0, data)
+    except redis.exceptions.ResponseError as err:
+        # The payment has been moved by a concurrent request
+        if not str(err).startswith("BUSYKEY"):
+            raise
+    legacy_db.delete(order_id)
 
-# Run close_db_connection function when service ends
-atexit.register(close_db_connection)
 
+def transaction_key(user_id: str, txn_id: str) -> str:
+    """
+    Retrieve the key of the tombstone of a cancelled payment transaction, in the same shard of the user.
 
-# Retrieve DB from item_id
-def get_db(item_id: str):
+    :param user_id: The id of the user.
+    :param txn_id: The id of the transaction, e.g. the id of the checkout of an order.
+    :return: The transaction key.
     """
-    Retrieve the DB where the item_id is stored.
-    :param item_id: The item id.
-    :return: The db connection.
+    return f"{user_id}:txn:{txn_id}"
+
+
+def script_error_response(result, user_id: str, order_id: str, txn_id: str = None):
     """
-    item_id_bytes = int(item_id.split(":")[1])
-    db_idx = item_id_bytes % MODULO_HASH
+    Convert the failed result of a payment script to the corresponding error response.
 
-    return db_shards[db_idx]
+    :param result: The result of the script.
+    :param user_id: The id of the user.
+    :param order_id: The id of the order.
+    :param txn_id: The id of the transaction, if any.
+    :return: The error response.
+    """
+    if result[0] == SCRIPT_USER_NOT_FOUND:
+        return Response(f"The user {user_id} does not exist in the DB!", status=404)
+    if result[0] == SCRIPT_INSUFFICIENT_CREDIT:
+        return Response(f"Insufficient credit balance", status=400)
+    if result[0] == SCRIPT_ALREADY_PAID:
+        return Response(f"The order {order_id} has been paid already!", status=400)
+    if result[0] == SCRIPT_PAYMENT_NOT_FOUND:
+        return Response(f"The payment for order {order_id} does not exist in the DB!", status=404)
+    if result[0] == SCRIPT_TRANSACTION_CANCELLED:
+        return Response(f"The payment transaction {txn_id} has been cancelled already!", status=400)
+    # A distinct status, so the callers can tell a repeated cancellation from a failure
+    return Response(f"The payment for order {order_id} has been cancelled already!", status=409)
 
 
 class User:
@@ -90,11 +135,8 @@ class Payment:
 @app.post('/create_user')
 def create_user():
     # Create new user id
-    new_user_id = f"user:{random.getrandbits(ID_BYTES_SIZE)}"
+    new_user_id = allocate_ids("user")[0]
     db = get_db(new_user_id)
-    while db.hget(new_user_id, "user_id"):
-        new_user_id = f"user:{random.getrandbits(ID_BYTES_SIZE)}"
-        db = get_db(new_user_id)
 
     new_user = User(user_id=new_user_id)
 
@@ -110,29 +152,97 @@ def create_user():
     return Response(json.dumps(return_user), mimetype="application/json", status=200)
 
 
+def convert_user(user_id: str, user):
+    """
+    Convert the user from bytes to proper types.
+
+    :param user_id: The id of the user.
+    :param user: The user as returned by the DB.
+    :return: The user as a dictionary.
+    """
+    return {
+        "user_id": user_id,
+        "credit": int(user[b"credit"]),
+    }
+
+
+def user_response(user_id: str, user):
+    """
+    Build the response of a retrieved user.
+
+    :param user_id: The id of the user.
+    :param user: The user as returned by the DB.
+    :return: The user with the proper types, or an error if it does not exist.
+    """
+    if not user:
+        return Response(f"The user {user_id} does not exist in the DB!", status=404)
+
+    return Response(json.dumps(convert_user(user_id, user)), mimetype="application/json", status=200)
+
+
+@app.post('/batch_create_users/<n>/<credit>')
+def batch_create_users(n: int, credit: int):
+    # Check the parameters
+    n, credit = int(n), int(credit)
+    if n <= 0:
+        return Response("The number of users must be > 0!", status=400)
+    if credit < 0:
+        return Response("The credit must be >= 0!", status=400)
+
+    # Create new user ids
+    new_user_ids = allocate_ids("user", n)
+
+    # Store the users with one pipeline per shard
+    try:
+        for db, user_ids in group_by_db(new_user_ids, new_keys=True).items():
+            serialized_transaction = db.pipeline(transaction=False)
+            for user_id in user_ids:
+                new_user = User(user_id=user_id)
+                new_user.credit = credit
+                serialized_transaction.hset(user_id, mapping=new_user.to_dict())
+            serialized_transaction.execute()
+    except Exception as exp:
+        return Response(str(exp), status=400)
+
+    return_users = {
+        "user_ids": new_user_ids
+    }
+
+    return Response(json.dumps(return_users), mimetype="application/json", status=200)
+
+
 @app.get('/find_user/<user_id>')
 def find_user(user_id: str):
-    db = get_db(user_id)
+    db = get_read_db(user_id)
+
+    if LOCK_FREE_READS:
+        # HGETALL is atomic and every write of the user is atomic, so it always returns a consistent user
+        return user_response(user_id, db.hgetall(user_id))
 
     # Lock the user
-    user_lock = Redlock(key=user_id, masters={db}, auto_release_time=LOCK_AUTORELEASE_TIME)
+    with locked(LeaseLock(user_id, db)) as acquired:
+        if not acquired:
+            return Response(f"The user {user_id} is locked, try later", status=400)
 
-    if user_lock.acquire():
-        user = db.hgetall(user_id)
+        return user_response(user_id, db.hgetall(user_id))
 
-        if not user:
-            user_lock.release()
-            return Response(f"The user {user_id} does not exist in the DB!", status=404)
 
-        return_user = {
-            "user_id": user_id,
-            "credit": int(user[b"credit"]),
-        }
+@app.post('/find_batch')
+def find_users_batch():
+    # The body is the list of user ids to retrieve
+    user_ids = request.get_json(silent=True)
+    if not isinstance(user_ids, list) or not all(isinstance(user_id, str) for user_id in user_ids):
+        return Response("The body must be a list of user ids!", status=400)
 
-        user_lock.release()
-        return Response(json.dumps(return_user), mimetype="application/json", status=200)
-    else:
-        return Response(f"The user {user_id} is locked, try later", status=400)
+    # Read the users with one pipeline per shard
+    try:
+        users = hgetall_many(user_ids)
+    except Exception as err:
+        return Response(str(err), status=400)
+
+    return_users = {user_id: convert_user(user_id, user) for user_id, user in users.items()}
+
+    return Response(json.dumps(return_users), mimetype="application/json", status=200)
 
 
 @app.post('/add_funds/<user_id>/<amount>')
@@ -143,16 +253,16 @@ def add_credit(user_id: str, amount: int):
     
     db = get_db(user_id)
 
-    user_lock = Redlock(key=user_id, masters={db}, auto_release_time=LOCK_AUTORELEASE_TIME)
-    if user_lock.acquire():
+    with locked(LeaseLock(user_id, db)) as acquired:
+        if not acquired:
+            return Response(f"The user {user_id} is locked, try later", status=400)
+
         if not db.hget(user_id, "user_id"):
-            user_lock.release()
             return Response(f"The user {user_id} does not exist in the DB!", status=404)
 
         try:
             new_amount = db.hincrby(user_id, "credit", amount)
         except Exception as err:
-            user_lock.release()
             return Response("FUND FAILED : " + str(err), status=400)
 
         body = {
@@ -160,164 +270,191 @@ def add_credit(user_id: str, amount: int):
             "message": f"The new credit for user {user_id} is {new_amount}"
         }
 
-        user_lock.release()
         return Response(json.dumps(body), mimetype="application/json", status=200)
-    else:
-        return Response(f"The user {user_id} is locked, try later", status=400)
 
 
-@app.post('/pay/<user_id>/<order_id>/<amount>')
-def remove_credit(user_id: str, order_id: str, amount: int):
+@app.post('/pay/<user_id>/<order_id>/<amount>', defaults={"txn_id": None})
+@app.post('/pay/<user_id>/<order_id>/<amount>/<txn_id>')
+def remove_credit(user_id: str, order_id: str, amount: int, txn_id: str):
     # Check the amount
     amount = int(amount)
     if amount <= 0:
         return Response("The amount must be > 0!", status=400)
     
-    db = get_db(user_id)
+    payment_id = payment_key(user_id, order_id)
+    txn_keys = [transaction_key(user_id, txn_id)] if txn_id else []
+    db = get_db(user_id, payment_id, *txn_keys)
+    if LEGACY_PAYMENTS:
+        move_legacy_payment(user_id, order_id, db)
+
+    if USE_SCRIPTS:
+        try:
+            result = pay_script(keys=[user_id, payment_id, *txn_keys],
+                                args=[amount, order_id, txn_id] if txn_id else [amount, order_id], client=db)
+        except Exception as err:
+            return Response(str(err), status=400)
+
+        if result[0] != SCRIPT_OK:
+            return script_error_response(result, user_id, order_id, txn_id)
+        return Response(f"The payment of the order {order_id} is paid", status=200)
 
-    user_lock = Redlock(key=user_id, masters={db}, auto_release_time=LOCK_AUTORELEASE_TIME)
-    order_lock = Redlock(key=order_id, masters={db}, auto_release_time=LOCK_AUTORELEASE_TIME)
+    with locked(LeaseLock(user_id, db), LeaseLock(order_id, db)) as acquired:
+        if not acquired:
+            return Response(f"Not able to acquire locks for {order_id} and/or {user_id}, try later", status=400)
+
+        # A cancelled transaction is never paid, also when its payment arrives after the cancellation
+        if txn_id and db.exists(*txn_keys):
+            return script_error_response([SCRIPT_TRANSACTION_CANCELLED], user_id, order_id, txn_id)
 
-    if user_lock.acquire() and order_lock.acquire():
         # Check if the user exists
         if not db.hget(user_id, "user_id"):
-            user_lock.release()
-            order_lock.release()
             return Response(f"The user {user_id} does not exist in the DB!", status=404)
 
+        # A retry of the transaction that paid the order is successful without paying again
+        if txn_id and db.hmget(payment_id, "status", "txn_id") == [b"True", txn_id.encode("utf-8")]:
+            return Response(f"The payment of the order {order_id} is paid", status=200)
+
         # Check if the user has enough credit
         current_credit = int(db.hget(user_id, "credit"))
         if current_credit < amount:
             return Response(f"Insufficient credit balance", status=400)
 
         # Check if the orders been paid already
-        order_payment = db.hgetall(order_id)
-
-        # Create payment instance for the order if it does not exists yet
-        if not order_payment:
-            order_payment = Payment(
-                order_id=order_id,
-                amount=amount,
-                status=False
-            )
-
-            try:
-                db.hset(order_payment.order_id, mapping=order_payment.to_dict())
-            except Exception as exp:
-                user_lock.release()
-                order_lock.release()
-                return Response(str(exp), status=400)
-        else:
-            order_payment = Payment(
-                order_id=order_id,
-                amount=amount,
-                status=order_payment[b"status"].decode("utf-8") == "True"
-            )
-
-        if order_payment.status:
-            user_lock.release()
-            order_lock.release()
+        if db.hget(payment_id, "status") == b"True":
             return Response(f"The order {order_id} has been paid already!", status=400)
 
-        # Proceed with completing the payment
+        # Proceed with completing the payment, storing the amount paid now also over a cancelled payment of the order,
+        # and remembering the transaction that paid the order
+        order_payment = Payment(
+            order_id=order_id,
+            amount=amount,
+            status=True
+        )
         try:
             serialized_transaction = db.pipeline()
             serialized_transaction.hincrby(user_id, "credit", -1 * amount)
-            serialized_transaction.hset(order_id, "status", "True")
+            serialized_transaction.hset(payment_id, mapping=order_payment.to_dict())
+            if txn_id:
+                serialized_transaction.hset(payment_id, "txn_id", txn_id)
+            else:
+                serialized_transaction.hdel(payment_id, "txn_id")
             serialized_transaction.execute()
         except Exception as err:
-            user_lock.release()
-            order_lock.release()
             return Response(str(err), status=400)
-        
-        user_lock.release()
-        order_lock.release()
+
         return Response(f"The payment of the order {order_id} is paid", status=200)
-    else:
-        return Response(f"Not able to acquire locks for {order_id} and/or {user_id}, try later", status=400)
 
 
-@app.post('/cancel/<user_id>/<order_id>')
-def cancel_payment(user_id: str, order_id: str):
-    db = get_db(user_id)
+@app.post('/cancel/<user_id>/<order_id>', defaults={"txn_id": None})
+@app.post('/cancel/<user_id>/<order_id>/<txn_id>')
+def cancel_payment(user_id: str, order_id: str, txn_id: str):
+    payment_id = payment_key(user_id, order_id)
+    txn_keys = [transaction_key(user_id, txn_id)] if txn_id else []
+    db = get_db(user_id, payment_id, *txn_keys)
+    if LEGACY_PAYMENTS:
+        move_legacy_payment(user_id, order_id, db)
+
+    if USE_SCRIPTS:
+        try:
+            result = cancel_script(keys=[user_id, payment_id, *txn_keys],
+                                   args=[TRANSACTION_TTL, txn_id] if txn_id else [], client=db)
+        except Exception as err:
+            return Response(str(err), status=400)
+
+        if result[0] != SCRIPT_OK:
+            return script_error_response(result, user_id, order_id, txn_id)
+        return Response(f"The payment of the order {order_id} has been cancelled and the current credit for user "
+                        f"{user_id} is {result[1]}", status=200)
 
-    user_lock = Redlock(key=user_id, masters={db}, auto_release_time=LOCK_AUTORELEASE_TIME)
-    order_lock = Redlock(key=order_id, masters={db}, auto_release_time=LOCK_AUTORELEASE_TIME)
+    with locked(LeaseLock(user_id, db), LeaseLock(order_id, db)) as acquired:
+        if not acquired:
+            return Response(f"Not able to acquire locks for {order_id} and/or {user_id}, try later", status=400)
 
-    if user_lock.acquire() and order_lock.acquire():
         # Check if user exists
         if not db.hget(user_id, "user_id"):
-            user_lock.release()
-            order_lock.release()
             return Response(f"The user {user_id} does not exist in the DB!", status=404)
 
+        # The transaction is cancelled in any case, so a late payment of it is ignored
+        if txn_id:
+            db.set(transaction_key(user_id, txn_id), "cancelled", px=TRANSACTION_TTL)
+
         # Check if the payment order exists
-        if not db.hget(order_id, "order_id"):
-            user_lock.release()
-            order_lock.release()
+        if not db.hget(payment_id, "order_id"):
             return Response(f"The payment for order {order_id} does not exist in the DB!", status=404)
 
         # Retrieve information from the database about the order payment
-        order_payment = db.hgetall(order_id)
+        order_payment = db.hgetall(payment_id)
+        paid_txn_id = order_payment.get(b"txn_id")
         order_payment = {
             "order_id": order_id,
             "amount": int(order_payment[b"amount"]),
             "status": order_payment[b"status"].decode("utf-8") == "True"
         }
 
-        if not order_payment["status"]:
-            user_lock.release()
-            order_lock.release()
-            return Response(f"The payment for order {order_id} has been cancelled already!", status=400)
+        # Only the payment of the transaction is refunded, not a later payment of the order
+        if not order_payment["status"] or (txn_id and paid_txn_id and paid_txn_id != txn_id.encode("utf-8")):
+            return Response(f"The payment for order {order_id} has been cancelled already!", status=409)
 
         # Invalidate the payment and reimburse the user
         try:
             serialized_transaction = db.pipeline()
-            new_credit = serialized_transaction.hincrby(user_id, "credit", order_payment["amount"])
-            serialized_transaction.hset(order_id, "status", "False")
-            serialized_transaction.execute()
+            serialized_transaction.hincrby(user_id, "credit", order_payment["amount"])
+            serialized_transaction.hset(payment_id, "status", "False")
+            new_credit, _ = serialized_transaction.execute()
         except Exception as err:
-            user_lock.release()
-            order_lock.release()    
             return Response(str(err), status=400)
-        
-        user_lock.release()
-        order_lock.release()
+
         return Response(f"The payment of the order {order_id} has been cancelled and the current credit for user {user_id} is {new_credit}", status=200)
-    else:
-        return Response(f"Not able to acquire locks for {order_id} and/or {user_id}, try later", status=400)
 
 
 @app.post('/status/<user_id>/<order_id>')
 def payment_status(user_id: str, order_id: str):
-    db = get_db(user_id)
-    
-    user_lock = Redlock(key=user_id, masters={db}, auto_release_time=LOCK_AUTORELEASE_TIME)
-    order_lock = Redlock(key=order_id, masters={db}, auto_release_time=LOCK_AUTORELEASE_TIME)
+    payment_id = payment_key(user_id, order_id)
+    db = get_db(user_id, payment_id)
+    if LEGACY_PAYMENTS:
+        move_legacy_payment(user_id, order_id, db)
+
+    if USE_SCRIPTS:
+        try:
+            result = status_script(keys=[user_id, payment_id], client=db)
+        except Exception as err:
+            return Response(str(err), status=400)
+
+        if result[0] != SCRIPT_OK:
+            return script_error_response(result, user_id, order_id)
+        return {
+            "paid": bool(result[1])
+        }
+
+    with locked(LeaseLock(user_id, db), LeaseLock(order_id, db)) as acquired:
+        if not acquired:
+            return Response(f"Not able to acquire locks for {order_id} and/or {user_id}, try later", status=400)
 
-    if user_lock.acquire() and order_lock.acquire():
         # Check if user exists
         if not db.hget(user_id, "user_id"):
-            user_lock.release()
-            order_lock.release()
             return Response(f"The user {user_id} does not exist in the DB!", status=404)
 
         # Check if the payment order exists
-        if not db.hget(order_id, "order_id"):
-            user_lock.release()
-            order_lock.release()
+        if not db.hget(payment_id, "order_id"):
             return Response(f"The payment for order {order_id} does not exist in the DB!", status=404)
 
-        order_payment = db.hgetall(order_id)
+        order_payment = db.hgetall(payment_id)
         order_payment = {
             "order_id": order_id,
             "amount": int(order_payment[b"amount"]),
             "status": order_payment[b"status"].decode("utf-8") == "True"
         }
-        user_lock.release()
-        order_lock.release()
         return {
             "paid": order_payment["status"]
         }
-    else:
-        return Response(f"Not able to acquire locks for {order_id} and/or {user_id}, try later", status=400)
+
+
+@app.get('/locks')
+def list_locks():
+    # The locks held in the DB of the service, by any process
+    return Response(json.dumps(held_locks()), mimetype="application/json", status=200)
+
+
+# Execute the commands sent to the service over the bus, when the order service calls the services through it
+if SAGA_TRANSPORT == "streams":
+    start_consumers(app, "payment")
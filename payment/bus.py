@@ -0,0 +1,397 @@
+"""
+Message bus between the services over Redis Streams.
+The order service sends its requests to the stock and payment services as commands appended to the stream
+bus:<service>:commands, instead of proxied HTTP requests. The consumer group of each service executes the commands
+with the same routes of the HTTP API and appends the response to the reply stream of the requesting process.
+
+The same module is copied in every service: the order service uses StreamClient, the other services start_consumers.
+The services also notify each other of events with Redis pub/sub, e.g. the stock service publishes the restocked
+items on STOCK_RESTOCKED.
+"""
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+import redis
+
+BUS_REDIS_HOST = os.environ.get('BUS_REDIS_HOST')
+# The transport of the calls of the order service to the other services: http or streams, the stock and payment
+# services only consume the commands of the bus with streams
+SAGA_TRANSPORT = os.environ.get('SAGA_TRANSPORT', 'http')
+# Seconds a request waits for its reply, the consumers skip the commands found after it, as a best effort
+BUS_TIMEOUT = float(os.environ.get('BUS_TIMEOUT', 30))
+# Approximate maximum length of the command streams
+BUS_MAX_LENGTH = int(os.environ.get('BUS_MAX_LENGTH', 100000))
+# Number of consumer threads of a service
+BUS_CONSUMERS = int(os.environ.get('BUS_CONSUMERS', 4))
+# Milliseconds a consumer blocks waiting for new commands
+BUS_BLOCK_TIME = int(os.environ.get('BUS_BLOCK_TIME', 1000))
+# Milliseconds after which a command read by a consumer that did not acknowledge it is claimed by another consumer
+BUS_CLAIM_IDLE = int(os.environ.get('BUS_CLAIM_IDLE', 10000))
+# Seconds the reply stream of a process is kept after its last reply
+REPLY_STREAM_TTL = 3600
+
+CONSUMER_GROUP = "consumers"
+
+# Channel of the ids of the items whose stock has been increased, as a JSON list
+STOCK_RESTOCKED = "bus:stock:restocked"
+
+bus = redis.Redis(host=BUS_REDIS_HOST,
+                  port=int(os.environ.get('BUS_REDIS_PORT', 6379)),
+                  password=os.environ.get('BUS_REDIS_PASSWORD'),
+                  db=int(os.environ.get('BUS_REDIS_DB', 0))) if BUS_REDIS_HOST else None
+
+if SAGA_TRANSPORT == "streams" and bus is None:
+    raise RuntimeError("SAGA_TRANSPORT=streams needs a bus, set BUS_REDIS_HOST.")
+
+
+def command_stream(service: str) -> str:
+    """
+    Retrieve the stream of the commands of a service.
+
+    :param service: The name of the service, e.g. stock.
+    :return: The stream key.
+    """
+    return f"bus:{service}:commands"
+
+
+def encode_body(body) -> str:
+    """
+    Encode the JSON body of a command.
+
+    :param body: The body, or None.
+    :return: The encoded body, empty if there is no body.
+    """
+    return json.dumps(body) if body is not None else ""
+
+
+class StreamResponse:
+    """
+    Response of a command, with the fields of requests.Response used by the callers.
+    """
+
+    def __init__(self, status_code: int, content: bytes):
+        self.status_code = status_code
+        self.content = content
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class ReplyDispatcher:
+    """
+    Reads the reply stream of the process and hands every reply to the request waiting for it.
+    """
+
+    def __init__(self):
+        self.stream = f"bus:replies:{socket.gethostname()}-{os.getpid()}"
+        self.lock = threading.Lock()
+        self.waiting = {}
+        self.thread = None
+
+    def register(self, request_id: str) -> dict:
+        """
+        Register a request before its command is sent, starting the dispatcher if needed.
+
+        :param request_id: The id of the request.
+        :return: The slot where the reply is delivered, its "event" is set when the reply arrives.
+        """
+        slot = {"event": threading.Event(), "reply": None}
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.waiting[request_id] = slot
+
+        return slot
+
+    def unregister(self, request_id: str):
+        with self.lock:
+            self.waiting.pop(request_id, None)
+
+    def run(self):
+        # Read from the start, a reply can arrive before the first read. The replies of a previous process with the
+        # same name are not waited for, they are just deleted.
+        last_id = "0-0"
+        while True:
+            try:
+                streams = bus.xread({self.stream: last_id}, block=BUS_BLOCK_TIME)
+                for entry_id, fields in (streams[0][1] if streams else []):
+                    last_id = entry_id
+                    with self.lock:
+                        slot = self.waiting.pop(fields[b"id"].decode("utf-8"), None)
+                    if slot is not None:
+                        slot["reply"] = fields
+                        slot["event"].set()
+                    bus.xdel(self.stream, entry_id)
+            except Exception as err:
+                print(f"Reply dispatcher failed: {err}")
+                time.sleep(1)
+
+
+reply_dispatcher = ReplyDispatcher()
+
+
+class StreamClient:
+    """
+    Client of one service over the bus, with the same interface and metrics of the HTTP ServiceClient.
+    """
+
+    def __init__(self, service: str):
+        self.service = service
+        self.stream = command_stream(service)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+
+    def request(self, method: str, path: str, json=None, timeout: float = BUS_TIMEOUT, **kwargs) -> StreamResponse:
+        """
+        Send a request to the service as a command and wait for its reply.
+
+        :param method: The HTTP method of the route.
+        :param path: The path of the route.
+        :param json: The JSON body of the request, if any.
+        :param timeout: The seconds to wait for the reply.
+        :return: The response of the service.
+        """
+        request_id = uuid.uuid4().hex
+        slot = reply_dispatcher.register(request_id)
+
+        with self.lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            self.requests += 1
+
+        try:
+            bus.xadd(self.stream, {
+                "id": request_id,
+                "reply_to": reply_dispatcher.stream,
+                "deadline": time.time() + timeout,
+                "method": method,
+                "path": path,
+                "body": encode_body(json),
+            }, maxlen=BUS_MAX_LENGTH, approximate=True)
+
+            if not slot["event"].wait(timeout):
+                with self.lock:
+                    self.timeouts += 1
+                raise TimeoutError(f"No reply from the {self.service} service to {method} {path}")
+
+            return StreamResponse(int(slot["reply"][b"status"]), slot["reply"][b"body"])
+        except redis.RedisError:
+            with self.lock:
+                self.errors += 1
+            raise
+        finally:
+            reply_dispatcher.unregister(request_id)
+            with self.lock:
+                self.in_flight -= 1
+
+    def get(self, path: str, **kwargs) -> StreamResponse:
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> StreamResponse:
+        return self.request("POST", path, **kwargs)
+
+    def stats(self) -> dict:
+        """
+        Retrieve the metrics of the client.
+
+        :return: The metrics as a dictionary.
+        """
+        with self.lock:
+            return {
+                "stream": self.stream,
+                "in_flight": self.in_flight,
+                "peak_in_flight": self.peak_in_flight,
+                "requests": self.requests,
+                "errors": self.errors,
+                "timeouts": self.timeouts,
+            }
+
+
+def send_reply(fields, status_code: int, body: bytes):
+    """
+    Append the response of a command to the reply stream of the requester.
+
+    :param fields: The fields of the command.
+    :param status_code: The status code of the response.
+    :param body: The body of the response.
+    """
+    reply_to = fields[b"reply_to"].decode("utf-8")
+    serialized_transaction = bus.pipeline()
+    serialized_transaction.xadd(reply_to, {"id": fields[b"id"], "status": status_code, "body": body})
+    serialized_transaction.expire(reply_to, REPLY_STREAM_TTL)
+    serialized_transaction.execute()
+
+
+def execute_command(client, fields):
+    """
+    Execute a command with the routes of the service and append the response to the reply stream of the requester.
+    A command that fails to execute is answered with a 500, so the requester does not wait for its timeout.
+    The commands whose requester stopped waiting are skipped to save the work, but the deadline is set by the clock of
+    another host, so a late command may still run after the requester gave up. A late command is harmless because of
+    the transaction of the checkout attempt, not of the deadline: the stock and the payment of a cancelled transaction
+    are not taken anymore.
+
+    :param client: The test client of the Flask app of the service.
+    :param fields: The fields of the command.
+    """
+    if float(fields[b"deadline"]) < time.time():
+        return
+
+    try:
+        body = fields[b"body"]
+        response = client.open(fields[b"path"].decode("utf-8"), method=fields[b"method"].decode("utf-8"),
+                               data=body, content_type="application/json" if body else None)
+        status_code, content = response.status_code, response.get_data()
+    except Exception as err:
+        print(f"Bus command {fields.get(b'method')} {fields.get(b'path')} failed: {err}")
+        status_code, content = 500, f"The command failed: {err}".encode("utf-8")
+
+    send_reply(fields, status_code, content)
+
+
+def acknowledge(stream: str, entry_id):
+    """
+    Acknowledge a command and delete it from the stream.
+
+    :param stream: The command stream.
+    :param entry_id: The id of the command.
+    """
+    serialized_transaction = bus.pipeline()
+    serialized_transaction.xack(stream, CONSUMER_GROUP, entry_id)
+    serialized_transaction.xdel(stream, entry_id)
+    serialized_transaction.execute()
+
+
+def create_group(stream: str):
+    """
+    Create the consumer group of a command stream, if it does not exist yet.
+
+    :param stream: The command stream.
+    """
+    try:
+        bus.xgroup_create(stream, CONSUMER_GROUP, id="0", mkstream=True)
+    except redis.exceptions.ResponseError as err:
+        if "BUSYGROUP" not in str(err):
+            raise
+
+
+def run_consumer(app, stream: str, consumer: str):
+    """
+    Execute the commands of the stream of a service forever.
+    A command is acknowledged only once it is answered, the commands of a consumer that died or could not reply are
+    claimed by another consumer after BUS_CLAIM_IDLE, and skipped if their requester stopped waiting meanwhile.
+
+    :param app: The Flask app of the service.
+    :param stream: The command stream of the service.
+    :param consumer: The name of the consumer in the consumer group.
+    """
+    client = app.test_client()
+    group_created = False
+    while True:
+        try:
+            if not group_created:
+                create_group(stream)
+                group_created = True
+
+            # Claim the abandoned commands first, then wait for new ones
+            _, entries, *_ = bus.xautoclaim(stream, CONSUMER_GROUP, consumer, min_idle_time=BUS_CLAIM_IDLE, count=10)
+            if not entries:
+                streams = bus.xreadgroup(CONSUMER_GROUP, consumer, {stream: ">"}, count=10, block=BUS_BLOCK_TIME)
+                entries = streams[0][1] if streams else []
+
+            for entry_id, fields in entries:
+                # An entry deleted after it was read has no fields, only its acknowledgement is missing. A reply that
+                # cannot be sent raises, the command stays pending until it is claimed again.
+                if fields:
+                    execute_command(client, fields)
+                acknowledge(stream, entry_id)
+        except Exception as err:
+            # The group is created again in case the bus lost it, e.g. after a restart
+            group_created = False
+            print(f"Bus consumer {consumer} failed: {err}")
+            time.sleep(1)
+
+
+def start_consumers(app, service: str, consumers: int = BUS_CONSUMERS) -> list:
+    """
+    Start the consumer threads that execute the commands sent to a service over the bus.
+
+    :param app: The Flask app of the service.
+    :param service: The name of the service, e.g. stock.
+    :param consumers: The number of consumer threads.
+    :return: The started threads.
+    """
+    stream = command_stream(service)
+    threads = []
+    for consumer_idx in range(consumers):
+        consumer = f"{socket.gethostname()}-{os.getpid()}-{consumer_idx}"
+        thread = threading.Thread(target=run_consumer, args=(app, stream, consumer), daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    return threads
+
+
+def publish(channel: str, message: str):
+    """
+    Publish an event, if a bus is configured. An event that cannot be published is dropped, the subscribers must
+    tolerate it, e.g. with a TTL on what they derive from the events.
+
+    :param channel: The channel of the event.
+    :param message: The message of the event.
+    """
+    if bus is None:
+        return
+
+    try:
+        bus.publish(channel, message)
+    except redis.RedisError as err:
+        print(f"Failed to publish on {channel}: {err}")
+
+
+def run_subscriber(channel: str, handler):
+    """
+    Hand every event of a channel to the handler forever, subscribing again after a failure.
+
+    :param channel: The channel of the events.
+    :param handler: The function called with the message of every event.
+    """
+    while True:
+        try:
+            pubsub = bus.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(channel)
+            for message in pubsub.listen():
+                if message["type"] == "message":
+                    handler(message["data"].decode("utf-8"))
+        except Exception as err:
+            print(f"Subscriber of {channel} failed: {err}")
+            time.sleep(1)
+
+
+def subscribe(channel: str, handler):
+    """
+    Start the thread that handles the events of a channel, if a bus is configured.
+
+    :param channel: The channel of the events.
+    :param handler: The function called with the message of every event.
+    :return: The started thread, None without a bus.
+    """
+    if bus is None:
+        return None
+
+    thread = threading.Thread(target=run_subscriber, args=(channel, handler), daemon=True)
+    thread.start()
+    return thread
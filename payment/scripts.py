@@ -0,0 +1,104 @@
+"""
+Server-side Lua scripts for the payment operations.
+The user and the payments of the user's orders are stored in the same shard, so each script checks and
+updates them atomically in a single round trip, without distributed locks.
+
+The scripts return a list whose first element is the status of the execution, followed by its result:
+- SCRIPT_OK: the operation is successful.
+- SCRIPT_USER_NOT_FOUND: the user does not exist.
+- SCRIPT_INSUFFICIENT_CREDIT: the user does not have enough credit, list[1] is the current credit.
+- SCRIPT_ALREADY_PAID: the order has been paid already.
+- SCRIPT_PAYMENT_NOT_FOUND: there is no payment for the order.
+- SCRIPT_ALREADY_CANCELLED: the payment of the order has been cancelled already.
+- SCRIPT_TRANSACTION_CANCELLED: the transaction of the payment has been cancelled, it is not paid anymore.
+"""
+
+SCRIPT_OK = 0
+SCRIPT_USER_NOT_FOUND = 1
+SCRIPT_INSUFFICIENT_CREDIT = 2
+SCRIPT_ALREADY_PAID = 3
+SCRIPT_PAYMENT_NOT_FOUND = 4
+SCRIPT_ALREADY_CANCELLED = 5
+SCRIPT_TRANSACTION_CANCELLED = 6
+
+# KEYS: [user_id, payment key of the order, tombstone key of the transaction (optional)],
+# ARGV: [amount, order_id, transaction id (optional)]
+# Pays the order once per transaction: a retry of the transaction that paid the order is successful without paying
+# again, and a cancelled transaction is never paid. Returns the new credit of the user.
+PAY = """
+if KEYS[3] and redis.call('EXISTS', KEYS[3]) == 1 then
+    return {6}
+end
+
+local credit = redis.call('HGET', KEYS[1], 'credit')
+if not credit then
+    return {1}
+end
+
+local payment = redis.call('HMGET', KEYS[2], 'status', 'txn_id')
+if payment[1] == 'True' then
+    if ARGV[3] and payment[2] == ARGV[3] then
+        return {0, tonumber(credit)}
+    end
+    return {3}
+end
+
+local amount = tonumber(ARGV[1])
+if tonumber(credit) < amount then
+    return {2, tonumber(credit)}
+end
+
+local new_credit = redis.call('HINCRBY', KEYS[1], 'credit', -amount)
+redis.call('HSET', KEYS[2], 'order_id', ARGV[2], 'amount', amount, 'status', 'True')
+if ARGV[3] then
+    redis.call('HSET', KEYS[2], 'txn_id', ARGV[3])
+else
+    redis.call('HDEL', KEYS[2], 'txn_id')
+end
+return {0, new_credit}
+"""
+
+# KEYS: [user_id, payment key of the order, tombstone key of the transaction (optional)],
+# ARGV: [the ttl of the tombstone in ms, transaction id (optional)]
+# With a transaction, only its own payment is refunded, and the transaction is always marked as cancelled, so a late
+# payment of the same transaction is ignored. Returns the new credit of the user.
+CANCEL = """
+if redis.call('HEXISTS', KEYS[1], 'user_id') == 0 then
+    return {1}
+end
+
+if KEYS[3] then
+    redis.call('SET', KEYS[3], 'cancelled', 'PX', ARGV[1])
+end
+
+local payment = redis.call('HMGET', KEYS[2], 'amount', 'status', 'txn_id')
+if not payment[1] then
+    return {4}
+end
+
+if payment[2] ~= 'True' or (ARGV[2] and payment[3] and payment[3] ~= ARGV[2]) then
+    return {5}
+end
+
+local new_credit = redis.call('HINCRBY', KEYS[1], 'credit', tonumber(payment[1]))
+redis.call('HSET', KEYS[2], 'status', 'False')
+return {0, new_credit}
+"""
+
+# KEYS: [user_id, payment key of the order]
+# Returns 1 if the order is paid, 0 otherwise.
+STATUS = """
+if redis.call('HEXISTS', KEYS[1], 'user_id') == 0 then
+    return {1}
+end
+
+local status = redis.call('HGET', KEYS[2], 'status')
+if not status then
+    return {4}
+end
+
+if status == 'True' then
+    return {0, 1}
+end
+return {0, 0}
+"""
@@ -0,0 +1,410 @@
+"""
+Shard topology of the service DB and routing of the keys to the shards.
+
+The shards are read from the REDIS_HOSTS environment variable as a comma separated list of hosts,
+or from the numbered REDIS_HOST_0, REDIS_HOST_1, ... variables. Any number of shards is supported.
+
+The keys have the format <type>:<number>[:...] and are routed by their number modulo the number of shards, as in the
+first versions. With SHARD_HASH=jump they are routed with a jump consistent hash of their number instead, so when a
+shard is appended to the list only about 1/N of the keys move to the new shard. An existing deployment is switched to
+the jump hash with the online migration below, with OLD_SHARD_HASH=modulo and the same shards in both topologies.
+This module is shared by the order, stock and payment services.
+
+Online migration to a new topology:
+1. Deploy the services with the new topology and the previous one in OLD_REDIS_HOSTS (or OLD_REDIS_HOST_<i>)
+   and OLD_SHARD_HASH. The keys are moved to their new shard when they are written, the reads fall back to the
+   old shard for the keys that have not been moved yet.
+2. Run the migration tool in one of the service containers: python sharding.py migrate
+3. Remove the OLD_ variables once the tool has completed.
+The keys local to a shard that record the state of a transaction for the keys of the shard, e.g. the stock
+reservations, are copied instead of moved: the keys of the transaction may move to different shards or stay.
+"""
+import os
+import sys
+import time
+import atexit
+import logging
+import argparse
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+
+# Hash used to route the keys: "jump" (consistent) or "modulo" (the routing of the first versions)
+SHARD_HASH = os.environ.get('SHARD_HASH', 'modulo')
+OLD_SHARD_HASH = os.environ.get('OLD_SHARD_HASH', 'modulo')
+
+# Prefixes of the keys local to a shard that record the state of a transaction, copied to the new shards by a migration
+TRANSACTION_KEY_PREFIXES = ("reservation:", "allocation:")
+
+# The numbers of the allocated ids start above the random 32 bit ids of the first versions
+ID_OFFSET = 1 << 32
+# Maximum number of shards: the number of an id encodes the shard whose counter allocated it
+ID_STRIDE = 1024
+
+logger = logging.getLogger(__name__)
+
+
+def shard_hosts(prefix: str = "") -> list:
+    """
+    Retrieve the hosts of the shards from the environment.
+
+    :param prefix: The prefix of the environment variables, e.g. "OLD_" for the topology before a migration.
+    :return: The list of hosts, in shard order.
+    """
+    if os.environ.get(f'{prefix}REDIS_HOSTS'):
+        return [host.strip() for host in os.environ[f'{prefix}REDIS_HOSTS'].split(",") if host.strip()]
+
+    hosts = []
+    while os.environ.get(f'{prefix}REDIS_HOST_{len(hosts)}'):
+        hosts.append(os.environ[f'{prefix}REDIS_HOST_{len(hosts)}'])
+
+    return hosts
+
+
+def connect_shards(hosts: list, connections: dict) -> list:
+    """
+    Connect to the given shards, reusing the existing connection of a host.
+
+    :param hosts: The hosts of the shards.
+    :param connections: The connections already opened, by host.
+    :return: The list of db connections, in shard order.
+    """
+    for host in hosts:
+        if host not in connections:
+            connections[host] = redis.Redis(host=host,
+                                            port=int(os.environ['REDIS_PORT']),
+                                            password=os.environ['REDIS_PASSWORD'],
+                                            db=int(os.environ['REDIS_DB']))
+
+    return [connections[host] for host in hosts]
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """
+    Jump consistent hash (Lamping and Veach): map a key to one of the buckets,
+    moving only 1/buckets of the keys when a bucket is added.
+
+    :param key: The key to route.
+    :param buckets: The number of buckets.
+    :return: The bucket of the key, in [0, buckets).
+    """
+    key &= 0xFFFFFFFFFFFFFFFF
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+
+    return b
+
+
+def shard_index(key: str, shards: int, shard_hash: str = SHARD_HASH) -> int:
+    """
+    Retrieve the index of the shard where the key is stored.
+
+    :param key: The key, e.g. item:<number>.
+    :param shards: The number of shards.
+    :param shard_hash: The hash used to route the keys.
+    :return: The shard index.
+    """
+    key_number = int(key.split(":")[1])
+    if shard_hash == "modulo":
+        return key_number % shards
+
+    return jump_hash(key_number, shards)
+
+
+def is_routable(key: str) -> bool:
+    """
+    Check if a key is routed by its number. The other keys, e.g. the locks, are local to their shard.
+
+    :param key: The key.
+    :return: True if the key is routed to a shard by its number.
+    """
+    parts = key.split(":")
+    return len(parts) > 1 and parts[1].isdigit()
+
+
+# Connect to the shards
+connections = {}
+db_shards = connect_shards(shard_hosts(), connections)
+old_db_shards = connect_shards(shard_hosts("OLD_"), connections)
+
+
+def close_db_connection():
+    """
+    Close the DB connection
+    """
+    for db in connections.values():
+        db.close()
+
+
+# Run close_db_connection function when service ends
+atexit.register(close_db_connection)
+
+
+def get_old_db(key: str):
+    """
+    Retrieve the DB where the key was stored before the migration.
+
+    :param key: The key, e.g. item:<number>.
+    :return: The db connection, None if no migration is in progress.
+    """
+    if not old_db_shards:
+        return None
+
+    return old_db_shards[shard_index(key, len(old_db_shards), OLD_SHARD_HASH)]
+
+
+def move_keys(keys: list, old_db, new_db, delete: bool = True) -> int:
+    """
+    Move the given keys from their old shard to their new shard with DUMP and RESTORE.
+    A key already present in the new shard has been moved already, its old copy is only deleted.
+
+    :param keys: The keys to move.
+    :param old_db: The db connection of the old shard.
+    :param new_db: The db connection of the new shard.
+    :param delete: Delete the old copies, False to copy the keys.
+    :return: The number of keys moved.
+    """
+    if not keys:
+        return 0
+
+    serialized_transaction = old_db.pipeline(transaction=False)
+    for key in keys:
+        serialized_transaction.dump(key)
+        serialized_transaction.pttl(key)
+    results = serialized_transaction.execute()
+
+    dumped = [(key, data, ttl) for key, data, ttl in zip(keys, results[0::2], results[1::2]) if data is not None]
+    if not dumped:
+        return 0
+
+    serialized_transaction = new_db.pipeline(transaction=False)
+    for key, data, ttl in dumped:
+        serialized_transaction.restore(key, max(ttl, 0), data)
+    restored = serialized_transaction.execute(raise_on_error=False)
+
+    for result in restored:
+        if isinstance(result, Exception) and not str(result).startswith("BUSYKEY"):
+            raise result
+
+    if delete:
+        old_db.delete(*[key for key, _, _ in dumped])
+
+    return sum(1 for result in restored if not isinstance(result, Exception))
+
+
+def get_db(key: str, *colocated_keys: str):
+    """
+    Retrieve the DB where the key is stored.
+    During a migration the key, and the given keys stored in the same shard, are moved to their new shard first.
+    The given keys local to the shard, e.g. the reservation of a transaction, are copied instead.
+
+    :param key: The key, e.g. item:<number>.
+    :param colocated_keys: Other keys of the same shard that are written together with the key.
+    :return: The db connection.
+    """
+    db = db_shards[shard_index(key, len(db_shards))]
+
+    old_db = get_old_db(key)
+    if old_db is not None and old_db is not db:
+        keys = [key, *colocated_keys]
+        serialized_transaction = db.pipeline(transaction=False)
+        for k in keys:
+            serialized_transaction.exists(k)
+        missing = [k for k, exists in zip(keys, serialized_transaction.execute()) if not exists]
+        if missing:
+            move_keys([k for k in missing if is_routable(k)], old_db, db)
+            move_keys([k for k in missing if not is_routable(k)], old_db, db, delete=False)
+
+    return db
+
+
+def group_by_db(keys, new_keys: bool = False, colocated_keys: tuple = ()) -> dict:
+    """
+    Group the given keys by the DB shard where they are stored.
+
+    :param keys: The keys.
+    :param new_keys: True if the keys have just been allocated, so they cannot be stored in an old shard.
+    :param colocated_keys: Keys local to each shard that are written together with the keys, see get_db.
+    :return: A dictionary mapping each db connection to the list of its keys.
+    """
+    shards = {}
+    for key in keys:
+        db = db_shards[shard_index(key, len(db_shards))] if new_keys else get_db(key, *colocated_keys)
+        shards.setdefault(db, []).append(key)
+
+    return shards
+
+
+def get_read_db(key: str):
+    """
+    Retrieve the DB to read the key from.
+    During a migration the key is read from its old shard if it has not been moved yet.
+
+    :param key: The key, e.g. item:<number>.
+    :return: The db connection.
+    """
+    db = db_shards[shard_index(key, len(db_shards))]
+
+    old_db = get_old_db(key)
+    if old_db is None or old_db is db or db.exists(key):
+        return db
+
+    if old_db.exists(key):
+        return old_db
+
+    # The key has been moved meanwhile, or it does not exist
+    return db
+
+
+# Round robin over the shards to spread the id allocations
+id_counter_shards = itertools.count()
+
+
+def allocate_ids(key_type: str, count: int = 1) -> list:
+    """
+    Allocate new unique ids with a single INCRBY on the id counter of one of the shards.
+    The number of an id is ID_OFFSET + counter * ID_STRIDE + shard index, so the ids allocated by different shards,
+    replicas or processes never collide and no existence check is needed.
+    The shards must only be appended to the topology, never reordered, to keep the counters unique.
+
+    :param key_type: The type of the ids, e.g. item.
+    :param count: The number of ids to allocate.
+    :return: The list of new ids, e.g. item:<number>.
+    """
+    db_idx = next(id_counter_shards) % len(db_shards)
+    last = db_shards[db_idx].incrby(f"id_counter:{key_type}", count)
+
+    return [f"{key_type}:{ID_OFFSET + counter * ID_STRIDE + db_idx}" for counter in range(last - count + 1, last + 1)]
+
+
+# Threads to read the shards in parallel
+shard_executor = ThreadPoolExecutor(max_workers=max(len(connections), 1))
+
+
+def hgetall_shard(db, keys: list) -> dict:
+    """
+    Read the given hashes from one shard with a single pipeline.
+
+    :param db: The db connection of the shard.
+    :param keys: The keys of the hashes.
+    :return: A dictionary mapping each existing key to its hash.
+    """
+    serialized_transaction = db.pipeline(transaction=False)
+    for key in keys:
+        serialized_transaction.hgetall(key)
+
+    return {key: value for key, value in zip(keys, serialized_transaction.execute()) if value}
+
+
+def hgetall_many(keys) -> dict:
+    """
+    Read many hashes with one pipelined HGETALL batch per shard, running on the shards in parallel.
+    During a migration the keys that have not been moved yet are read from their old shard.
+
+    :param keys: The keys of the hashes.
+    :return: A dictionary mapping each existing key to its hash.
+    """
+    shards = {}
+    for key in keys:
+        shards.setdefault(db_shards[shard_index(key, len(db_shards))], []).append(key)
+
+    results = {}
+    for shard_results in shard_executor.map(lambda shard: hgetall_shard(*shard), shards.items()):
+        results.update(shard_results)
+
+    if old_db_shards:
+        old_shards = {}
+        for key in keys:
+            if key not in results:
+                old_shards.setdefault(get_old_db(key), []).append(key)
+        for shard_results in shard_executor.map(lambda shard: hgetall_shard(*shard), old_shards.items()):
+            results.update(shard_results)
+
+        # A key moved between the two reads is missing from both, it is read again from its new shard
+        missing = {}
+        for key in keys:
+            if key not in results:
+                missing.setdefault(db_shards[shard_index(key, len(db_shards))], []).append(key)
+        for shard_results in shard_executor.map(lambda shard: hgetall_shard(*shard), missing.items()):
+            results.update(shard_results)
+
+    return results
+
+
+def migrate(batch_size: int):
+    """
+    Move all the keys of the old topology to their shard in the new topology.
+    The keys are scanned and moved in pipelined batches, the services keep running meanwhile.
+
+    :param batch_size: The number of keys scanned and moved per batch.
+    :return: The number of scanned and moved keys.
+    """
+    scanned = moved = 0
+    start = time.time()
+    for old_db in {id(db): db for db in old_db_shards}.values():
+        batch = []
+        for key in old_db.scan_iter(count=batch_size):
+            batch.append(key.decode("utf-8"))
+            if len(batch) < batch_size:
+                continue
+            moved += migrate_batch(batch, old_db)
+            scanned += len(batch)
+            batch = []
+            elapsed = time.time() - start
+            logger.info(f"Scanned {scanned} keys, moved {moved} keys ({moved / elapsed:.0f} keys/s)")
+
+        moved += migrate_batch(batch, old_db)
+        scanned += len(batch)
+
+    elapsed = time.time() - start
+    logger.info(f"Migration completed: scanned {scanned} keys, moved {moved} keys in {elapsed:.1f}s "
+                f"({moved / max(elapsed, 1e-6):.0f} keys/s)")
+
+    return scanned, moved
+
+
+def migrate_batch(keys: list, old_db) -> int:
+    """
+    Move a batch of keys scanned from an old shard, grouped by their new shard.
+
+    :param keys: The scanned keys.
+    :param old_db: The db connection of the scanned shard.
+    :return: The number of keys moved.
+    """
+    targets = {}
+    copied = []
+    for key in keys:
+        if key.startswith(TRANSACTION_KEY_PREFIXES):
+            copied.append(key)
+        if not is_routable(key):
+            continue
+        new_db = db_shards[shard_index(key, len(db_shards))]
+        if new_db is not old_db:
+            targets.setdefault(new_db, []).append(key)
+
+    # The state of the transactions is copied to every shard, it may be needed by the keys moved there
+    for new_db in {id(db): db for db in db_shards if db is not old_db}.values():
+        move_keys(copied, old_db, new_db, delete=False)
+
+    return sum(move_keys(target_keys, old_db, new_db) for new_db, target_keys in targets.items())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(levelname)s - %(asctime)s - %(name)s - %(message)s',
+                        datefmt='%I:%M:%S')
+
+    parser = argparse.ArgumentParser(description="Shard topology tools.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser("migrate", help="Move the keys from OLD_REDIS_HOSTS to REDIS_HOSTS.")
+    migrate_parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    if not old_db_shards:
+        sys.exit("Set OLD_REDIS_HOSTS (or OLD_REDIS_HOST_<i>) to the topology to migrate from.")
+
+    migrate(args.batch_size)
@@ -14,6 +14,8 @@ helm uninstall stock-db-0
 helm uninstall stock-db-1
 helm uninstall stock-db-2
 
+helm uninstall bus-db
+
 echo "Uninstalling Nginx Chart..."
 helm uninstall nginx
 
@@ -21,4 +23,4 @@ echo "Uninstalling metrics-server Chart..."
 helm uninstall metrics-server
 
 echo "Removing volumes..."
-kubectl delete pvc redis-data-order-db-0-redis-master-0 redis-data-order-db-0-redis-replicas-0 redis-data-order-db-1-redis-master-0 redis-data-order-db-1-redis-replicas-0 redis-data-order-db-2-redis-master-0 redis-data-order-db-2-redis-replicas-0 redis-data-payment-db-0-redis-master-0 redis-data-payment-db-0-redis-replicas-0 redis-data-payment-db-1-redis-master-0 redis-data-payment-db-1-redis-replicas-0 redis-data-payment-db-2-redis-master-0 redis-data-payment-db-2-redis-replicas-0 redis-data-stock-db-0-redis-master-0 redis-data-stock-db-0-redis-replicas-0 redis-data-stock-db-1-redis-master-0 redis-data-stock-db-1-redis-replicas-0 redis-data-stock-db-2-redis-master-0 redis-data-stock-db-2-redis-replicas-0
\ No newline at end of file
+kubectl delete pvc redis-data-order-db-0-redis-master-0 redis-data-order-db-0-redis-replicas-0 redis-data-order-db-1-redis-master-0 redis-data-order-db-1-redis-replicas-0 redis-data-order-db-2-redis-master-0 redis-data-order-db-2-redis-replicas-0 redis-data-payment-db-0-redis-master-0 redis-data-payment-db-0-redis-replicas-0 redis-data-payment-db-1-redis-master-0 redis-data-payment-db-1-redis-replicas-0 redis-data-payment-db-2-redis-master-0 redis-data-payment-db-2-redis-replicas-0 redis-data-stock-db-0-redis-master-0 redis-data-stock-db-0-redis-replicas-0 redis-data-stock-db-1-redis-master-0 redis-data-stock-db-1-redis-replicas-0 redis-data-stock-db-2-redis-master-0 redis-data-stock-db-2-redis-replicas-0 redis-data-bus-db-redis-master-0 redis-data-bus-db-redis-replicas-0
\ No newline at end of file
@@ -16,6 +16,8 @@ helm uninstall stock-db-0
 helm uninstall stock-db-1
 helm uninstall stock-db-2
 
+helm uninstall bus-db
+
 echo "Removing volumes..."
 kubectl delete pvc redis-data-order-db-0-redis-master-0 \
                    redis-data-order-db-0-redis-replicas-0 \
@@ -34,4 +36,6 @@ kubectl delete pvc redis-data-order-db-0-redis-master-0 \
                    redis-data-stock-db-1-redis-master-0 \
                    redis-data-stock-db-1-redis-replicas-0 \
                    redis-data-stock-db-2-redis-master-0 \
-                   redis-data-stock-db-2-redis-replicas-0
\ No newline at end of file
+                   redis-data-stock-db-2-redis-replicas-0 \
+                   redis-data-bus-db-redis-master-0 \
+                   redis-data-bus-db-redis-replicas-0
\ No newline at end of file
@@ -1,66 +1,330 @@
 import json
 import os
-import atexit
-import random
 
-from flask import Flask, Response
-import redis
-from pottery import Redlock
+from flask import Flask, Response, request
 
-RANDOM_SEED = 444
-ID_BYTES_SIZE = 32
-LOCK_AUTORELEASE_TIME = 120
+from bus import SAGA_TRANSPORT, STOCK_RESTOCKED, bus, publish, start_consumers
+from lease_lock import LeaseLock, held_locks, locked
+from sharding import db_shards, get_db, get_read_db, group_by_db, hgetall_many, allocate_ids
+from scripts import ADD_STOCK, SUBTRACT_STOCK, RESERVE_STOCK, RELEASE_STOCK, SCRIPT_OK, SCRIPT_NOT_FOUND
+from item_parts import (SPLIT_ITEMS, MAX_PARTS, add_parts_stock, allocate, allocation_key, read_parts,
+                        replay_transfers, split_item, stock_totals, to_parts)
 
-# Set random seed to generate unique ids for the items
-random.seed(RANDOM_SEED)
+# How long the state of the reservation of a transaction is kept, in milliseconds
+RESERVATION_TTL = int(os.environ.get('RESERVATION_TTL', 7 * 24 * 3600 * 1000))
+
+# Run the stock mutations as atomic server-side scripts instead of locks + multiple round trips
+USE_SCRIPTS = os.environ.get('USE_SCRIPTS', 'False') == 'True'
+# Serve the reads with a single HGETALL without locking the item
+LOCK_FREE_READS = os.environ.get('LOCK_FREE_READS', 'False') == 'True'
+# Attempts of a subtraction of split items, when the chosen parts run out of stock meanwhile
+SPLIT_RETRIES = 3
 
 # Initialize Flask app
 app = Flask("stock-service")
 
-# Connect to DB
-db_0: redis.Redis = redis.Redis(host=os.environ['REDIS_HOST_0'],
-                                port=int(os.environ['REDIS_PORT']),
-                                password=os.environ['REDIS_PASSWORD'],
-                                db=int(os.environ['REDIS_DB']))
+# Register the scripts, they are executed with EVALSHA on the shard passed as client
+add_stock_script = db_shards[0].register_script(ADD_STOCK)
+subtract_stock_script = db_shards[0].register_script(SUBTRACT_STOCK)
+reserve_stock_script = db_shards[0].register_script(RESERVE_STOCK)
+release_stock_script = db_shards[0].register_script(RELEASE_STOCK)
+
+
+def reservation_key(txn_id: str) -> str:
+    """
+    Retrieve the key of the reservation of a transaction, there is one in each shard updated by the transaction.
+
+    :param txn_id: The id of the transaction, e.g. the id of the checkout of an order.
+    :return: The reservation key.
+    """
+    return f"reservation:{txn_id}"
+
+
+def transaction_keys(txn_id: str = None) -> list:
+    """
+    Retrieve the keys of the state of a transaction in the shard of each updated item.
+
+    :param txn_id: The id of the transaction, if any.
+    :return: The reservation key and the allocation key of the transaction, none without transaction.
+    """
+    return [reservation_key(txn_id), allocation_key(txn_id)] if txn_id else []
+
+
+def parse_items(items):
+    """
+    Validate the items dictionary of a batch request.
+
+    :param items: The dictionary of item_id -> amount sent in the request body.
+    :return: The items with integer amounts, or None if the request is not valid.
+    """
+    if not isinstance(items, dict) or not items:
+        return None
+
+    try:
+        items = {item_id: int(amount) for item_id, amount in items.items()}
+    except (TypeError, ValueError):
+        return None
+
+    if any(amount <= 0 for amount in items.values()):
+        return None
+
+    return items
+
+
+def item_locks(item_ids) -> list:
+    """
+    Create the locks of all the given items, sorted so they are always acquired in the same order to avoid deadlocks.
+
+    :param item_ids: The ids of the items to lock.
+    :return: The list of locks, to acquire with locked.
+    """
+    return [LeaseLock(item_id, get_db(item_id)) for item_id in sorted(item_ids)]
+
+
+def read_batch(shards, txn_id: str = None) -> dict:
+    """
+    Read the stock of the items of a batch and the state of the reservation of the transaction, one round trip per shard.
+
+    :param shards: The item ids grouped by db connection.
+    :param txn_id: The id of the transaction, if any.
+    :return: The (reservation state, dictionary of item_id -> stock or None) of each db connection.
+    """
+    result = {}
+    for db, item_ids in shards.items():
+        serialized_transaction = db.pipeline()
+        for item_id in item_ids:
+            serialized_transaction.hget(item_id, "stock")
+        if txn_id:
+            serialized_transaction.get(reservation_key(txn_id))
+        results = serialized_transaction.execute()
+        state = results.pop() if txn_id else None
+        result[db] = (state, {item_id: None if amount is None else int(amount)
+                              for item_id, amount in zip(item_ids, results)})
+
+    return result
+
+
+def apply_batch(shards, items, sign: int, txn_id: str = None):
+    """
+    Apply the stock changes of a batch, one serialized transaction per shard.
+    If one of the shards fails, the changes already applied to the other shards are reverted.
+
+    :param shards: The item ids grouped by db connection.
+    :param items: The dictionary of item_id -> amount.
+    :param sign: 1 to add the amounts to the stock, -1 to subtract them.
+    :param txn_id: The id of the transaction, the reservation is marked as reserved or released with the changes.
+    :return: The new stock amount of each item.
+    """
+    new_amounts = {}
+    applied = []
+    try:
+        for db, item_ids in shards.items():
+            serialized_transaction = db.pipeline()
+            for item_id in item_ids:
+                serialized_transaction.hincrby(item_id, "stock", sign * items[item_id])
+            if txn_id:
+                serialized_transaction.set(reservation_key(txn_id), "reserved" if sign < 0 else "released",
+                                           px=RESERVATION_TTL)
+            results = serialized_transaction.execute()
+            applied.append((db, item_ids))
+            new_amounts.update(zip(item_ids, results))
+    except Exception:
+        revert_batch(applied, items, sign, txn_id)
+        raise
+
+    return new_amounts
+
+
+def revert_batch(applied, items, sign: int, txn_id: str = None):
+    """
+    Revert the stock changes already applied to some shards of a batch.
+
+    :param applied: The list of (db connection, item ids) that have been updated.
+    :param items: The dictionary of item_id -> amount.
+    :param sign: The sign used to apply the changes, 1 if they were added and -1 if they were subtracted.
+    :param txn_id: The id of the transaction, its reservation is reverted as well.
+    """
+    for db, item_ids in applied:
+        serialized_transaction = db.pipeline()
+        for item_id in item_ids:
+            serialized_transaction.hincrby(item_id, "stock", -1 * sign * items[item_id])
+        if txn_id:
+            # A reverted reservation is released, so a late retry of the same transaction is ignored
+            serialized_transaction.set(reservation_key(txn_id), "released" if sign < 0 else "reserved",
+                                       px=RESERVATION_TTL)
+        serialized_transaction.execute()
+
+
+def run_stock_script(items, sign: int, txn_id: str = None):
+    """
+    Apply the stock changes with the atomic server-side scripts, one script execution per shard.
+    If one of the shards fails, the changes already applied to the other shards are reverted.
+
+    :param items: The dictionary of item_id -> amount.
+    :param sign: 1 to add the amounts to the stock, -1 to subtract them.
+    :param txn_id: The id of the transaction, subtracting reserves the stock once and adding releases the reservation.
+    :return: The new stock amount of each item, or an error response.
+    """
+    if txn_id:
+        script = release_stock_script if sign > 0 else reserve_stock_script
+    else:
+        script = add_stock_script if sign > 0 else subtract_stock_script
+    new_amounts = {}
+    applied = []
+    # The reservation of the transaction is copied with the items moved by a migration
+    for db, item_ids in group_by_db(items, colocated_keys=transaction_keys(txn_id)).items():
+        keys = [reservation_key(txn_id), *item_ids] if txn_id else item_ids
+        args = [items[item_id] for item_id in item_ids]
+        try:
+            result = script(keys=keys, args=[RESERVATION_TTL, *args] if txn_id else args, client=db)
+        except Exception as err:
+            revert_batch(applied, items, sign, txn_id)
+            return Response(str(err), status=400)
+
+        if result[0] != SCRIPT_OK:
+            revert_batch(applied, items, sign, txn_id)
+            item_id = item_ids[result[1] - 1]
+            if result[0] == SCRIPT_NOT_FOUND:
+                return Response(f"The item {item_id} does not exist in the DB!", status=404)
+            return Response(f"You cannot remove {items[item_id]} items of {item_id} "
+                            f"from a stock of {result[2]}!", status=400)
 
-db_1: redis.Redis = redis.Redis(host=os.environ['REDIS_HOST_1'],
-                                port=int(os.environ['REDIS_PORT']),
-                                password=os.environ['REDIS_PASSWORD'],
-                                db=int(os.environ['REDIS_DB']))
+        applied.append((db, item_ids))
+        new_amounts.update(zip(item_ids, result[1:]))
 
-db_2: redis.Redis = redis.Redis(host=os.environ['REDIS_HOST_2'],
-                                port=int(os.environ['REDIS_PORT']),
-                                password=os.environ['REDIS_PASSWORD'],
-                                db=int(os.environ['REDIS_DB']))
+    return new_amounts
 
-db_shards = [db_0, db_1, db_2]
-MODULO_HASH = len(db_shards)
 
+def add_stock_locked(items, txn_id: str = None):
+    """
+    Increase the stock of several items holding their locks, one round trip per shard to read and one to update.
 
-def close_db_connection():
+    :param items: The dictionary of item_id -> amount.
+    :param txn_id: The id of the transaction whose reservation is released, if any.
+    :return: The new stock amount of each item, or an error response.
     """
-    Close the DB connection
+    shards = group_by_db(items, colocated_keys=transaction_keys(txn_id))
+
+    # Lock all the items of the batch, they are released when the block exits
+    with locked(*item_locks(items)) as acquired:
+        if not acquired:
+            return Response(f"The items {list(items)} are locked, try later", status=400)
+
+        # Check that all the items exist and which shards hold a reservation, one round trip per shard
+        new_amounts = {}
+        pending = {}
+        for db, (state, amounts) in read_batch(shards, txn_id).items():
+            new_amounts.update(amounts)
+            if txn_id and state != b"reserved":
+                continue
+            pending[db] = shards[db]
+            for item_id, current_amount in amounts.items():
+                if current_amount is None:
+                    return Response(f"The item {item_id} does not exist in the DB!", status=404)
+
+        # Increase the stock amount of the items
+        try:
+            new_amounts.update(apply_batch(pending, items, 1, txn_id))
+            if txn_id:
+                # Release the shards without a reservation too, so a late reservation of the transaction is ignored
+                for db in shards.keys() - pending.keys():
+                    db.set(reservation_key(txn_id), "released", px=RESERVATION_TTL)
+        except Exception as err:
+            return Response(str(err), status=400)
+
+    return new_amounts
+
+
+def subtract_stock_locked(items, txn_id: str = None):
     """
-    for db in db_shards:
-        db.close()
+    Decrease the stock of several items holding their locks, one round trip per shard to read and one to update.
 
+    :param items: The dictionary of item_id -> amount.
+    :param txn_id: The id of the transaction that reserves the stock, if any.
+    :return: The new stock amount of each item, or an error response.
+    """
+    shards = group_by_db(items, colocated_keys=transaction_keys(txn_id))
+
+    # Lock all the items of the batch, they are released when the block exits
+    with locked(*item_locks(items)) as acquired:
+        if not acquired:
+            return Response(f"The items {list(items)} are locked, try later", status=400)
+
+        # Check that all the items exist and have enough stock, skipping the shards already updated by the
+        # transaction, one round trip per shard
+        new_amounts = {}
+        pending = {}
+        for db, (state, amounts) in read_batch(shards, txn_id).items():
+            new_amounts.update(amounts)
+            if state is not None:
+                continue
+            pending[db] = shards[db]
+            for item_id, current_amount in amounts.items():
+                if current_amount is None:
+                    return Response(f"The item {item_id} does not exist in the DB!", status=404)
+
+                if items[item_id] > current_amount:
+                    return Response(f"You cannot remove {items[item_id]} items of {item_id} "
+                                    f"from a stock of {current_amount}!", status=400)
+
+        # Remove the amounts from the stock
+        try:
+            new_amounts.update(apply_batch(pending, items, -1, txn_id))
+        except Exception as err:
+            return Response(str(err), status=400)
+
+    return new_amounts
+
+
+def update_stock(items, sign: int, txn_id: str = None):
+    """
+    Apply the stock changes of several items, with the scripts or holding the locks of the items.
 
-# Run close_db_connection function when service ends
-atexit.register(close_db_connection)
+    :param items: The dictionary of item_id -> amount.
+    :param sign: 1 to add the amounts to the stock, -1 to subtract them.
+    :param txn_id: The id of the transaction, if any.
+    :return: The new stock amount of each item, or an error response.
+    """
+    if USE_SCRIPTS:
+        return run_stock_script(items, sign, txn_id)
+    if sign > 0:
+        return add_stock_locked(items, txn_id)
+    return subtract_stock_locked(items, txn_id)
 
 
-# Retrieve DB from item_id
-def get_db(item_id: str):
+def update_split_stock(items, sign: int, txn_id: str = None):
     """
-    Retrieve the DB where the item_id is stored.
+    Apply the stock changes of several items that may be split, each one to the part chosen for it.
+    A subtraction without transaction is retried with new parts if the chosen ones ran out of stock meanwhile.
+
+    :param items: The dictionary of item_id -> amount.
+    :param sign: 1 to add the amounts to the stock, -1 to subtract them.
+    :param txn_id: The id of the transaction, if any.
+    :return: The new total stock of each item, or an error response.
+    """
+    for _ in range(SPLIT_RETRIES):
+        try:
+            allocation, parts = allocate(items, sign, txn_id, RESERVATION_TTL)
+        except Exception as err:
+            return Response(str(err), status=400)
+
+        new_amounts = update_stock(to_parts(items, allocation), sign, txn_id)
+        if not isinstance(new_amounts, Response):
+            return stock_totals(new_amounts, allocation, parts)
+        if sign > 0 or txn_id or new_amounts.status_code != 400:
+            break
 
-    :param item_id: The item id.
-    :return: The db connection.
+    return new_amounts
+
+
+def publish_restocked(item_ids):
     """
-    item_id_bytes = int(item_id.split(":")[1])
-    db_idx = item_id_bytes % MODULO_HASH
+    Notify the other services that the stock of the given items has been increased, e.g. to invalidate the stock
+    they cached for the sold out items.
 
-    return db_shards[db_idx]
+    :param item_ids: The ids of the restocked items.
+    """
+    publish(STOCK_RESTOCKED, json.dumps(list(item_ids)))
 
 
 # Define models
@@ -99,11 +363,7 @@ def create_item(price: int):
         return Response("The price must be >= 0!", status=400)
 
     # Create unique item id
-    new_item_id = f"item:{random.getrandbits(ID_BYTES_SIZE)}"
-    db = get_db(new_item_id)
-    while db.hget(new_item_id, "item_id"):
-        new_item_id = f"item:{random.getrandbits(ID_BYTES_SIZE)}"
-        db = get_db(new_item_id)
+    new_item_id = allocate_ids("item")[0]
 
     # Create new item
     db = get_db(new_item_id)
@@ -123,6 +383,111 @@ def create_item(price: int):
     return Response(json.dumps(return_item), mimetype="application/json", status=200)
 
 
+def convert_item(item):
+    """
+    Convert the item from bytes to proper types.
+
+    :param item: The item as returned by the DB.
+    :return: The item as a dictionary.
+    """
+    return {
+        "price": int(item[b"price"]),
+        "stock": int(item[b"stock"]),
+    }
+
+
+def item_response(item_id: str, item):
+    """
+    Build the response of a retrieved item.
+
+    :param item_id: The item unique id.
+    :param item: The item as returned by the DB.
+    :return: The item with the proper types, or an error if it does not exist.
+    """
+    if not item:
+        return Response(f"The item {item_id} does not exist in the DB!", status=404)
+
+    return Response(json.dumps(convert_item(item)), mimetype="application/json", status=200)
+
+
+@app.post('/item/batch_create/<n>/<price>', defaults={"stock": 0})
+@app.post('/item/batch_create/<n>/<price>/<stock>')
+def batch_create_items(n: int, price: int, stock: int):
+    """
+    Create several new items in the DB, with one pipeline per shard.
+
+    :param n: The number of items to create, must be > 0.
+    :param price: The price of the items, must be >= 0.
+    :param stock: The initial stock of the items, must be >= 0.
+    :return: The ids of the new items if they have been saved successfully, an error otherwise.
+    """
+    n, price, stock = int(n), int(price), int(stock)
+    if n <= 0:
+        return Response("The number of items must be > 0!", status=400)
+    if price < 0:
+        return Response("The price must be >= 0!", status=400)
+    if stock < 0:
+        return Response("The stock must be >= 0!", status=400)
+
+    # Create unique item ids
+    new_item_ids = allocate_ids("item", n)
+
+    # Store to DB
+    try:
+        for db, item_ids in group_by_db(new_item_ids, new_keys=True).items():
+            serialized_transaction = db.pipeline(transaction=False)
+            for item_id in item_ids:
+                new_item = Item(item_id=item_id, price=price)
+                new_item.stock = stock
+                serialized_transaction.hset(item_id, mapping=new_item.to_dict())
+            serialized_transaction.execute()
+    except Exception as err:
+        return Response(str(err), status=400)
+
+    # Return success response
+    return_items = {
+        "item_ids": new_item_ids
+    }
+
+    return Response(json.dumps(return_items), mimetype="application/json", status=200)
+
+
+@app.post('/item/split/<item_id>/<parts>')
+def split_item_stock(item_id: str, parts: int):
+    """
+    Split the stock of a hot item in several parts, spread evenly, so its updates do not contend for one counter.
+
+    :param item_id: The item unique id.
+    :param parts: The number of parts, between the current number of parts and MAX_PARTS.
+    :return: The stock of each part if the item has been split, an error otherwise.
+    """
+    if not SPLIT_ITEMS:
+        return Response("Splitting items is disabled, set SPLIT_ITEMS!", status=400)
+
+    parts = int(parts)
+    try:
+        if not get_db(item_id).exists(item_id):
+            return Response(f"The item {item_id} does not exist in the DB!", status=404)
+
+        current_parts = read_parts([item_id])[item_id]
+        if not current_parts <= parts <= MAX_PARTS:
+            return Response(f"The parts must be between {current_parts} and {MAX_PARTS}!", status=400)
+
+        stocks = split_item(item_id, parts)
+    except Exception as err:
+        return Response(str(err), status=400)
+
+    if stocks is None:
+        return Response(f"The item {item_id} is locked, try later", status=400)
+
+    return_item = {
+        "item_id": item_id,
+        "parts": stocks
+    }
+
+    return Response(json.dumps(return_item), mimetype="application/json", status=200)
+
+
 @app.get('/find/<item_id>')
 def find_item(item_id: str):
     """
@@ -131,29 +496,48 @@ def find_item(item_id: str):
     :param item_id: The item unique id.
     :return: The retrieved item. An error otherwise.
     """
-    db = get_db(item_id)
-    # Lock the item
-    item_lock = Redlock(key=item_id, masters={db}, auto_release_time=LOCK_AUTORELEASE_TIME)
-    if item_lock.acquire():
+    db = get_read_db(item_id)
+
+    if LOCK_FREE_READS:
+        # HGETALL is atomic and every write of the item is atomic, so it always returns a consistent item
         item = db.hgetall(item_id)
+    else:
+        # Lock the item, it is released when the block exits
+        with locked(LeaseLock(item_id, db)) as acquired:
+            if not acquired:
+                return Response(f"The item {item_id} is locked, try later", status=400)
 
-        if not item:
-            # Release the lock
-            item_lock.release()
-            return Response(f"The item {item_id} does not exist in the DB!", status=404)
+            item = db.hgetall(item_id)
 
-        # Convert bytes to proper types
-        return_item = {
-            "price": int(item[b"price"]),
-            "stock": int(item[b"stock"]),
-        }
+    if SPLIT_ITEMS and item:
+        # The stock of a split item is the sum of its parts
+        item = add_parts_stock({item_id: item})[item_id]
 
-        # Release the lock
-        item_lock.release()
+    return item_response(item_id, item)
 
-        return Response(json.dumps(return_item), mimetype="application/json", status=200)
-    else:
-        return Response(f"The item {item_id} is locked, try later", status=400)
+
+@app.post('/find_batch')
+def find_items_batch():
+    """
+    Retrieve several items from the DB, with one pipelined read per shard.
+    The request body is a JSON list of item ids.
+
+    :return: The dictionary of item_id -> item for the items that exist in the DB. An error otherwise.
+    """
+    item_ids = request.get_json(silent=True)
+    if not isinstance(item_ids, list) or not all(isinstance(item_id, str) for item_id in item_ids):
+        return Response("The body must be a list of item ids!", status=400)
+
+    try:
+        items = hgetall_many(item_ids)
+        if SPLIT_ITEMS:
+            items = add_parts_stock(items)
+    except Exception as err:
+        return Response(str(err), status=400)
+
+    return_items = {item_id: convert_item(item) for item_id, item in items.items()}
+
+    return Response(json.dumps(return_items), mimetype="application/json", status=200)
 
 
 @app.post('/add/<item_id>/<amount>')
@@ -169,30 +553,34 @@ def add_stock(item_id: str, amount: int):
     if amount <= 0:
         return Response("The amount must be > 0!", status=400)
 
+    if USE_SCRIPTS or SPLIT_ITEMS:
+        # Apply the change as a batch of one item
+        items = {item_id: amount}
+        new_amounts = update_split_stock(items, 1) if SPLIT_ITEMS else run_stock_script(items, 1)
+        if isinstance(new_amounts, Response):
+            return new_amounts
+        publish_restocked(items)
+        return Response(f"The new stock amount for item {item_id} is {new_amounts[item_id]}", status=200)
+
     db = get_db(item_id)
 
-    # Lock the item
-    item_lock = Redlock(key=item_id, masters={db}, auto_release_time=LOCK_AUTORELEASE_TIME)
-    if item_lock.acquire():
+    # Lock the item, it is released when the block exits
+    with locked(LeaseLock(item_id, db)) as acquired:
+        if not acquired:
+            return Response(f"The item {item_id} is locked, try later", status=400)
+
         if not db.hget(item_id, "item_id"):
-            # Release the lock
-            item_lock.release()
             return Response(f"The item {item_id} does not exist in the DB!", status=404)
 
         # Increase the stock amount of the item
         try:
             new_amount = db.hincrby(item_id, "stock", amount)
         except Exception as err:
-            # Release the lock
-            item_lock.release()
             return Response(str(err), status=400)
 
-        # Release the lock
-        item_lock.release()
+    publish_restocked([item_id])
 
-        return Response(f"The new stock amount for item {item_id} is {new_amount}", status=200)
-    else:
-        return Response(f"The item {item_id} is locked, try later", status=400)
+    return Response(f"The new stock amount for item {item_id} is {new_amount}", status=200)
 
 
 @app.post('/subtract/<item_id>/<amount>')
@@ -208,35 +596,107 @@ def remove_stock(item_id: str, amount: int):
     if amount <= 0:
         return Response("The amount must be > 0!", status=400)
 
+    if USE_SCRIPTS or SPLIT_ITEMS:
+        # Apply the change as a batch of one item
+        items = {item_id: amount}
+        new_amounts = update_split_stock(items, -1) if SPLIT_ITEMS else run_stock_script(items, -1)
+        if isinstance(new_amounts, Response):
+            return new_amounts
+        return Response(f"The new stock amount for item {item_id} is {new_amounts[item_id]}", status=200)
+
     db = get_db(item_id)
 
-    # Lock the item
-    item_lock = Redlock(key=item_id, masters={db}, auto_release_time=LOCK_AUTORELEASE_TIME)
-    if item_lock.acquire():
+    # Lock the item, it is released when the block exits
+    with locked(LeaseLock(item_id, db)) as acquired:
+        if not acquired:
+            return Response(f"The item {item_id} is locked, try later", status=400)
+
         if not db.hget(item_id, "item_id"):
-            # Release the lock
-            item_lock.release()
             return Response(f"The item {item_id} does not exist in the DB!", status=404)
 
         # Check if the amount is greater than the items in stock
         current_amount = int(db.hget(item_id, "stock"))
 
         if amount > current_amount:
-            # Release the lock
-            item_lock.release()
             return Response(f"You cannot remove {amount} items from a stock of {current_amount}!", status=400)
 
         # Remove the amount from the stock
         try:
             new_amount = db.hincrby(item_id, "stock", -1 * amount)
         except Exception as err:
-            # Release the lock
-            item_lock.release()
             return Response(str(err), status=400)
 
-        # Release the lock
-        item_lock.release()
-
         return Response(f"The new stock amount for item {item_id} is {new_amount}", status=200)
-    else:
-        return Response(f"The item {item_id} is locked, try later", status=400)
+
+
+@app.post('/add_batch', defaults={"txn_id": None})
+@app.post('/add_batch/<txn_id>')
+def add_stock_batch(txn_id: str):
+    """
+    Increase the stock of several items at once.
+    The request body is a JSON dictionary of item_id -> amount, every amount must be > 0.
+    Either all the items are updated or none of them.
+    With a transaction id the stock reserved by /subtract_batch/<txn_id> is released instead, exactly once,
+    so the compensation of a transaction can be retried safely.
+
+    :param txn_id: The id of the transaction whose reservation is released, optional.
+    :return: The new stock amount of each item if the operation is successful, an error otherwise.
+    """
+    items = parse_items(request.get_json(silent=True))
+    if items is None:
+        return Response("The body must be a dictionary of item_id -> amount > 0!", status=400)
+
+    new_amounts = update_split_stock(items, 1, txn_id) if SPLIT_ITEMS else update_stock(items, 1, txn_id)
+    if isinstance(new_amounts, Response):
+        return new_amounts
+
+    # The release of a reservation only returns the stock of a failed checkout, the order service notifies it
+    if not txn_id:
+        publish_restocked(items)
+
+    return Response(json.dumps(new_amounts), mimetype="application/json", status=200)
+
+
+@app.post('/subtract_batch', defaults={"txn_id": None})
+@app.post('/subtract_batch/<txn_id>')
+def remove_stock_batch(txn_id: str):
+    """
+    Decrease the stock of several items at once, e.g. all the items of an order.
+    The request body is a JSON dictionary of item_id -> amount, every amount must be > 0 and <= current stock.
+    Either all the items are updated or none of them.
+    With a transaction id the stock is reserved for the transaction exactly once, so it can be retried safely
+    and released later with /add_batch/<txn_id>.
+
+    :param txn_id: The id of the transaction that reserves the stock, optional.
+    :return: The new stock amount of each item if the operation is successful, an error otherwise.
+    """
+    items = parse_items(request.get_json(silent=True))
+    if items is None:
+        return Response("The body must be a dictionary of item_id -> amount > 0!", status=400)
+
+    new_amounts = update_split_stock(items, -1, txn_id) if SPLIT_ITEMS else update_stock(items, -1, txn_id)
+    if isinstance(new_amounts, Response):
+        return new_amounts
+
+    return Response(json.dumps(new_amounts), mimetype="application/json", status=200)
+
+
+@app.get('/locks')
+def list_locks():
+    """
+    List the locks currently held in the DB of the service, by any process.
+
+    :return: The held locks with their holder, route, age in seconds and callsite, the oldest first.
+    """
+    return Response(json.dumps(held_locks()), mimetype="application/json", status=200)
+
+
+# Complete the moves of stock between the parts of the split items left unfinished by a process that died
+try:
+    replay_transfers()
+except Exception as err:
+    print(f"Failed to replay the transfers of stock: {err}")
+
+# Execute the commands sent to the service over the bus, when the order service calls the services through it
+if SAGA_TRANSPORT == "streams":
+    start_consumers(app, "stock")
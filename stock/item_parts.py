@@ -0,0 +1,380 @@
+"""
+Split inventory of the hot items.
+With SPLIT_ITEMS the stock of an item can be split with /item/split/<item_id>/<parts> into several counters, so the
+checkouts of a hot item do not all contend for the same key, lock and shard. The item keeps the number of its parts in
+its field parts: part 0 is the stock field of the item itself, part i > 0 is the stock field of the hash
+item_part:<number * MAX_PARTS + i>, routed to its own shard like any other key.
+
+A subtraction takes the whole amount of an item from one random part with enough stock, and only when no part has
+enough it first moves the stock of the other parts to the fullest one. An addition goes to a random part. The stock of
+an item is the sum of its parts.
+
+The parts used by a transaction are recorded in the hash allocation:<txn_id> of the shard of each item, so the retries
+of a reservation and its release use the same parts, and so the same reservation markers.
+
+The stock moved between two parts, which may be on different shards, is taken from the donor together with a record of
+the transfer in the hash transfers:pending of its shard, then added to the target at most once thanks to the receipt
+transfer:<transfer_id> in the shard of the target, and the record is deleted. The transfers of a process that died
+in between are completed by replay_transfers when the service starts.
+"""
+import os
+import random
+import uuid
+
+from lease_lock import LeaseLock, locked
+from scripts import RECEIVE_STOCK, TAKE_STOCK
+from sharding import db_shards, get_db, group_by_db
+
+# Allow the hot items to be split in several stock counters
+SPLIT_ITEMS = os.environ.get('SPLIT_ITEMS', 'False') == 'True'
+# Maximum number of parts of an item, it must never change as it is part of the keys of the parts
+MAX_PARTS = 64
+
+PART_TYPE = "item_part"
+
+# Hash of the transfers of stock taken from the parts of a shard and not added to their target yet
+PENDING_TRANSFERS = "transfers:pending"
+# Milliseconds the receipt of a transfer is kept, a transfer is replayed long before its receipt expires
+TRANSFER_RECEIPT_TTL = 7 * 24 * 3600 * 1000
+
+# Register the scripts, they are executed with EVALSHA on the shard passed as client
+take_stock_script = db_shards[0].register_script(TAKE_STOCK)
+receive_stock_script = db_shards[0].register_script(RECEIVE_STOCK)
+
+
+class NotEnoughStock(Exception):
+    """
+    The parts of an item do not have enough stock in total.
+    """
+
+    def __init__(self, item_id: str, amount: int, stock: int):
+        super().__init__(f"You cannot remove {amount} items of {item_id} from a stock of {stock}!")
+        self.item_id = item_id
+
+
+def part_key(item_id: str, part: int) -> str:
+    """
+    Retrieve the key of a part of the stock of an item.
+
+    :param item_id: The item unique id.
+    :param part: The index of the part, 0 is the item itself.
+    :return: The key of the hash holding the stock of the part.
+    """
+    if part == 0:
+        return item_id
+    return f"{PART_TYPE}:{int(item_id.split(':')[1]) * MAX_PARTS + part}"
+
+
+def item_part_keys(item_id: str, parts: int) -> list:
+    """
+    Retrieve the keys of all the parts of the stock of an item.
+
+    :param item_id: The item unique id.
+    :param parts: The number of parts of the item.
+    :return: The keys of the parts, the item itself first.
+    """
+    return [part_key(item_id, part) for part in range(parts)]
+
+
+def allocation_key(txn_id: str) -> str:
+    """
+    Retrieve the key of the parts used by a transaction, there is one in the shard of each item of the transaction.
+
+    :param txn_id: The id of the transaction.
+    :return: The allocation key.
+    """
+    return f"allocation:{txn_id}"
+
+
+def read_parts(item_ids) -> dict:
+    """
+    Read the number of parts of the given items, one round trip per shard.
+
+    :param item_ids: The item ids.
+    :return: The dictionary of item_id -> number of parts, 1 for the items that are not split or do not exist.
+    """
+    parts = {}
+    for db, keys in group_by_db(item_ids).items():
+        serialized_transaction = db.pipeline(transaction=False)
+        for item_id in keys:
+            serialized_transaction.hget(item_id, "parts")
+        results = serialized_transaction.execute()
+        parts.update({item_id: int(item_parts or 1) for item_id, item_parts in zip(keys, results)})
+
+    return parts
+
+
+def read_stocks(keys) -> dict:
+    """
+    Read the stock of the given items or parts, one round trip per shard.
+
+    :param keys: The keys of the items or parts.
+    :return: The dictionary of key -> stock, 0 for the parts that do not exist.
+    """
+    stocks = {}
+    for db, shard_keys in group_by_db(keys).items():
+        serialized_transaction = db.pipeline(transaction=False)
+        for key in shard_keys:
+            serialized_transaction.hget(key, "stock")
+        stocks.update({key: int(stock or 0) for key, stock in zip(shard_keys, serialized_transaction.execute())})
+
+    return stocks
+
+
+def complete_transfer(db, transfer_id: str, target: str, amount: int):
+    """
+    Add the stock of a transfer to its target, unless it has been added already, and delete the record of the transfer.
+
+    :param db: The db connection of the shard of the donor, where the transfer is recorded.
+    :param transfer_id: The id of the transfer.
+    :param target: The key of the part that receives the stock.
+    :param amount: The amount of stock taken from the donor.
+    """
+    receive_stock_script(keys=[target, f"transfer:{transfer_id}"], args=[amount, TRANSFER_RECEIPT_TTL],
+                         client=get_db(target))
+    db.hdel(PENDING_TRANSFERS, transfer_id)
+
+
+def transfer_stock(donor: str, target: str, amount: int) -> int:
+    """
+    Move up to the given amount of stock from a part of an item to another one.
+
+    :param donor: The key of the part that gives the stock.
+    :param target: The key of the part that receives the stock.
+    :param amount: The amount to move.
+    :return: The amount moved, lower than the given one if the donor has less stock.
+    """
+    db = get_db(donor)
+    transfer_id = uuid.uuid4().hex
+    taken = take_stock_script(keys=[donor, PENDING_TRANSFERS], args=[amount, transfer_id, target], client=db)
+    if taken:
+        complete_transfer(db, transfer_id, target, taken)
+
+    return taken
+
+
+def replay_transfers():
+    """
+    Complete the transfers of stock recorded in all the shards, left unfinished by a process that died.
+    A transfer still running in another process is harmless to replay, its target receives the stock only once.
+    """
+    for db in {id(db): db for db in db_shards}.values():
+        for transfer_id, transfer in db.hgetall(PENDING_TRANSFERS).items():
+            target, amount = transfer.decode("utf-8").rsplit(":", 1)
+            complete_transfer(db, transfer_id.decode("utf-8"), target, int(amount))
+
+
+def rebalance(item_id: str, keys: list, amount: int):
+    """
+    Move the stock of the parts of an item to the fullest part, until it has the given amount.
+    The parts are locked, so no locked update runs meanwhile, and the stock is taken with an atomic script, so the
+    scripted updates stay consistent too. Every move is a transfer, completed even if the process dies meanwhile.
+
+    :param item_id: The item unique id.
+    :param keys: The keys of the parts of the item.
+    :param amount: The amount needed in one part.
+    :return: The key of the part that has the amount, None if it could not be gathered.
+    """
+    with locked(*[LeaseLock(key, get_db(key)) for key in sorted(keys)]) as acquired:
+        if not acquired:
+            return None
+
+        stocks = read_stocks(keys)
+        target = max(keys, key=stocks.get)
+        needed = amount - stocks[target]
+        for donor in sorted(keys, key=stocks.get, reverse=True):
+            if needed <= 0:
+                break
+            if donor == target or not stocks[donor]:
+                continue
+
+            needed -= transfer_stock(donor, target, needed)
+
+        return target if needed <= 0 else None
+
+
+def choose_parts(items: dict, parts: dict, sign: int) -> dict:
+    """
+    Choose the part of each item to update.
+
+    :param items: The dictionary of item_id -> amount.
+    :param parts: The number of parts of each item.
+    :param sign: 1 to add the amounts to the stock, -1 to subtract them.
+    :return: The dictionary of item_id -> part key.
+    """
+    allocation = {item_id: item_id for item_id in items if parts[item_id] == 1}
+    split = [item_id for item_id in items if parts[item_id] > 1]
+    if sign > 0:
+        allocation.update({item_id: part_key(item_id, random.randrange(parts[item_id])) for item_id in split})
+        return allocation
+
+    stocks = read_stocks([key for item_id in split for key in item_part_keys(item_id, parts[item_id])])
+    for item_id in split:
+        keys = item_part_keys(item_id, parts[item_id])
+        candidates = [key for key in keys if stocks[key] >= items[item_id]]
+        if not candidates:
+            total = sum(stocks[key] for key in keys)
+            if total < items[item_id]:
+                raise NotEnoughStock(item_id, items[item_id], total)
+
+            target = rebalance(item_id, keys, items[item_id])
+            if target is None:
+                raise NotEnoughStock(item_id, items[item_id], total)
+            candidates = [target]
+
+        allocation[item_id] = random.choice(candidates)
+
+    return allocation
+
+
+def record_allocation(txn_id: str, allocation: dict, ttl: int) -> dict:
+    """
+    Record the parts used by a transaction, keeping the parts recorded already by a previous attempt.
+
+    :param txn_id: The id of the transaction.
+    :param allocation: The dictionary of item_id -> part key.
+    :param ttl: The milliseconds the record is kept, as long as the reservation of the transaction.
+    :return: The recorded dictionary of item_id -> part key.
+    """
+    recorded = {}
+    for db, item_ids in group_by_db(allocation, colocated_keys=[allocation_key(txn_id)]).items():
+        serialized_transaction = db.pipeline()
+        for item_id in item_ids:
+            serialized_transaction.hsetnx(allocation_key(txn_id), item_id, allocation[item_id])
+            serialized_transaction.hget(allocation_key(txn_id), item_id)
+        serialized_transaction.pexpire(allocation_key(txn_id), ttl)
+        results = serialized_transaction.execute()
+        recorded.update({item_id: key.decode("utf-8") for item_id, key in zip(item_ids, results[1::2])})
+
+    return recorded
+
+
+def read_allocation(txn_id: str, item_ids) -> dict:
+    """
+    Read the parts recorded by a transaction.
+
+    :param txn_id: The id of the transaction.
+    :param item_ids: The item ids.
+    :return: The dictionary of item_id -> part key of the recorded items.
+    """
+    recorded = {}
+    for db, keys in group_by_db(item_ids, colocated_keys=[allocation_key(txn_id)]).items():
+        for item_id, key in zip(keys, db.hmget(allocation_key(txn_id), keys)):
+            if key is not None:
+                recorded[item_id] = key.decode("utf-8")
+
+    return recorded
+
+
+def allocate(items: dict, sign: int, txn_id: str = None, ttl: int = 0):
+    """
+    Choose the parts to update for the given items.
+    With a transaction id the parts recorded by the transaction are used. The release of a transaction that has no
+    recorded parts uses the items themselves, and records them, so a late reservation uses them too.
+
+    :param items: The dictionary of item_id -> amount.
+    :param sign: 1 to add the amounts to the stock, -1 to subtract them.
+    :param txn_id: The id of the transaction, if any.
+    :param ttl: The milliseconds the parts of the transaction are recorded.
+    :return: The dictionary of item_id -> part key and the number of parts of each item.
+    """
+    parts = read_parts(items)
+    if not txn_id:
+        return choose_parts(items, parts, sign), parts
+
+    allocation = read_allocation(txn_id, items)
+    missing = {item_id: amount for item_id, amount in items.items() if item_id not in allocation}
+    if missing:
+        chosen = choose_parts(missing, parts, sign) if sign < 0 else {item_id: item_id for item_id in missing}
+        allocation.update(record_allocation(txn_id, chosen, ttl))
+
+    return allocation, parts
+
+
+def to_parts(items: dict, allocation: dict) -> dict:
+    """
+    Convert the amounts of the items to the amounts of their allocated parts.
+
+    :param items: The dictionary of item_id -> amount.
+    :param allocation: The dictionary of item_id -> part key.
+    :return: The dictionary of part key -> amount.
+    """
+    return {allocation[item_id]: amount for item_id, amount in items.items()}
+
+
+def stock_totals(new_amounts: dict, allocation: dict, parts: dict) -> dict:
+    """
+    Compute the stock of the items from the new stock of the updated parts.
+
+    :param new_amounts: The dictionary of part key -> new stock.
+    :param allocation: The dictionary of item_id -> updated part key.
+    :param parts: The number of parts of each item.
+    :return: The dictionary of item_id -> stock.
+    """
+    others = {item_id: [key for key in item_part_keys(item_id, parts[item_id]) if key != allocation[item_id]]
+              for item_id in allocation}
+    stocks = read_stocks([key for keys in others.values() for key in keys])
+
+    return {item_id: new_amounts[key] + sum(stocks[other] for other in others[item_id])
+            for item_id, key in allocation.items()}
+
+
+def add_parts_stock(items: dict) -> dict:
+    """
+    Set the stock of the split items among the given hashes to the sum of their parts.
+
+    :param items: The dictionary of item_id -> hash, as returned by the DB.
+    :return: The same dictionary, with the stock of the split items updated.
+    """
+    split = {item_id: int(item[b"parts"]) for item_id, item in items.items() if int(item.get(b"parts", 1)) > 1}
+    if not split:
+        return items
+
+    stocks = read_stocks([part_key(item_id, part) for item_id, parts in split.items() for part in range(1, parts)])
+    for item_id, parts in split.items():
+        total = int(items[item_id][b"stock"]) + sum(stocks[part_key(item_id, part)] for part in range(1, parts))
+        items[item_id] = {**items[item_id], b"stock": str(total).encode("utf-8")}
+
+    return items
+
+
+def split_item(item_id: str, parts: int):
+    """
+    Split the stock of an item in the given number of parts, spreading it evenly.
+    The item and all its parts are locked meanwhile, the stock is moved with transfers, as in rebalance.
+
+    :param item_id: The item unique id.
+    :param parts: The new number of parts, it can only grow.
+    :return: The stock of each part, None if the item is locked.
+    """
+    keys = item_part_keys(item_id, parts)
+    with locked(*[LeaseLock(key, get_db(key)) for key in sorted(keys)]) as acquired:
+        if not acquired:
+            return None
+
+        # Create the new parts before they are visible in the item
+        for db, shard_keys in group_by_db(keys[1:]).items():
+            serialized_transaction = db.pipeline()
+            for key in shard_keys:
+                serialized_transaction.hsetnx(key, "item_id", item_id)
+                serialized_transaction.hsetnx(key, "stock", 0)
+            serialized_transaction.execute()
+        get_db(item_id).hset(item_id, "parts", parts)
+
+        # Move the surplus of the fullest parts to the emptiest ones
+        stocks = read_stocks(keys)
+        share, remainder = divmod(sum(stocks.values()), parts)
+        targets = {key: share + (1 if part < remainder else 0) for part, key in enumerate(keys)}
+        surplus = {key: stocks[key] - targets[key] for key in keys if stocks[key] > targets[key]}
+        for key in keys:
+            for donor in list(surplus):
+                if stocks[key] >= targets[key]:
+                    break
+                moved = transfer_stock(donor, key, min(targets[key] - stocks[key], surplus[donor]))
+                stocks[key] += moved
+                surplus[donor] -= moved
+                # The donor has no surplus left, or less stock than read if a scripted update took it meanwhile
+                if not moved or not surplus[donor]:
+                    del surplus[donor]
+
+        return read_stocks(keys)
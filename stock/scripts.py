@@ -0,0 +1,120 @@
+"""
+Server-side Lua scripts for the stock mutations.
+Each script checks and updates all the given items of one shard atomically in a single round trip,
+so no distributed lock is needed.
+
+The scripts return a list whose first element is the status of the execution:
+- SCRIPT_OK: the items have been updated, the rest of the list contains their new stock amounts.
+- SCRIPT_NOT_FOUND: the item at position list[1] (1-based) does not exist, nothing has been updated.
+- SCRIPT_NOT_ENOUGH_STOCK: the item at position list[1] (1-based) has only list[2] items in stock,
+  nothing has been updated.
+"""
+
+SCRIPT_OK = 0
+SCRIPT_NOT_FOUND = 1
+SCRIPT_NOT_ENOUGH_STOCK = 2
+
+# KEYS: the item ids, ARGV: the amounts to add to the stock of each item
+ADD_STOCK = """
+for i, item_id in ipairs(KEYS) do
+    if redis.call('HEXISTS', item_id, 'item_id') == 0 then
+        return {1, i}
+    end
+end
+
+local result = {0}
+for i, item_id in ipairs(KEYS) do
+    result[i + 1] = redis.call('HINCRBY', item_id, 'stock', tonumber(ARGV[i]))
+end
+return result
+"""
+
+# KEYS: the item ids, ARGV: the amounts to subtract from the stock of each item
+SUBTRACT_STOCK = """
+for i, item_id in ipairs(KEYS) do
+    local stock = redis.call('HGET', item_id, 'stock')
+    if not stock then
+        return {1, i}
+    end
+    if tonumber(stock) < tonumber(ARGV[i]) then
+        return {2, i, tonumber(stock)}
+    end
+end
+
+local result = {0}
+for i, item_id in ipairs(KEYS) do
+    result[i + 1] = redis.call('HINCRBY', item_id, 'stock', -tonumber(ARGV[i]))
+end
+return result
+"""
+
+# KEYS: [the reservation key of the transaction, the item ids], ARGV: [the ttl of the reservation in ms, the amounts]
+# Subtracts the amounts once per transaction, if the transaction has been seen already nothing is updated
+# and the current stock amounts are returned.
+RESERVE_STOCK = """
+local result = {0}
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    for i = 2, #KEYS do
+        result[i] = tonumber(redis.call('HGET', KEYS[i], 'stock') or 0)
+    end
+    return result
+end
+
+for i = 2, #KEYS do
+    local stock = redis.call('HGET', KEYS[i], 'stock')
+    if not stock then
+        return {1, i - 1}
+    end
+    if tonumber(stock) < tonumber(ARGV[i]) then
+        return {2, i - 1, tonumber(stock)}
+    end
+end
+
+for i = 2, #KEYS do
+    result[i] = redis.call('HINCRBY', KEYS[i], 'stock', -tonumber(ARGV[i]))
+end
+redis.call('SET', KEYS[1], 'reserved', 'PX', ARGV[1])
+return result
+"""
+
+# KEYS: [the reservation key of the transaction, the item ids], ARGV: [the ttl of the reservation in ms, the amounts]
+# Adds the amounts back only if they are reserved by the transaction. The reservation is always marked as released,
+# so a late reservation of the same transaction is ignored.
+RELEASE_STOCK = """
+local result = {0}
+local reserved = redis.call('GET', KEYS[1]) == 'reserved'
+for i = 2, #KEYS do
+    if reserved then
+        result[i] = redis.call('HINCRBY', KEYS[i], 'stock', tonumber(ARGV[i]))
+    else
+        result[i] = tonumber(redis.call('HGET', KEYS[i], 'stock') or 0)
+    end
+end
+redis.call('SET', KEYS[1], 'released', 'PX', ARGV[1])
+return result
+"""
+
+# KEYS: [the donor item or part id, the pending transfers], ARGV: [the amount to take, the transfer id, the transfer]
+# Subtracts up to the amount from the stock of the donor, without failing when the stock is lower, and records the
+# transfer of the taken amount in the same shard, so it is completed even if the process dies before crediting it.
+# Unlike the other scripts it returns a number: the amount actually taken.
+TAKE_STOCK = """
+local stock = tonumber(redis.call('HGET', KEYS[1], 'stock') or 0)
+local taken = math.min(stock, tonumber(ARGV[1]))
+if taken > 0 then
+    redis.call('HINCRBY', KEYS[1], 'stock', -taken)
+    redis.call('HSET', KEYS[2], ARGV[2], ARGV[3] .. ':' .. taken)
+end
+return taken
+"""
+
+# KEYS: [the target item or part id, the receipt of the transfer], ARGV: [the amount, the receipt TTL in milliseconds]
+# Adds the amount of a transfer to the stock of the target, once: a transfer replayed after its receipt is ignored.
+# Returns 1 if the amount has been added, 0 if the transfer had been received already.
+RECEIVE_STOCK = """
+if not redis.call('SET', KEYS[2], 'received', 'NX', 'PX', ARGV[2]) then
+    return 0
+end
+redis.call('HINCRBY', KEYS[1], 'stock', ARGV[1])
+return 1
+"""
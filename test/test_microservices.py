@@ -1,4 +1,11 @@
+import os
+import random
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask
 
 import utils as tu
 
@@ -34,6 +41,75 @@ class TestMicroservices(unittest.TestCase):
         stock_after_subtract: int = tu.find_item(item_id)['stock']
         self.assertEqual(stock_after_subtract, 35)
 
+    def test_stock_batch(self):
+        item_id1: str = tu.create_item(5)['item_id']
+        item_id2: str = tu.create_item(5)['item_id']
+
+        # Test /stock/add_batch
+        add_stock_response = tu.add_stock_batch({item_id1: 10, item_id2: 2})
+        self.assertTrue(tu.status_code_is_success(add_stock_response))
+        self.assertEqual(tu.find_item(item_id1)['stock'], 10)
+        self.assertEqual(tu.find_item(item_id2)['stock'], 2)
+
+        # Test /stock/subtract_batch, nothing is subtracted if one of the items has not enough stock
+        over_subtract_stock_response = tu.subtract_stock_batch({item_id1: 5, item_id2: 3})
+        self.assertTrue(tu.status_code_is_failure(over_subtract_stock_response))
+        self.assertEqual(tu.find_item(item_id1)['stock'], 10)
+        self.assertEqual(tu.find_item(item_id2)['stock'], 2)
+
+        subtract_stock_response = tu.subtract_stock_batch({item_id1: 5, item_id2: 2})
+        self.assertTrue(tu.status_code_is_success(subtract_stock_response))
+        self.assertEqual(tu.find_item(item_id1)['stock'], 5)
+        self.assertEqual(tu.find_item(item_id2)['stock'], 0)
+
+    def test_stock_reservation(self):
+        item_id: str = tu.create_item(5)['item_id']
+        add_stock_response = tu.add_stock(item_id, 10)
+        self.assertTrue(tu.status_code_is_success(add_stock_response))
+        txn_id: str = f"test:{item_id}"
+
+        # Test /stock/subtract_batch/<txn_id>, the stock is reserved once per transaction
+        for _ in range(2):
+            reserve_stock_response = tu.reserve_stock_batch(txn_id, {item_id: 3})
+            self.assertTrue(tu.status_code_is_success(reserve_stock_response))
+            self.assertEqual(tu.find_item(item_id)['stock'], 7)
+
+        # Test /stock/add_batch/<txn_id>, the reservation is released once
+        for _ in range(2):
+            release_stock_response = tu.release_stock_batch(txn_id, {item_id: 3})
+            self.assertTrue(tu.status_code_is_success(release_stock_response))
+            self.assertEqual(tu.find_item(item_id)['stock'], 10)
+
+        # A released transaction does not reserve the stock again
+        reserve_stock_response = tu.reserve_stock_batch(txn_id, {item_id: 3})
+        self.assertTrue(tu.status_code_is_success(reserve_stock_response))
+        self.assertEqual(tu.find_item(item_id)['stock'], 10)
+
+    def test_batch_create(self):
+        # Test /stock/item/batch_create/<n>/<price>/<stock>
+        items: dict = tu.batch_create_items(10, 5, 20)
+        self.assertEqual(len(set(items['item_ids'])), 10)
+        for item_id in items['item_ids']:
+            item: dict = tu.find_item(item_id)
+            self.assertEqual(item['price'], 5)
+            self.assertEqual(item['stock'], 20)
+
+        # Test /stock/find_batch
+        found_items: dict = tu.find_items_batch(items['item_ids'] + ['item:0'])
+        self.assertEqual(set(found_items), set(items['item_ids']))
+        self.assertTrue(all(item['stock'] == 20 for item in found_items.values()))
+
+        # Test /payment/batch_create_users/<n>/<credit>
+        users: dict = tu.batch_create_users(10, 15)
+        self.assertEqual(len(set(users['user_ids'])), 10)
+        for user_id in users['user_ids']:
+            self.assertEqual(tu.find_user(user_id)['credit'], 15)
+
+        # Test /payment/find_batch
+        found_users: dict = tu.find_users_batch(users['user_ids'])
+        self.assertEqual(set(found_users), set(users['user_ids']))
+        self.assertTrue(all(user['credit'] == 15 for user in found_users.values()))
+
     def test_payment(self):
         # Test /payment/pay/<user_id>/<order_id>
         user: dict = tu.create_user()
@@ -74,6 +150,164 @@ class TestMicroservices(unittest.TestCase):
         credit_after_payment: int = tu.find_user(user_id)['credit']
         self.assertEqual(credit_after_payment, 5)
 
+    def test_payment_locks_released(self):
+        user: dict = tu.create_user()
+        user_id: str = user['user_id']
+
+        # A failed payment releases its locks, so the next payment of the user is not blocked
+        payment_response = tu.payment_pay(user_id, "order:0", 10)
+        self.assertTrue(tu.status_code_is_failure(payment_response))
+
+        add_credit_response = tu.add_credit_to_user(user_id, 15)
+        self.assertTrue(tu.status_code_is_success(add_credit_response))
+
+        payment_response = tu.payment_pay(user_id, "order:0", 10)
+        self.assertTrue(tu.status_code_is_success(payment_response))
+
+        # Test /payment/locks
+        held_locks: list = tu.payment_held_locks()
+        self.assertFalse(any(lock['key'] in (user_id, "order:0") for lock in held_locks))
+
+    def test_held_locks(self):
+        if not tu.db_available("payment"):
+            self.skipTest("The DBs of the payment service are not reachable")
+        payment_app, lease_lock = tu.load_service_modules("payment", "app", "lease_lock")
+        user_id: str = tu.create_user()['user_id']
+
+        # A lock held by another process is listed by the service with the identity of its holder
+        user_lock = lease_lock.LeaseLock(user_id, payment_app.get_db(user_id))
+        with payment_app.app.test_request_context(f"/pay/{user_id}/order:0/1", method="POST"):
+            self.assertTrue(user_lock.acquire(blocking=False))
+        try:
+            held_lock, = [lock for lock in tu.payment_held_locks() if lock['key'] == user_id]
+            self.assertIn(f"-{os.getpid()}-", held_lock['holder'])
+            self.assertEqual(held_lock['route'], f"POST /pay/{user_id}/order:0/1")
+            self.assertIn("test_held_locks", held_lock['callsite'])
+            self.assertGreaterEqual(held_lock['age'], 0)
+        finally:
+            self.assertTrue(user_lock.release())
+        self.assertFalse(any(lock['key'] == user_id for lock in tu.payment_held_locks()))
+
+    def test_payment_transaction(self):
+        user_id: str = tu.create_user()['user_id']
+        add_credit_response = tu.add_credit_to_user(user_id, 15)
+        self.assertTrue(tu.status_code_is_success(add_credit_response))
+        order_id: str = "order:0"
+        txn_id: str = f"test:{user_id}"
+
+        # Test /payment/pay/<user_id>/<order_id>/<amount>/<txn_id>, the order is paid once per transaction
+        for _ in range(2):
+            payment_response = tu.payment_pay_transaction(user_id, order_id, 10, txn_id)
+            self.assertTrue(tu.status_code_is_success(payment_response))
+            self.assertEqual(tu.find_user(user_id)['credit'], 5)
+
+        # Test /payment/cancel/<user_id>/<order_id>/<txn_id>, the payment is refunded once
+        cancel_response = tu.payment_cancel_transaction(user_id, order_id, txn_id)
+        self.assertTrue(tu.status_code_is_success(cancel_response))
+        cancel_response = tu.payment_cancel_transaction(user_id, order_id, txn_id)
+        self.assertEqual(cancel_response, 409)
+        self.assertEqual(tu.find_user(user_id)['credit'], 15)
+
+        # A cancelled transaction does not pay again, also if it was cancelled before paying
+        payment_response = tu.payment_pay_transaction(user_id, order_id, 10, txn_id)
+        self.assertTrue(tu.status_code_is_failure(payment_response))
+        cancel_response = tu.payment_cancel_transaction(user_id, "order:1", f"{txn_id}:late")
+        self.assertTrue(tu.status_code_is_failure(cancel_response))
+        payment_response = tu.payment_pay_transaction(user_id, "order:1", 10, f"{txn_id}:late")
+        self.assertTrue(tu.status_code_is_failure(payment_response))
+        self.assertEqual(tu.find_user(user_id)['credit'], 15)
+
+        # A new transaction pays the cancelled order again with its own amount, which is refunded by its cancellation
+        payment_response = tu.payment_pay_transaction(user_id, order_id, 7, f"{txn_id}:retry")
+        self.assertTrue(tu.status_code_is_success(payment_response))
+        self.assertEqual(tu.find_user(user_id)['credit'], 8)
+        cancel_response = tu.payment_cancel_transaction(user_id, order_id, f"{txn_id}:retry")
+        self.assertTrue(tu.status_code_is_success(cancel_response))
+        self.assertEqual(tu.find_user(user_id)['credit'], 15)
+
+    def payment_app(self, **env):
+        if not tu.db_available("payment"):
+            self.skipTest("The DBs of the payment service are not reachable")
+        return tu.load_service_modules("payment", "app", shards=len(tu.DB_PORTS["payment"]), **env)[0]
+
+    def test_payment_scripts(self):
+        payment_app = self.payment_app(USE_SCRIPTS="True")
+        client = payment_app.app.test_client()
+        user_id: str = client.post("/create_user").json['user_id']
+        self.assertTrue(tu.status_code_is_success(client.post(f"/add_funds/{user_id}/15").status_code))
+        order_id: str = f"order:{random.randrange(1 << 40, 1 << 41)}"
+
+        # Test /payment/pay, an order is paid once and only with enough credit
+        self.assertEqual(client.post(f"/status/{user_id}/{order_id}").status_code, 404)
+        self.assertEqual(client.post(f"/pay/{user_id}/{order_id}/20").status_code, 400)
+        self.assertEqual(client.post(f"/pay/{user_id}/{order_id}/10").status_code, 200)
+        self.assertEqual(client.post(f"/pay/{user_id}/{order_id}/10").status_code, 400)
+        self.assertEqual(client.post(f"/pay/user:0/{order_id}/10").status_code, 404)
+        self.assertTrue(client.post(f"/status/{user_id}/{order_id}").json['paid'])
+        self.assertEqual(client.get(f"/find_user/{user_id}").json['credit'], 5)
+
+        # Test /payment/cancel, the payment is refunded once
+        self.assertEqual(client.post(f"/cancel/{user_id}/{order_id}").status_code, 200)
+        self.assertEqual(client.post(f"/cancel/{user_id}/{order_id}").status_code, 409)
+        self.assertEqual(client.post(f"/cancel/{user_id}/order:0").status_code, 404)
+        self.assertFalse(client.post(f"/status/{user_id}/{order_id}").json['paid'])
+        self.assertEqual(client.get(f"/find_user/{user_id}").json['credit'], 15)
+
+        # A cancelled order is paid again with the new amount, which its cancellation refunds
+        self.assertEqual(client.post(f"/pay/{user_id}/{order_id}/7").status_code, 200)
+        self.assertEqual(client.get(f"/find_user/{user_id}").json['credit'], 8)
+        self.assertEqual(client.post(f"/cancel/{user_id}/{order_id}").status_code, 200)
+        self.assertEqual(client.get(f"/find_user/{user_id}").json['credit'], 15)
+
+    def test_payment_scripts_transaction(self):
+        payment_app = self.payment_app(USE_SCRIPTS="True")
+        client = payment_app.app.test_client()
+        user_id: str = client.post("/create_user").json['user_id']
+        self.assertTrue(tu.status_code_is_success(client.post(f"/add_funds/{user_id}/15").status_code))
+        order_id: str = f"order:{random.randrange(1 << 40, 1 << 41)}"
+        txn_id: str = f"{order_id}:1"
+
+        # The order is paid once per transaction and refunded once
+        for _ in range(2):
+            self.assertEqual(client.post(f"/pay/{user_id}/{order_id}/10/{txn_id}").status_code, 200)
+            self.assertEqual(client.get(f"/find_user/{user_id}").json['credit'], 5)
+        self.assertEqual(client.post(f"/pay/{user_id}/{order_id}/10/{order_id}:2").status_code, 400)
+        self.assertEqual(client.post(f"/cancel/{user_id}/{order_id}/{order_id}:2").status_code, 409)
+        self.assertEqual(client.post(f"/cancel/{user_id}/{order_id}/{txn_id}").status_code, 200)
+        self.assertEqual(client.post(f"/cancel/{user_id}/{order_id}/{txn_id}").status_code, 409)
+        self.assertEqual(client.get(f"/find_user/{user_id}").json['credit'], 15)
+
+        # A cancelled transaction never pays, also if it was cancelled before paying
+        self.assertEqual(client.post(f"/pay/{user_id}/{order_id}/10/{txn_id}").status_code, 400)
+        self.assertEqual(client.post(f"/pay/{user_id}/{order_id}/10/{order_id}:2").status_code, 400)
+        self.assertEqual(client.get(f"/find_user/{user_id}").json['credit'], 15)
+
+    def test_legacy_payment(self):
+        payment_app = self.payment_app(LEGACY_PAYMENTS="True")
+        client = payment_app.app.test_client()
+        user_id: str = client.post("/create_user").json['user_id']
+        self.assertTrue(tu.status_code_is_success(client.post(f"/add_funds/{user_id}/15").status_code))
+
+        # A payment stored by the first versions under the order id, in the shard of the user, not of the order
+        db = payment_app.get_db(user_id)
+        order_id: str = f"order:{random.randrange(1 << 40, 1 << 41)}"
+        while payment_app.get_db(order_id) is db:
+            order_id = f"order:{random.randrange(1 << 40, 1 << 41)}"
+        db.hset(order_id, mapping={"order_id": order_id, "amount": 10, "status": "True"})
+        self.addCleanup(db.delete, order_id, payment_app.payment_key(user_id, order_id))
+
+        # The legacy payment is found, the order is not paid twice
+        self.assertTrue(client.post(f"/status/{user_id}/{order_id}").json['paid'])
+        self.assertTrue(tu.status_code_is_failure(client.post(f"/pay/{user_id}/{order_id}/10").status_code))
+        self.assertEqual(client.get(f"/find_user/{user_id}").json['credit'], 15)
+        self.assertFalse(db.exists(order_id))
+
+        # Its cancellation refunds the legacy amount once
+        self.assertTrue(tu.status_code_is_success(client.post(f"/cancel/{user_id}/{order_id}").status_code))
+        self.assertTrue(tu.status_code_is_failure(client.post(f"/cancel/{user_id}/{order_id}").status_code))
+        self.assertEqual(client.get(f"/find_user/{user_id}").json['credit'], 25)
+        self.assertFalse(client.post(f"/status/{user_id}/{order_id}").json['paid'])
+
     def test_order(self):
         # Test /payment/pay/<user_id>/<order_id>
         user: dict = tu.create_user()
@@ -142,5 +376,582 @@ class TestMicroservices(unittest.TestCase):
         self.assertEqual(credit, 5)
 
 
+    def test_order_concurrent_cart(self):
+        user_id: str = tu.create_user()['user_id']
+        order_id: str = tu.create_order(user_id)['order_id']
+        item_id1: str = tu.create_item(5)['item_id']
+        self.assertTrue(tu.status_code_is_success(tu.add_stock(item_id1, 100)))
+        item_id2: str = tu.create_item(3)['item_id']
+        self.assertTrue(tu.status_code_is_success(tu.add_stock(item_id2, 100)))
+        for _ in range(10):
+            self.assertTrue(tu.status_code_is_success(tu.add_item_to_order(order_id, item_id1)))
+
+        # Concurrent additions and removals of the items of the same order are all applied, except the ones that
+        # found the item locked by a concurrent lookup and failed at once
+        updates = [(tu.add_item_to_order, item_id1, 1)] * 10 + [(tu.remove_item_from_order, item_id1, -1)] * 10 + \
+                  [(tu.add_item_to_order, item_id2, 1)] * 10
+        random.shuffle(updates)
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            status_codes = list(executor.map(lambda update: update[0](order_id, update[1]), updates))
+        amounts = {item_id1: 10, item_id2: 0}
+        for (_, item_id, change), status_code in zip(updates, status_codes):
+            if tu.status_code_is_success(status_code):
+                amounts[item_id] += change
+
+        order: dict = tu.find_order(order_id)
+        self.assertEqual(order['items'], {item_id: amount for item_id, amount in amounts.items() if amount > 0})
+        self.assertEqual(order['total_cost'], 5 * amounts[item_id1] + 3 * amounts[item_id2])
+
+        # The order is empty and free after removing all its items
+        for item_id, amount in amounts.items():
+            for _ in range(amount):
+                self.assertTrue(tu.status_code_is_success(tu.remove_item_from_order(order_id, item_id)))
+        self.assertTrue(tu.status_code_is_failure(tu.remove_item_from_order(order_id, item_id1)))
+        order = tu.find_order(order_id)
+        self.assertEqual(order['items'], {})
+        self.assertEqual(order['total_cost'], 0)
+
+    def test_shard_routing(self):
+        # The keys are routed by modulo by default, as the first versions
+        sharding, = tu.load_service_modules("order", "sharding", shards=3)
+        self.assertEqual([sharding.shard_index(f"order:{number}", 3) for number in range(6)], [0, 1, 2, 0, 1, 2])
+
+        # The jump hash spreads the keys evenly and moves only the keys of the appended shard
+        sharding, = tu.load_service_modules("order", "sharding", shards=3, SHARD_HASH="jump")
+        keys = [f"order:{random.randrange(1 << 40)}" for _ in range(10000)]
+        for shards in range(1, 6):
+            before = [sharding.shard_index(key, shards) for key in keys]
+            after = [sharding.shard_index(key, shards + 1) for key in keys]
+            self.assertEqual(set(after), set(range(shards + 1)))
+            moved = [new for old, new in zip(before, after) if old != new]
+            self.assertEqual(set(moved), {shards})
+            self.assertAlmostEqual(len(moved) / len(keys), 1 / (shards + 1), delta=0.02)
+        self.assertEqual(sharding.shard_index("order:12345", 1), 0)
+
+    def test_shard_migration(self):
+        if not tu.db_available("order"):
+            self.skipTest("The DBs of the order service are not reachable")
+        # Migrate from the first shard to three shards, the old shard is kept in the new topology
+        sharding, = tu.load_service_modules("order", "sharding", shards=3, SHARD_HASH="jump")
+        sharding.old_db_shards[:] = sharding.db_shards[:1]
+        old_db = sharding.db_shards[0]
+
+        keys = []
+        while len(keys) < 2:
+            key = f"order:{random.randrange(1 << 40, 1 << 41)}"
+            if sharding.shard_index(key, 3) != 0:
+                keys.append(key)
+        txn_key: str = f"reservation:test:{keys[0]}"
+        self.addCleanup(lambda: [db.delete(*keys, txn_key) for db in sharding.db_shards])
+        for key in keys:
+            old_db.hset(key, "order_id", key)
+        old_db.set(txn_key, "reserved")
+
+        # The keys not moved yet are read from the old shard
+        new_db = sharding.db_shards[sharding.shard_index(keys[0], 3)]
+        self.assertIs(sharding.get_read_db(keys[0]), old_db)
+        self.assertEqual(set(sharding.hgetall_many(keys)), set(keys))
+
+        # A key is moved to its new shard when it is written, with the transaction state it is written with
+        self.assertIs(sharding.get_db(keys[0], txn_key), new_db)
+        self.assertTrue(new_db.exists(keys[0], txn_key) == 2 and not old_db.exists(keys[0]))
+        self.assertTrue(old_db.exists(txn_key))
+        self.assertIs(sharding.get_read_db(keys[0]), new_db)
+
+        # The migration moves the other keys and copies the transaction state to every new shard
+        self.assertEqual(sharding.migrate_batch([*keys, txn_key], old_db), 1)
+        for key in keys:
+            self.assertEqual(sharding.db_shards[sharding.shard_index(key, 3)].hget(key, "order_id"), key.encode())
+            self.assertFalse(old_db.exists(key))
+        self.assertTrue(all(db.exists(txn_key) for db in sharding.db_shards))
+
+    def test_shard_migration_reads(self):
+        if not tu.db_available("order"):
+            self.skipTest("The DBs of the order service are not reachable")
+        sharding, = tu.load_service_modules("order", "sharding", shards=3, SHARD_HASH="jump")
+        sharding.old_db_shards[:] = sharding.db_shards[:1]
+        old_db = sharding.db_shards[0]
+
+        keys = [f"order:{random.randrange(1 << 40, 1 << 41)}" for _ in range(200)]
+        self.addCleanup(lambda: [db.delete(*keys) for db in sharding.db_shards])
+        for key in keys:
+            old_db.hset(key, "order_id", key)
+
+        # The keys are always found while the migration moves them, from the old or the new shard
+        def migrate():
+            for batch_start in range(0, len(keys), 10):
+                sharding.migrate_batch(keys[batch_start:batch_start + 10], old_db)
+
+        migration = threading.Thread(target=migrate)
+        migration.start()
+        while migration.is_alive():
+            self.assertEqual(set(sharding.hgetall_many(keys)), set(keys))
+            key = random.choice(keys)
+            self.assertEqual(sharding.get_read_db(key).hget(key, "order_id"), key.encode())
+        migration.join()
+
+        for key in keys:
+            self.assertIs(sharding.get_read_db(key), sharding.db_shards[sharding.shard_index(key, 3)])
+
+    def test_saga_fence_after_shard_move(self):
+        if not tu.db_available("order"):
+            self.skipTest("The DBs of the order service are not reachable")
+        sharding, lease_lock, saga_log = tu.load_service_modules("order", "sharding", "lease_lock", "saga_log")
+
+        old_db, new_db = tu.connect_db("order", 0), tu.connect_db("order", 1)
+        order_id: str = f"order:{random.randrange(1 << 40, 1 << 41)}"
+        saga_key: str = saga_log.saga_key(order_id)
+        try:
+            # Some checkout attempts on the old shard raise the fence of the saga
+            old_db.hset(order_id, "order_id", order_id)
+            for _ in range(3):
+                order_lock = lease_lock.LeaseLock(order_id, old_db, saga_key)
+                self.assertTrue(order_lock.acquire())
+                saga_log.SagaLog(order_id, old_db, order_lock.fencing_token).finish(saga_log.SAGA_ABORTED)
+                order_lock.release()
+
+            # Move the order and its saga to another shard, as the migration does
+            self.assertEqual(sharding.move_keys([order_id, saga_key], old_db, new_db), 2)
+
+            # The lock of the moved order issues tokens above the fence of the saga, which accepts its updates
+            order_lock = lease_lock.LeaseLock(order_id, new_db, saga_key)
+            self.assertTrue(order_lock.acquire())
+            self.assertGreater(order_lock.fencing_token, int(new_db.hget(saga_key, "fence")))
+            saga_log.SagaLog(order_id, new_db, order_lock.fencing_token).finish(saga_log.SAGA_ABORTED)
+            order_lock.release()
+
+            # Also a saga whose counter has been lost, e.g. fenced before the counter was kept in the saga
+            new_db.hdel(saga_key, "lock_fence")
+            order_lock = lease_lock.LeaseLock(order_id, new_db, saga_key)
+            self.assertTrue(order_lock.acquire())
+            saga_log.SagaLog(order_id, new_db, order_lock.fencing_token).finish(saga_log.SAGA_ABORTED)
+            order_lock.release()
+
+            # The locks without fenced resource do not issue fencing tokens
+            item_lock = lease_lock.LeaseLock(order_id, new_db)
+            self.assertTrue(item_lock.acquire())
+            self.assertIsNone(item_lock.fencing_token)
+            item_lock.release()
+        finally:
+            for db in (old_db, new_db):
+                db.delete(order_id, saga_key)
+
+    def stock_app(self, **env):
+        if not tu.db_available("stock"):
+            self.skipTest("The DBs of the stock service are not reachable")
+        return tu.load_service_modules("stock", "app", shards=len(tu.DB_PORTS["stock"]), **env)[0]
+
+    def create_items_on_shards(self, stock_app, stock: int) -> list:
+        # Items of the same stock on two different shards
+        client = stock_app.app.test_client()
+        item_ids = [client.post("/item/create/5").json['item_id']]
+        while stock_app.get_db(item_ids[-1]) is stock_app.get_db(item_ids[0]):
+            item_ids.append(client.post("/item/create/5").json['item_id'])
+        item_ids = [item_ids[0], item_ids[-1]]
+        for item_id in item_ids:
+            self.assertTrue(tu.status_code_is_success(client.post(f"/add/{item_id}/{stock}").status_code))
+        return item_ids
+
+    def test_allocate_ids(self):
+        if not tu.db_available("stock"):
+            self.skipTest("The DBs of the stock service are not reachable")
+        shards: int = len(tu.DB_PORTS["stock"])
+        stock_app, sharding = tu.load_service_modules("stock", "app", "sharding", shards=shards)
+        # A replica allocates from the same counters with its own round robin
+        replica, = tu.load_service_modules("stock", "sharding", shards=shards)
+
+        # The ids allocated concurrently by the replicas are unique, each batch encodes the shard of its counter
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            batches = list(executor.map(lambda idx: (sharding if idx % 2 else replica).allocate_ids("item", 5),
+                                        range(60)))
+        ids = [item_id for batch in batches for item_id in batch]
+        self.assertEqual(len(set(ids)), len(ids))
+        for batch in batches:
+            numbers = [int(item_id.split(":")[1]) for item_id in batch]
+            self.assertTrue(all(number >= sharding.ID_OFFSET for number in numbers))
+            self.assertEqual(len({number % sharding.ID_STRIDE for number in numbers}), 1)
+            self.assertLess(numbers[0] % sharding.ID_STRIDE, shards)
+
+        # The created items are spread over all the shards and stored on the shard they are routed to
+        client = stock_app.app.test_client()
+        item_ids = [client.post("/item/create/5").json['item_id'] for _ in range(12)]
+        self.assertEqual({sharding.shard_index(item_id, shards) for item_id in item_ids}, set(range(shards)))
+        for item_id in item_ids:
+            self.assertTrue(sharding.db_shards[sharding.shard_index(item_id, shards)].exists(item_id))
+
+    def test_stock_scripts(self):
+        stock_app = self.stock_app(USE_SCRIPTS="True")
+        client = stock_app.app.test_client()
+        item_id1, item_id2 = self.create_items_on_shards(stock_app, 10)
+
+        # Test /stock/add and /stock/subtract
+        self.assertTrue(client.post(f"/subtract/{item_id1}/3").data.endswith(b" is 7"))
+        self.assertEqual(client.post(f"/subtract/{item_id1}/8").status_code, 400)
+        self.assertTrue(client.post(f"/add/{item_id1}/3").data.endswith(b" is 10"))
+        self.assertEqual(client.post("/add/item:0/3").status_code, 404)
+        self.assertEqual(client.post("/subtract/item:0/3").status_code, 404)
+        self.assertEqual(client.get(f"/find/{item_id1}").json['stock'], 10)
+
+        # Test /stock/add_batch and /stock/subtract_batch on several shards, all the items are updated or none
+        subtract_response = client.post("/subtract_batch", json={item_id1: 2, item_id2: 4})
+        self.assertEqual(subtract_response.json, {item_id1: 8, item_id2: 6})
+        add_response = client.post("/add_batch", json={item_id1: 2, item_id2: 4})
+        self.assertEqual(add_response.json, {item_id1: 10, item_id2: 10})
+        self.assertEqual(client.post("/subtract_batch", json={item_id1: 2, item_id2: 11}).status_code, 400)
+        self.assertEqual(client.post("/subtract_batch", json={item_id1: 2, "item:0": 1}).status_code, 404)
+        self.assertEqual(client.post("/add_batch", json={item_id1: 2, "item:0": 1}).status_code, 404)
+        self.assertEqual(client.post("/add_batch", json={item_id1: 0}).status_code, 400)
+        self.assertEqual(client.post("/find_batch", json=[item_id1, item_id2]).json[item_id2]['stock'], 10)
+        self.assertEqual(client.get(f"/find/{item_id1}").json['stock'], 10)
+
+    def test_stock_scripts_reservation(self):
+        stock_app = self.stock_app(USE_SCRIPTS="True")
+        client = stock_app.app.test_client()
+        item_id1, item_id2 = self.create_items_on_shards(stock_app, 10)
+        txn_id: str = f"test:{item_id1}"
+
+        # A reservation that fails on one shard reserves nothing
+        reserve_response = client.post(f"/subtract_batch/{txn_id}:failed", json={item_id1: 3, item_id2: 11})
+        self.assertEqual(reserve_response.status_code, 400)
+        self.assertEqual(client.get(f"/find/{item_id1}").json['stock'], 10)
+
+        # The stock is reserved once per transaction and released once
+        for _ in range(2):
+            reserve_response = client.post(f"/subtract_batch/{txn_id}", json={item_id1: 3, item_id2: 2})
+            self.assertEqual(reserve_response.json, {item_id1: 7, item_id2: 8})
+        for _ in range(2):
+            release_response = client.post(f"/add_batch/{txn_id}", json={item_id1: 3, item_id2: 2})
+            self.assertEqual(release_response.json, {item_id1: 10, item_id2: 10})
+
+        # A released transaction does not reserve the stock again, a cancelled one never reserves it
+        reserve_response = client.post(f"/subtract_batch/{txn_id}", json={item_id1: 3, item_id2: 2})
+        self.assertEqual(reserve_response.json, {item_id1: 10, item_id2: 10})
+        release_response = client.post(f"/add_batch/{txn_id}:late", json={item_id1: 3})
+        self.assertEqual(release_response.json, {item_id1: 10})
+        reserve_response = client.post(f"/subtract_batch/{txn_id}:late", json={item_id1: 3})
+        self.assertEqual(reserve_response.json, {item_id1: 10})
+
+    def split_stock_app(self):
+        if not tu.db_available("stock"):
+            self.skipTest("The DBs of the stock service are not reachable")
+        stock_app, item_parts = tu.load_service_modules("stock", "app", "item_parts", SPLIT_ITEMS="True")
+        item_id: str = f"item:{random.randrange(1 << 40, 1 << 41)}"
+        stock_app.get_db(item_id).hset(item_id, mapping={"item_id": item_id, "price": 5, "stock": 10})
+        self.addCleanup(stock_app.get_db(item_id).delete, item_id, *item_parts.item_part_keys(item_id, 4)[1:])
+        return stock_app, item_id
+
+    def test_split_item(self):
+        stock_app, item_id = self.split_stock_app()
+        client = stock_app.app.test_client()
+
+        # The stock is spread evenly over the parts, and the item still reports all of it
+        split_response = client.post(f"/item/split/{item_id}/4")
+        self.assertTrue(tu.status_code_is_success(split_response.status_code))
+        self.assertEqual(sorted(split_response.json['parts'].values()), [2, 2, 3, 3])
+        self.assertEqual(client.get(f"/find/{item_id}").json['stock'], 10)
+
+        # The parts cannot shrink
+        self.assertTrue(tu.status_code_is_failure(client.post(f"/item/split/{item_id}/2").status_code))
+
+        # The updates of a split item change its total stock
+        self.assertTrue(tu.status_code_is_success(client.post(f"/add/{item_id}/2").status_code))
+        self.assertTrue(tu.status_code_is_success(client.post(f"/subtract/{item_id}/1").status_code))
+        self.assertEqual(client.get(f"/find/{item_id}").json['stock'], 11)
+
+    def test_split_item_rebalance(self):
+        stock_app, item_id = self.split_stock_app()
+        client = stock_app.app.test_client()
+        self.assertTrue(tu.status_code_is_success(client.post(f"/item/split/{item_id}/4").status_code))
+
+        # No part has 6 items, they are gathered into one part
+        subtract_response = client.post("/subtract_batch", json={item_id: 6})
+        self.assertTrue(tu.status_code_is_success(subtract_response.status_code))
+        self.assertEqual(client.get(f"/find/{item_id}").json['stock'], 4)
+
+        # More than the total stock is never taken
+        subtract_response = client.post("/subtract_batch", json={item_id: 5})
+        self.assertTrue(tu.status_code_is_failure(subtract_response.status_code))
+        self.assertEqual(client.get(f"/find/{item_id}").json['stock'], 4)
+
+    def test_split_item_release(self):
+        stock_app, item_id = self.split_stock_app()
+        client = stock_app.app.test_client()
+        self.assertTrue(tu.status_code_is_success(client.post(f"/item/split/{item_id}/4").status_code))
+        txn_id: str = f"test:{item_id}"
+        self.addCleanup(stock_app.get_db(item_id).delete, *stock_app.transaction_keys(txn_id))
+
+        # The reservation is released once, to the part it was taken from
+        reserve_response = client.post(f"/subtract_batch/{txn_id}", json={item_id: 3})
+        self.assertTrue(tu.status_code_is_success(reserve_response.status_code))
+        self.assertEqual(client.get(f"/find/{item_id}").json['stock'], 7)
+        for _ in range(2):
+            release_response = client.post(f"/add_batch/{txn_id}", json={item_id: 3})
+            self.assertTrue(tu.status_code_is_success(release_response.status_code))
+            self.assertEqual(client.get(f"/find/{item_id}").json['stock'], 10)
+
+        # A released transaction does not reserve the stock again
+        reserve_response = client.post(f"/subtract_batch/{txn_id}", json={item_id: 3})
+        self.assertTrue(tu.status_code_is_success(reserve_response.status_code))
+        self.assertEqual(client.get(f"/find/{item_id}").json['stock'], 10)
+
+    def test_split_item_transfer_replay(self):
+        stock_app, item_id = self.split_stock_app()
+        client = stock_app.app.test_client()
+        self.assertTrue(tu.status_code_is_success(client.post(f"/item/split/{item_id}/2").status_code))
+        item_parts, = tu.load_service_modules("stock", "item_parts")
+        part_id: str = item_parts.part_key(item_id, 1)
+        db = stock_app.get_db(item_id)
+        transfer_ids = [f"test-{random.randrange(1 << 40)}" for _ in range(2)]
+        self.addCleanup(lambda: [stock_app.get_db(key).delete(f"transfer:{transfer_id}")
+                                 for key, transfer_id in zip((part_id, item_id), transfer_ids)])
+
+        # A process dies after taking the stock of a transfer, another one after adding it but before its cleanup
+        item_parts.take_stock_script(keys=[item_id, item_parts.PENDING_TRANSFERS],
+                                     args=[3, transfer_ids[0], part_id], client=db)
+        item_parts.take_stock_script(keys=[part_id, item_parts.PENDING_TRANSFERS],
+                                     args=[1, transfer_ids[1], item_id], client=stock_app.get_db(part_id))
+        item_parts.receive_stock_script(keys=[item_id, f"transfer:{transfer_ids[1]}"],
+                                        args=[1, item_parts.TRANSFER_RECEIPT_TTL], client=db)
+        self.assertEqual(client.get(f"/find/{item_id}").json['stock'], 7)
+
+        # The service completes both transfers when it starts, each one only once
+        for _ in range(2):
+            stock_app = tu.load_service_modules("stock", "app", SPLIT_ITEMS="True")[0]
+            client = stock_app.app.test_client()
+            self.assertEqual(client.get(f"/find/{item_id}").json['stock'], 10)
+            self.assertEqual(item_parts.read_stocks([item_id, part_id]), {item_id: 3, part_id: 7})
+        self.assertEqual(db.hmget(item_parts.PENDING_TRANSFERS, transfer_ids), [None, None])
+
+    def order_app(self, **env):
+        if not tu.db_available("order"):
+            self.skipTest("The DBs of the order service are not reachable")
+        return tu.load_service_modules("order", "app", COMPENSATION_WORKERS="0", SAGA_RECOVERY_INTERVAL="0", **env)[0]
+
+    def test_sold_out_restock(self):
+        # Without a bus the restocks are not notified, so the sold out items are not cached
+        self.assertEqual(self.order_app(SOLD_OUT_TTL="60").sold_out_items.ttl, 0)
+        if not tu.db_available("bus"):
+            self.skipTest("The DB of the bus is not reachable")
+        order_app = self.order_app(SOLD_OUT_TTL="60", **tu.bus_environment())
+        client = order_app.app.test_client()
+
+        user_id: str = tu.create_user()['user_id']
+        order_id: str = client.post(f"/create/{user_id}").json['order_id']
+        item_id: str = tu.create_item(5)['item_id']
+
+        # The item without stock is remembered as sold out
+        self.assertTrue(tu.status_code_is_failure(client.post(f"/addItem/{order_id}/{item_id}").status_code))
+        self.assertEqual(order_app.sold_out_items.unavailable({item_id: 1}), item_id)
+
+        # Its restock is published on the bus and forgotten long before the TTL
+        bus = tu.connect_db("bus")
+        deadline: float = time.monotonic() + 5
+        while not bus.pubsub_numsub(order_app.STOCK_RESTOCKED)[0][1] and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertTrue(tu.status_code_is_success(tu.add_stock(item_id, 1)))
+        while order_app.sold_out_items.unavailable({item_id: 1}) is not None and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertTrue(tu.status_code_is_success(client.post(f"/addItem/{order_id}/{item_id}").status_code))
+
+    def test_bus_consumer(self):
+        # The streams transport cannot start without a bus
+        with self.assertRaises(RuntimeError):
+            tu.load_service_modules("stock", "bus", SAGA_TRANSPORT="streams", BUS_REDIS_HOST="")
+        if not tu.db_available("bus"):
+            self.skipTest("The DB of the bus is not reachable")
+        bus = tu.load_service_modules("stock", "bus", BUS_BLOCK_TIME="100", BUS_CLAIM_IDLE="200",
+                                      **tu.bus_environment())[0]
+
+        app = Flask("test_bus_consumer")
+        app.testing = True
+        app.add_url_rule("/ok", "ok", lambda: "ok")
+        app.add_url_rule("/fail", "fail", lambda: 1 / 0)
+        service: str = f"test-{random.randrange(1 << 40)}"
+        stream: str = bus.command_stream(service)
+        client = bus.StreamClient(service)
+
+        # A command read by a consumer that died before replying is claimed by another consumer
+        bus.create_group(stream)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            reply = executor.submit(client.get, "/ok", timeout=5)
+            deadline: float = time.monotonic() + 5
+            while not bus.bus.xlen(stream) and time.monotonic() < deadline:
+                time.sleep(0.05)
+            self.assertTrue(bus.bus.xreadgroup(bus.CONSUMER_GROUP, "dead", {stream: ">"}, count=1))
+            threading.Thread(target=bus.run_consumer, args=(app, stream, "alive"), daemon=True).start()
+            self.assertEqual(reply.result().status_code, 200)
+
+        # A command that fails is answered with an error instead of the timeout of the requester
+        response = client.get("/fail", timeout=5)
+        self.assertEqual(response.status_code, 500)
+        self.assertIn("division by zero", response.text)
+
+        # The answered commands are acknowledged and deleted
+        deadline = time.monotonic() + 5
+        while bus.bus.xpending(stream, bus.CONSUMER_GROUP)["pending"] and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(bus.bus.xpending(stream, bus.CONSUMER_GROUP)["pending"], 0)
+        self.assertEqual(bus.bus.xlen(stream), 0)
+
+    def test_service_client_ejection(self):
+        service_client, = tu.load_service_modules("order", "service_client", EJECT_FAILURES="2", EJECT_TIME="3")
+        healthy_url, dead_url = f"{tu.STOCK_URL}/stock", "http://127.0.0.1:1"
+        client = service_client.ServiceClient([healthy_url, dead_url])
+        healthy, dead = client.endpoints
+        item_id: str = tu.create_item(5)['item_id']
+
+        def find() -> bool:
+            try:
+                return tu.status_code_is_success(client.get(f"/find/{item_id}").status_code)
+            except service_client.requests.ConnectionError:
+                return False
+
+        # The dead endpoint is ejected after its consecutive failures, then only the healthy one is picked
+        while not dead.ejections:
+            find()
+        self.assertTrue(all(find() for _ in range(10)))
+        self.assertEqual((dead.requests, dead.ejections), (2, 1))
+        self.assertTrue(client.stats()["endpoints"][dead_url]["ejected"])
+
+        # It is admitted again after the ejection time, and ejected again while it keeps failing
+        time.sleep(max(dead.ejected_until - time.monotonic(), 0))
+        while dead.requests == 2:
+            find()
+        self.assertFalse(client.stats()["endpoints"][dead_url]["ejected"])
+        while dead.ejections == 1:
+            find()
+        self.assertEqual(dead.requests, 4)
+        self.assertEqual(healthy.failures, 0)
+
+    def test_saga_plan(self):
+        saga_planner, = tu.load_service_modules("order", "saga_planner", ADAPTIVE_SAGA_ORDER="True",
+                                                SAGA_STATS_ALPHA="0.5")
+        steps = {saga_planner.STOCK_STEP: "stock", saga_planner.PAYMENT_STEP: "payment"}
+        stock, payment = (saga_planner.step_stats[name] for name in steps)
+
+        # The default order is kept without statistics
+        self.assertEqual(saga_planner.plan_steps(steps), ["stock", "payment"])
+
+        # The step that fails more often runs first, at the same latency
+        for _ in range(5):
+            stock.observe(False, 0.01)
+            payment.observe(True, 0.01)
+        self.assertEqual(saga_planner.plan_steps(steps), ["payment", "stock"])
+        self.assertEqual(saga_planner.saga_stats()["order"], ["payment", "stock"])
+
+        # A step much slower for each failure it detects runs last, even if it fails more often
+        for _ in range(5):
+            stock.observe(True, 0.01)
+            payment.observe(True, 1)
+        stock.observe(False, 0.01)
+        self.assertGreater(payment.failure_rate, stock.failure_rate)
+        self.assertEqual(saga_planner.plan_steps(steps), ["stock", "payment"])
+
+        # The precheck of the failures only moves the failure rate
+        for _ in range(10):
+            stock.observe(False)
+        self.assertEqual(stock.prechecks, 10)
+        self.assertEqual(stock.executions, 11)
+        self.assertEqual(saga_planner.plan_steps(steps), ["payment", "stock"])
+
+        # Without the adaptive order the default order is kept whatever the statistics
+        saga_planner, = tu.load_service_modules("order", "saga_planner")
+        saga_planner.step_stats[saga_planner.PAYMENT_STEP].observe(True, 0.01)
+        self.assertEqual(saga_planner.plan_steps(steps), ["stock", "payment"])
+
+    def test_async_checkout(self):
+        order_app = self.order_app(ASYNC_CHECKOUT="True", CHECKOUT_BLOCK_TIME="100")
+        client = order_app.app.test_client()
+
+        user_id: str = tu.create_user()['user_id']
+        self.assertTrue(tu.status_code_is_success(tu.add_credit_to_user(user_id, 15)))
+        item_id: str = tu.create_item(5)['item_id']
+        self.assertTrue(tu.status_code_is_success(tu.add_stock(item_id, 1)))
+        order_id: str = client.post(f"/create/{user_id}").json['order_id']
+        self.assertTrue(tu.status_code_is_success(client.post(f"/addItem/{order_id}/{item_id}").status_code))
+
+        # There is no checkout to poll before the order is queued
+        self.assertEqual(client.get(f"/checkout_status/{order_id}").status_code, 404)
+
+        # The checkout is queued with a ticket, a duplicate request returns the same ticket
+        checkout_response = client.post(f"/checkout/{order_id}")
+        self.assertEqual(checkout_response.status_code, 202)
+        ticket: str = checkout_response.json['ticket']
+        self.assertEqual(client.post(f"/checkout/{order_id}").json['ticket'], ticket)
+
+        # Poll the status until the worker has run the checkout
+        deadline: float = time.monotonic() + 10
+        status: dict = client.get(f"/checkout_status/{order_id}").json
+        while status['status'] in ("queued", "processing") and time.monotonic() < deadline:
+            time.sleep(0.1)
+            status = client.get(f"/checkout_status/{order_id}").json
+        self.assertEqual(status['ticket'], ticket)
+        self.assertEqual(status['status'], "succeeded")
+        self.assertTrue(client.get(f"/find/{order_id}").json['paid'])
+        self.assertEqual(tu.find_item(item_id)['stock'], 0)
+        self.assertEqual(tu.find_user(user_id)['credit'], 10)
+
+        # A paid order is not queued again
+        self.assertTrue(tu.status_code_is_failure(client.post(f"/checkout/{order_id}").status_code))
+
+    def test_duplicate_checkouts(self):
+        order_app = self.order_app(CHECKOUT_COALESCING="True")
+        client = order_app.app.test_client()
+
+        user_id: str = tu.create_user()['user_id']
+        self.assertTrue(tu.status_code_is_success(tu.add_credit_to_user(user_id, 15)))
+        item_id: str = tu.create_item(5)['item_id']
+        self.assertTrue(tu.status_code_is_success(tu.add_stock(item_id, 10)))
+        order_id: str = client.post(f"/create/{user_id}").json['order_id']
+        self.assertTrue(tu.status_code_is_success(client.post(f"/addItem/{order_id}/{item_id}").status_code))
+
+        # The duplicate checkouts of the order all return the outcome of the single checkout that runs
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            responses = list(executor.map(lambda _: client.post(f"/checkout/{order_id}"), range(5)))
+        responses.append(client.post(f"/checkout/{order_id}"))
+        self.assertTrue(all(tu.status_code_is_success(response.status_code) for response in responses))
+        self.assertEqual(len({response.data for response in responses}), 1)
+
+        # The order is paid once
+        self.assertTrue(client.get(f"/find/{order_id}").json['paid'])
+        self.assertEqual(tu.find_item(item_id)['stock'], 9)
+        self.assertEqual(tu.find_user(user_id)['credit'], 10)
+
+    def test_fair_lock_order(self):
+        if not tu.db_available("stock"):
+            self.skipTest("The DBs of the stock service are not reachable")
+        lease_lock, = tu.load_service_modules("stock", "lease_lock", LOCK_FAIR_QUEUE="True", LOCK_BACKOFF_MAX="0.02")
+        db = tu.connect_db("stock")
+        key: str = f"item:{random.randrange(1 << 40, 1 << 41)}"
+        queue_key: str = lease_lock.lock_queue_key(key)
+        self.addCleanup(db.delete, lease_lock.lock_key(key), queue_key)
+
+        holder = lease_lock.LeaseLock(key, db)
+        self.assertTrue(holder.acquire())
+
+        # The waiters arrive one after the other while the lock is held
+        acquired = []
+
+        def wait_for_lock(waiter: int):
+            with lease_lock.locked(lease_lock.LeaseLock(key, db), timeout=10) as lock_acquired:
+                self.assertTrue(lock_acquired)
+                acquired.append(waiter)
+                time.sleep(0.01)
+
+        threads = []
+        for waiter in range(5):
+            threads.append(threading.Thread(target=wait_for_lock, args=(waiter,)))
+            threads[-1].start()
+            while db.zcard(queue_key) <= waiter:
+                time.sleep(0.005)
+            time.sleep(0.005)
+
+        # They get the lock in arrival order, also if a later one retries first
+        holder.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(acquired, list(range(5)))
+        self.assertEqual(db.zcard(queue_key), 0)
+
 if __name__ == '__main__':
     unittest.main()
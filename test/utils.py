@@ -1,7 +1,25 @@
+import importlib
+import os
+import sys
+
+import redis
 import requests
 
 ORDER_URL = STOCK_URL = PAYMENT_URL = "http://127.0.0.1:8000"  # "http://192.168.49.2"
 
+# The shards of the DB of each service, and the DB of the bus, as published by docker-compose
+DB_HOST = "127.0.0.1"
+DB_PASSWORD = "redis"
+DB_PORTS = {
+    "order": [8010, 8011, 8012],
+    "stock": [8020, 8021, 8022],
+    "payment": [8030, 8031, 8032],
+    "bus": [8040],
+}
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICES = ("order", "stock", "payment")
+
 
 ########################################################################################################################
 #   STOCK MICROSERVICE FUNCTIONS
@@ -10,10 +28,18 @@ def create_item(price: float) -> dict:
     return requests.post(f"{STOCK_URL}/stock/item/create/{price}").json()
 
 
+def batch_create_items(n: int, price: float, stock: int) -> dict:
+    return requests.post(f"{STOCK_URL}/stock/item/batch_create/{n}/{price}/{stock}").json()
+
+
 def find_item(item_id: str) -> dict:
     return requests.get(f"{STOCK_URL}/stock/find/{item_id}").json()
 
 
+def find_items_batch(item_ids: list) -> dict:
+    return requests.post(f"{STOCK_URL}/stock/find_batch", json=item_ids).json()
+
+
 def add_stock(item_id: str, amount: int) -> int:
     return requests.post(f"{STOCK_URL}/stock/add/{item_id}/{amount}").status_code
 
@@ -22,6 +48,22 @@ def subtract_stock(item_id: str, amount: int) -> int:
     return requests.post(f"{STOCK_URL}/stock/subtract/{item_id}/{amount}").status_code
 
 
+def add_stock_batch(items: dict) -> int:
+    return requests.post(f"{STOCK_URL}/stock/add_batch", json=items).status_code
+
+
+def subtract_stock_batch(items: dict) -> int:
+    return requests.post(f"{STOCK_URL}/stock/subtract_batch", json=items).status_code
+
+
+def reserve_stock_batch(txn_id: str, items: dict) -> int:
+    return requests.post(f"{STOCK_URL}/stock/subtract_batch/{txn_id}", json=items).status_code
+
+
+def release_stock_batch(txn_id: str, items: dict) -> int:
+    return requests.post(f"{STOCK_URL}/stock/add_batch/{txn_id}", json=items).status_code
+
+
 ########################################################################################################################
 #   PAYMENT MICROSERVICE FUNCTIONS
 ########################################################################################################################
@@ -29,18 +71,38 @@ def payment_pay(user_id: str, order_id: str, amount: float) -> int:
     return requests.post(f"{PAYMENT_URL}/payment/pay/{user_id}/{order_id}/{amount}").status_code
 
 
+def payment_pay_transaction(user_id: str, order_id: str, amount: float, txn_id: str) -> int:
+    return requests.post(f"{PAYMENT_URL}/payment/pay/{user_id}/{order_id}/{amount}/{txn_id}").status_code
+
+
+def payment_cancel_transaction(user_id: str, order_id: str, txn_id: str) -> int:
+    return requests.post(f"{PAYMENT_URL}/payment/cancel/{user_id}/{order_id}/{txn_id}").status_code
+
+
 def create_user() -> dict:
     return requests.post(f"{PAYMENT_URL}/payment/create_user").json()
 
 
+def batch_create_users(n: int, credit: float) -> dict:
+    return requests.post(f"{PAYMENT_URL}/payment/batch_create_users/{n}/{credit}").json()
+
+
 def find_user(user_id: str) -> dict:
     return requests.get(f"{PAYMENT_URL}/payment/find_user/{user_id}").json()
 
 
+def find_users_batch(user_ids: list) -> dict:
+    return requests.post(f"{PAYMENT_URL}/payment/find_batch", json=user_ids).json()
+
+
 def add_credit_to_user(user_id: str, amount: float) -> int:
     return requests.post(f"{PAYMENT_URL}/payment/add_funds/{user_id}/{amount}").status_code
 
 
+def payment_held_locks() -> list:
+    return requests.get(f"{PAYMENT_URL}/payment/locks").json()
+
+
 ########################################################################################################################
 #   ORDER MICROSERVICE FUNCTIONS
 ########################################################################################################################
@@ -52,6 +114,10 @@ def add_item_to_order(order_id: str, item_id: str) -> int:
     return requests.post(f"{ORDER_URL}/orders/addItem/{order_id}/{item_id}").status_code
 
 
+def remove_item_from_order(order_id: str, item_id: str) -> int:
+    return requests.delete(f"{ORDER_URL}/orders/removeItem/{order_id}/{item_id}").status_code
+
+
 def find_order(order_id: str) -> dict:
     return requests.get(f"{ORDER_URL}/orders/find/{order_id}").json()
 
@@ -69,3 +135,61 @@ def status_code_is_success(status_code: int) -> bool:
 
 def status_code_is_failure(status_code: int) -> bool:
     return 400 <= status_code < 500
+
+
+########################################################################################################################
+#   SERVICE MODULES ON THE DEPLOYED DBS
+########################################################################################################################
+def connect_db(service: str, shard: int = 0) -> redis.Redis:
+    return redis.Redis(host=DB_HOST, port=DB_PORTS[service][shard], password=DB_PASSWORD)
+
+
+def db_available(service: str) -> bool:
+    try:
+        return all(connect_db(service, shard).ping() for shard in range(len(DB_PORTS[service])))
+    except redis.RedisError:
+        return False
+
+
+def bus_environment() -> dict:
+    return {"BUS_REDIS_HOST": DB_HOST, "BUS_REDIS_PORT": str(DB_PORTS["bus"][0]), "BUS_REDIS_PASSWORD": DB_PASSWORD}
+
+
+def load_service_modules(service: str, *modules: str, shards: int = 1, **env) -> list:
+    """
+    Import modules of a service in the test process, connected to the first shards of the deployed DB of the service.
+    The modules of the services share their names, so the modules loaded before from any service are replaced.
+    The modules are imported with the first shard only, the other shards are added to the topology afterwards.
+
+    :param service: The name of the service, e.g. stock.
+    :param modules: The names of the modules, e.g. lease_lock.
+    :param shards: The number of shards of the topology.
+    :param env: The environment variables to set while the modules are imported.
+    :return: The imported modules.
+    """
+    service_dirs = tuple(os.path.join(ROOT_DIR, name) + os.sep for name in SERVICES)
+    for name, module in list(sys.modules.items()):
+        if (getattr(module, "__file__", None) or "").startswith(service_dirs):
+            del sys.modules[name]
+
+    environ = dict(os.environ)
+    os.environ.update({
+        "REDIS_HOSTS": DB_HOST,
+        "REDIS_PORT": str(DB_PORTS[service][0]),
+        "REDIS_PASSWORD": DB_PASSWORD,
+        "REDIS_DB": "0",
+        "STOCK_SERVICE_URL": f"{STOCK_URL}/stock",
+        "USER_SERVICE_URL": f"{PAYMENT_URL}/payment",
+        "SERVICE_DISCOVERY_INTERVAL": "0",
+        **env,
+    })
+    sys.path.insert(0, os.path.join(ROOT_DIR, service))
+    try:
+        imported = [importlib.import_module(module) for module in modules]
+        if "sharding" in sys.modules:
+            sys.modules["sharding"].db_shards[1:] = [connect_db(service, shard) for shard in range(1, shards)]
+        return imported
+    finally:
+        sys.path.pop(0)
+        os.environ.clear()
+        os.environ.update(environ)